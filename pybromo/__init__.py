@@ -13,6 +13,9 @@ from . import diffusion
 from . import timestamps
 from . import plot
 from . import plotter
+from . import rng
+from . import boundary
+from . import pipeline
 
 from .utils import hdf5
 
@@ -0,0 +1,195 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module contains the boundary conditions applied to the particles
+positions during the Brownian motion simulation.
+
+A boundary condition is an object derived from :class:`BoundaryCondition`.
+Calling it with an array of positions (coordinates on the second-last
+axis, e.g. shape (3, T) or (N, 3, T)) and the box boundaries (shape (3, 2),
+as `Box.b`) folds, in-place, all the positions inside the box:
+
+- :class:`PeriodicBoundary`: periodic boundary conditions (without
+  temporary arrays).
+- :class:`MirrorBoundary`: mirror-like (reflecting) boundary conditions.
+  Only the positions outside the box are modified, and they are folded
+  with any number of reflections. The positions outside are found using
+  a boolean buffer reused between calls (no full-size temporary arrays).
+
+The functions :func:`wrap_periodic` and :func:`wrap_mirror` apply the same
+boundary conditions to a single coordinate. Any other function with the
+same signature can be used as boundary condition through
+:class:`FuncBoundary` (see :func:`get_boundary`).
+"""
+
+import numpy as np
+
+
+# Boundary condition identifiers used by the fused kernels
+PERIODIC, MIRROR = 0, 1
+
+
+def periodic_inplace(a, lo, hi):
+    """Fold `a` in [lo, hi) with periodic boundary conditions.
+
+    `lo` and `hi` are broadcasted to `a`, which is modified in-place.
+    """
+    a -= lo
+    np.mod(a, hi - lo, out=a)
+    a += lo
+    return a
+
+
+def mirror_inplace(a, lo, hi, mask=None):
+    """Fold `a` in [lo, hi] with mirror boundary conditions.
+
+    `lo` and `hi` are broadcasted to `a`, which is modified in-place.
+    Only the samples outside [lo, hi] are modified: they are reflected
+    once as in :func:`wrap_mirror` (with the same floating point
+    operations) and, if still outside, folded with any number of
+    reflections, computing `hi - |((a - lo) mod 2 size) - size|`.
+
+    `mask` is a boolean array of shape `(2,) + a.shape` used as buffer to
+    find the samples outside. If None, a new array is allocated. The
+    other temporary arrays have the size of the samples outside.
+    """
+    if mask is None:
+        mask = np.empty((2,) + a.shape, dtype=bool)
+    lo, hi = np.broadcast_to(lo, a.shape), np.broadcast_to(hi, a.shape)
+    outside, above = mask[0], mask[1]
+    np.less(a, lo, out=outside)
+    np.greater(a, hi, out=above)
+    np.logical_or(outside, above, out=outside)
+    if not outside.any():
+        return a
+    v, lo, hi = a[outside], lo[outside], hi[outside]
+    above = v > hi
+    v[above] = hi[above] - (v[above] - hi[above])
+    below = v < lo
+    v[below] = lo[below] + (lo[below] - v[below])
+    far = (v < lo) | (v > hi)
+    if far.any():
+        size = hi[far] - lo[far]
+        u = np.mod(v[far] - lo[far], 2 * size)
+        v[far] = hi[far] - np.abs(u - size)
+    a[outside] = v
+    return a
+
+
+def wrap_periodic(a, a1, a2):
+    """Folds all the values of `a` outside [a1..a2] inside that interval.
+    This function is used to apply periodic boundary conditions.
+    The array `a` is modified in-place and returned.
+    """
+    return periodic_inplace(a, a1, a2)
+
+
+def wrap_mirror(a, a1, a2):
+    """Folds all the values of `a` outside [a1..a2] inside that interval.
+    This function is used to apply mirror-like boundary conditions.
+    The array `a` is modified in-place and returned.
+    """
+    return mirror_inplace(a, a1, a2)
+
+
+class BoundaryCondition:
+    """Base class for the boundary conditions.
+
+    Subclasses implement :meth:`apply`. The attribute `kernel_id` is the
+    identifier used by the fused kernels (None if not supported).
+    """
+    kernel_id = None
+
+    def apply(self, pos, lo, hi):
+        """Fold `pos` in [lo, hi] in-place and return it.
+
+        `lo` and `hi` have shape (3, 1): the lower and upper boundary of
+        each coordinate.
+        """
+        raise NotImplementedError
+
+    def __call__(self, pos, bounds):
+        """Apply the boundary conditions in-place to `pos` and return it.
+
+        Arguments:
+            pos (array): positions with the 3 coordinates on the
+                second-last axis, e.g. shape (3, T) or (N, 3, T).
+            bounds (array): box boundaries, shape (3, 2) (see `Box.b`).
+        """
+        bounds = np.asarray(bounds)
+        return self.apply(pos, bounds[:, :1], bounds[:, 1:])
+
+    def __repr__(self):
+        return '%s()' % type(self).__name__
+
+
+class PeriodicBoundary(BoundaryCondition):
+    """Periodic boundary conditions."""
+    kernel_id = PERIODIC
+
+    def apply(self, pos, lo, hi):
+        return periodic_inplace(pos, lo, hi)
+
+
+class MirrorBoundary(BoundaryCondition):
+    """Mirror-like boundary conditions (with multiple reflections).
+
+    The mask buffer of :func:`mirror_inplace` is kept and reused by the
+    following calls with positions of the same (or smaller) size, so an
+    instance must not be shared between threads.
+    """
+    kernel_id = MIRROR
+
+    def __init__(self):
+        self.buffer = np.zeros(0, dtype=bool)
+
+    def apply(self, pos, lo, hi):
+        size = 2 * pos.size
+        if self.buffer.size < size:
+            self.buffer = np.empty(size, dtype=bool)
+        mask = self.buffer[:size].reshape((2,) + pos.shape)
+        return mirror_inplace(pos, lo, hi, mask=mask)
+
+
+class FuncBoundary(BoundaryCondition):
+    """Boundary conditions from a function applied to each coordinate.
+
+    `func(a, a1, a2)` must return the values of `a` folded in [a1..a2].
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def apply(self, pos, lo, hi):
+        lo, hi = np.ravel(lo), np.ravel(hi)
+        for coord in (0, 1, 2):
+            pos[..., coord, :] = self.func(pos[..., coord, :], lo[coord],
+                                           hi[coord])
+        return pos
+
+    def __repr__(self):
+        return 'FuncBoundary(%s)' % self.func.__name__
+
+
+periodic = PeriodicBoundary()
+mirror = MirrorBoundary()
+
+
+def get_boundary(wrap_func):
+    """Return the :class:`BoundaryCondition` object for `wrap_func`.
+
+    `wrap_func` can be a :class:`BoundaryCondition` (returned as is),
+    :func:`wrap_periodic`, :func:`wrap_mirror` or any other function
+    with the same signature (wrapped in a :class:`FuncBoundary`).
+    """
+    if isinstance(wrap_func, BoundaryCondition):
+        return wrap_func
+    if wrap_func is wrap_periodic:
+        return periodic
+    if wrap_func is wrap_mirror:
+        return mirror
+    return FuncBoundary(wrap_func)
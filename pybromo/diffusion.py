@@ -12,16 +12,29 @@ Brownian motion and timestamps simulation.
 import os
 import hashlib
 import itertools
+from functools import partial
 from pathlib import Path
 from time import ctime
 import json
+import multiprocessing
+from collections import deque
 
 import numpy as np
 from numpy import array, sqrt
 
-from .storage import TrajectoryStore, TimestampStore, ExistingArrayError
-from .iter_chunks import iter_chunksize, iter_chunk_index
-from .psflib import NumericPSF
+from .storage import (TrajectoryStore, TimestampStore, ExistingArrayError,
+                      SparseEmissionArray)
+from .iter_chunks import iter_chunksize, iter_chunk_index, MemoryBudget
+from .psflib import NumericPSF, psf_from_hdf5
+from .boundary import (wrap_periodic, wrap_mirror, get_boundary,
+                       PeriodicBoundary)
+from .sampling import (sim_timetrace, sim_timetrace_bg, sim_timetrace_bg2,
+                       sim_counts, sim_timetrace_bg_sparse,
+                       sim_photons_thinning, CountsBuffer)
+from .pipeline import (run, diffusion_chunks, emission_chunks, progress,
+                       Photons, TrajectorySink, TimestampSink, ThreadedSink)
+from . import rng
+from . import kernels
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -29,10 +42,19 @@ __version__ = get_versions()['version']
 # Avogadro constant
 NA = 6.022141e23    # [mol^-1]
 
+# Bytes per particle and time step used to plan the chunks
+# (see ParticlesSimulation.memory_budget)
+_EMISSION_BYTES = 4     # float32 emission
+_PHOTON_BYTES = 2       # uint8 counts (and indexes of the bins with counts)
+
 
 def get_seed(seed, ID=0, EID=0):
     """Get a random seed that is a combination of `seed`, `ID` and `EID`.
-    Provides different, but deterministic, seeds in parallel computations
+    Provides different, but deterministic, seeds in parallel computations.
+
+    Seeds of different (`seed`, `ID`, `EID`) combinations may collide.
+    For new code, prefer independent streams spawned from a SeedSequence
+    (see :func:`rng.spawn_generators` and :class:`rng.StreamSet`).
     """
     return seed + EID + 100 * ID
 
@@ -92,50 +114,72 @@ class Particle(object):
 
 
 class Particles(object):
-    """A list of Particle() objects and a few attributes."""
+    """A set of particles stored as arrays of positions and diffusion coeff.
+
+    The initial positions are stored in an array of shape (N, 3) (see `r0`)
+    and the diffusion coefficients in an array of shape (N,). Iterating or
+    indexing returns `Particle` objects.
+    """
+
+    # Layout of the particles table saved in '/parameters/particles'
+    dtype = np.dtype([('D', 'f8'), ('x0', 'f8'), ('y0', 'f8'), ('z0', 'f8')])
 
     @staticmethod
     def _generate(num_particles, D, box, rs):
-        """Generate a list of `Particle` objects."""
-        X0 = rs.rand(num_particles) * (box.x2 - box.x1) + box.x1
-        Y0 = rs.rand(num_particles) * (box.y2 - box.y1) + box.y1
-        Z0 = rs.rand(num_particles) * (box.z2 - box.z1) + box.z1
-        return [Particle(D=D, x0=x0, y0=y0, z0=z0)
-                for x0, y0, z0 in zip(X0, Y0, Z0)]
+        """Generate `num_particles` random positions in `box`.
+
+        Returns:
+            A tuple (r0, D) with the positions, shape (num_particles, 3),
+            and the diffusion coefficients, shape (num_particles,).
+        """
+        X0 = rng.uniform(rs, num_particles) * (box.x2 - box.x1) + box.x1
+        Y0 = rng.uniform(rs, num_particles) * (box.y2 - box.y1) + box.y1
+        Z0 = rng.uniform(rs, num_particles) * (box.z2 - box.z1) + box.z1
+        return (np.column_stack([X0, Y0, Z0]),
+                np.full(num_particles, D, dtype='float64'))
 
     def __init__(self, num_particles, D, box, rs=None, seed=1, particles=None):
-        """A set of `N` Particle() objects with random position in `box`.
+        """A set of `N` particles with random position in `box`.
 
         Arguments:
             num_particles (int): number of particles to be generated
             D (float): diffusion coefficient in S.I. units (m^2/s)
             box (Box object): the simulation box
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state. `seed` is ignored when `rs` is not None.
-            particles (list or None): when not None, initialize the object from
-                this list that must containing only `Particle` objects.
+            particles (list, tuple or None): when not None, initialize the
+                object from a list of `Particle` objects or from a tuple
+                of arrays (r0, D) as returned by `_generate()`.
         """
         if rs is None:
             rs = np.random.RandomState(seed=seed)
         self.rs = rs
-        self.init_random_state = rs.get_state()
+        self.init_random_state = rng.get_state(rs)
         self.box = box
         if particles is None:
-            self._plist = self._generate(num_particles, D, box, rs)
+            r0, D = self._generate(num_particles, D, box, rs)
+        elif isinstance(particles, tuple):
+            r0, D = particles
         else:
-            self._plist = list(particles)
+            particles = list(particles)
+            r0 = [(p.x0, p.y0, p.z0) for p in particles]
+            D = [p.D for p in particles]
+        self._r0 = np.array(r0, dtype='float64').reshape(-1, 3)
+        self._D = np.array(D, dtype='float64').reshape(-1)
         self.rs_hash = hash_(self.init_random_state)[:3]
 
     def add(self, num_particles, D):
         """Add particles with diffusion coefficient `D` at random positions.
         """
-        self._plist += self._generate(num_particles, D, box=self.box,
-                                      rs=self.rs)
+        r0, D = self._generate(num_particles, D, box=self.box, rs=self.rs)
+        self._r0 = np.concatenate([self._r0, r0])
+        self._D = np.concatenate([self._D, D])
 
     def to_list(self):
-        return self._plist.copy()
+        return [Particle(D, *r0) for D, r0 in zip(self._D, self._r0)]
 
     def to_json(self):
         return json.dumps({'particles': [v.to_dict() for v in self]})
@@ -146,29 +190,54 @@ class Particles(object):
         # This returned obj will throw an error if the user calls .add()
         return cls(particles=particles, num_particles=None, D=None, box=None)
 
+    def to_array(self):
+        """Return a structured array of the particles (see `dtype`)."""
+        arr = np.zeros(len(self), dtype=self.dtype)
+        arr['D'] = self._D
+        arr['x0'], arr['y0'], arr['z0'] = self._r0.T
+        return arr
+
+    @classmethod
+    def from_array(cls, arr):
+        """Create a `Particles` object from a structured array (see `dtype`).
+        """
+        r0 = np.column_stack([arr['x0'], arr['y0'], arr['z0']])
+        # This returned obj will throw an error if the user calls .add()
+        return cls(particles=(r0, arr['D']), num_particles=None, D=None,
+                   box=None)
+
     def __iter__(self):
-        return iter(self._plist)
+        return iter(self.to_list())
 
     def __len__(self):
-        return len(self._plist)
+        return self._D.size
 
     def __getitem__(self, i):
-        return self._plist[i]
+        if isinstance(i, slice):
+            return self.to_list()[i]
+        return Particle(self._D[i], *self._r0[i])
 
     def __eq__(self, other_particles):
-        if len(self) != len(other_particles):
-            return False
-        equal = np.array([p1 == p2 for p1, p2 in zip(self, other_particles)])
-        return equal.all()
+        if not isinstance(other_particles, Particles):
+            other_particles = Particles(num_particles=None, D=None, box=None,
+                                        particles=other_particles)
+        return (len(self) == len(other_particles) and
+                (self._r0 == other_particles._r0).all() and
+                (self._D == other_particles._D).all())
+
+    @property
+    def r0(self):
+        """Initial position for each particle. Shape (N, 3)."""
+        return self._r0.copy()
 
     @property
     def positions(self):
         """Initial position for each particle. Shape (N, 3, 1)."""
-        return np.vstack([p.r0 for p in self]).reshape(len(self), 3, 1)
+        return self._r0.reshape(len(self), 3, 1).copy()
 
     @property
     def diffusion_coeff(self):
-        return np.array([par.D for par in self])
+        return self._D.copy()
 
     @property
     def diffusion_coeff_counts(self):
@@ -189,22 +258,138 @@ class Particles(object):
         return ", ".join(s)
 
 
-def wrap_periodic(a, a1, a2):
-    """Folds all the values of `a` outside [a1..a2] inside that interval.
-    This function is used to apply periodic boundary conditions.
+def draw_steps(rs, sigma, size, dtype='float64'):
+    """Draw normally distributed Brownian motion steps.
+
+    Arguments:
+        rs (RandomState, Generator or StreamSet): random number generator.
+            A StreamSet must contain one stream per particle (`size[0]`).
+        sigma (array): standard deviation of the steps, shape (size[0], 1, 1).
+        size (tuple): shape of the returned array (particles, 3, time).
+        dtype (string or numpy dtype): 'float64' or 'float32'.
+
+    With float64, the numbers are drawn as a single `rs.normal()` call
+    (one call per particle for a StreamSet). With float32 and a
+    `Generator` the steps are drawn directly in float32 (ziggurat), while
+    with a `RandomState` they are drawn in float64 one particle at a time
+    (same sequence as the float64 case) and rounded to float32.
     """
-    a -= a1
-    wrapped = np.mod(a, a2 - a1) + a1
-    return wrapped
+    dtype = np.dtype(dtype)
+    streams = isinstance(rs, rng.StreamSet)
+    if dtype == np.float64 and not streams:
+        return rs.normal(loc=0, scale=sigma, size=size)
+    steps = np.empty(size, dtype=dtype)
+    for i in range(size[0]):
+        rs_i = rs[i] if streams else rs
+        if dtype != np.float64 and isinstance(rs_i, np.random.Generator):
+            rs_i.standard_normal(size=size[1:], dtype=dtype, out=steps[i])
+            steps[i] *= sigma[i].astype(dtype)
+        else:
+            steps[i] = rs_i.normal(loc=0, scale=sigma[i], size=size[1:])
+    return steps
+
+
+def cumsum_anchored(steps, start_pos, anchor_size=2**12):
+    """In-place cumulative sum of `steps` (last axis) starting at `start_pos`.
+
+    Used for float32 `steps`. The cumulative sum is computed in float32 in
+    segments of `anchor_size` steps, relative to the segment start (the
+    anchor). The anchor is accumulated in float64 and added to each segment
+    with a single rounding to float32. Therefore the rounding error of the
+    positions does not grow with the number of steps: it is bounded by one
+    float32 rounding of the position (relative error 6e-8, i.e. < 0.5 pm
+    in a 10 um box) plus the float32 error of a sum of `anchor_size` steps
+    (about `anchor_size * 6e-8 * sigma * sqrt(anchor_size)`).
 
+    Compared to the float64 path (with the same float64-drawn steps), the
+    positions, after applying the boundary conditions in float32, differ
+    by a few float32 roundings (less than 2e-12 m in a 10 um box) and the
+    emission (normalized to 1 at the PSF peak) by less than 1e-5. The
+    float32 emission arrays stored on disk have a similar precision.
+
+    Arguments:
+        steps (array): float32 array of steps, shape (particles, 3, time).
+            Modified in-place to contain the positions.
+        start_pos (array): start positions, shape (particles, 3, 1).
+        anchor_size (int): number of steps in each segment.
+
+    Returns:
+        The float64 (non-rounded) end positions, shape (particles, 3, 1).
+    """
+    anchor = np.array(start_pos, dtype=np.float64)
+    for i_start, i_end in iter_chunk_index(steps.shape[-1], anchor_size):
+        segment = steps[..., i_start:i_end]
+        np.cumsum(segment, axis=-1, out=segment)
+        increment = segment[..., -1:].astype(np.float64)
+        segment += anchor
+        anchor += increment
+    return anchor
+
+
+def eval_emission(psf, R2, Z, psf_support=None):
+    """Evaluate the emission (squared PSF) culling samples outside a support.
+
+    Arguments:
+        psf (GaussianPSF or NumericPSF): the PSF object.
+        R2, Z (arrays): squared radial position and z position (meters).
+        psf_support (tuple or None): (r_max, z_max) in meters. Samples with
+            r > r_max or |z| > z_max (i.e. outside a cylinder centered on
+            the PSF origin) have zero emission and the PSF is not evaluated
+            for them. If None, evaluate the PSF on all the samples.
+
+    For a `NumericPSF` with `table=True`, a support containing the PSF
+    table (r_max >= 4 um and z_max >= 6 um for the default PSF) gives the
+    same results as no culling, since the emission is already zero outside
+    the table.
+
+    Returns:
+        A tuple (em, num_culled) with the emission array (same shape of
+        `R2`) and the number of culled samples.
+    """
+    if psf_support is None:
+        return psf.eval_r2z_squared(R2, Z), 0
+    r_max, z_max = psf_support
+    inside = (R2 <= r_max**2) & (np.abs(Z) <= z_max)
+    num_inside = np.count_nonzero(inside)
+    if num_inside == inside.size:
+        return psf.eval_r2z_squared(R2, Z), 0
+    em = np.zeros(inside.shape, dtype=np.float64)
+    if num_inside > 0:
+        em[inside] = psf.eval_r2z_squared(R2[inside], Z[inside])
+    return em, inside.size - num_inside
+
+
+def bridge_hit_prob(a, b, var, half_width, period):
+    """Upper bound of the probability that a Brownian bridge enters a slab.
+
+    The slab is the interval [-half_width, half_width] repeated with
+    `period` (i.e. its images through periodic boundary conditions).
+    The bound is computed for the continuous Brownian bridge, so it also
+    bounds the probability for the samples of a discrete random walk
+    bridge. All the arguments are broadcasted.
+
+    Arguments:
+        a, b (arrays): start and end position of the bridge (unwrapped).
+        var (array): variance of the bridge end-point, i.e. 2 * D * time.
+        half_width (float): half width of the slab.
+        period (float): the period of the slab images (box size).
 
-def wrap_mirror(a, a1, a2):
-    """Folds all the values of `a` outside [a1..a2] inside that interval.
-    This function is used to apply mirror-like boundary conditions.
+    Returns:
+        Array of probabilities, equal to 1 when `a` or `b` are not in the
+        same gap between two slab images.
     """
-    a[a > a2] = a2 - (a[a > a2] - a2)
-    a[a < a1] = a1 + (a1 - a[a < a1])
-    return a
+    gap = period - 2 * half_width
+    lower = a - np.mod(a - half_width, period)  # upper edge of slab below
+    upper = lower + gap
+    d_lo_a, d_lo_b = a - lower, b - lower
+    d_up_a, d_up_b = upper - a, upper - b
+    outside_gap = ((d_lo_a <= 0) | (d_lo_b <= 0) | (d_up_a <= 0) |
+                   (d_up_b <= 0))
+    with np.errstate(over='ignore'):
+        prob = (np.exp(-2 * d_lo_a * d_lo_b / var) +
+                np.exp(-2 * d_up_a * d_up_b / var))
+    prob = np.where(outside_gap, 1., np.minimum(prob, 1.))
+    return prob
 
 
 class NoMatchError(Exception):
@@ -245,20 +430,24 @@ class ParticlesSimulation(object):
         store = TrajectoryStore(file_traj, mode='r')
 
         psf_pytables = store.h5file.get_node('/psf/default_psf')
-        psf = NumericPSF(psf_pytables=psf_pytables)
+        psf = psf_from_hdf5(psf_pytables)
         box = store.h5file.get_node_attr('/parameters', 'box')
-        P = store.h5file.get_node_attr('/parameters', 'particles')
+        P = store.get_particles()
+        if P is not None:
+            P = Particles.from_array(P)
+        else:
+            P = Particles.from_json(
+                store.h5file.get_node_attr('/parameters', 'particles'))
 
         names = ['t_step', 't_max', 'EID', 'ID']
         kwargs = {name: store.numeric_params[name] for name in names}
-        S = ParticlesSimulation(particles=Particles.from_json(P), box=box,
-                                psf=psf, **kwargs)
+        S = ParticlesSimulation(particles=P, box=box, psf=psf, **kwargs)
 
         # Emulate S.open_store_traj()
         S.store = store
         S.psf_pytables = psf_pytables
         S.traj_group = S.store.h5file.root.trajectories
-        S.emission = S.traj_group.emission
+        S.emission = S.store.get_emission()
         S.emission_tot = S.traj_group.emission_tot
         if 'position' in S.traj_group:
             S.position = S.traj_group.position
@@ -284,16 +473,17 @@ class ParticlesSimulation(object):
         """Return a RandomState, equal to the input unless rs is None.
 
         When rs is None, try to get the random state from the
-        'last_random_state' attribute in `group`. When not available,
-        use `seed` to generate a random state. When seed is None the returned
-        random state will have a random seed.
+        'last_random_state' attribute in `group` (the returned object is
+        a `Generator` if the saved state comes from a `Generator`).
+        When not available, use `seed` to generate a random state. When seed
+        is None the returned random state will have a random seed.
         """
         if rs is None:
             rs = np.random.RandomState(seed=seed)
             # Try to set the random state from the last session to preserve
             # a single random stream when simulating timestamps multiple times
             if 'last_random_state' in group._v_attrs:
-                rs.set_state(group._v_attrs['last_random_state'])
+                rs = rng.from_state(rng.load_state(group, 'last_random_state'))
                 print("INFO: Random state set to last saved state in '%s'." %
                       group._v_name)
             else:
@@ -326,6 +516,8 @@ class ParticlesSimulation(object):
         self.ID = ID
         self.EID = EID
         self.n_samples = int(t_max / t_step)
+        # Number of samples skipped by the PSF support culling
+        self.culled_samples = 0
 
     @property
     def diffusion_coeff(self):
@@ -335,9 +527,29 @@ class ParticlesSimulation(object):
     def num_particles(self):
         return len(self.particles)
 
+    @property
+    def emission_culled(self):
+        """True if the emission is zero outside a bounded PSF support.
+
+        By default, True when the stored trajectories were simulated with
+        a `psf_support` or the emission is stored in the sparse (CSR)
+        format. It can be set explicitly, e.g. for the emission simulated
+        in memory by :func:`pipeline.diffusion_chunks` with `psf_support`.
+        """
+        if hasattr(self, '_emission_culled'):
+            return self._emission_culled
+        if isinstance(getattr(self, 'emission', None), SparseEmissionArray):
+            return True
+        return (hasattr(self, 'traj_group') and
+                'psf_support' in self.traj_group._v_attrs)
+
+    @emission_culled.setter
+    def emission_culled(self, value):
+        self._emission_culled = bool(value)
+
     @property
     def sigma_1d(self):
-        return [np.sqrt(2 * par.D * self.t_step) for par in self.particles]
+        return np.sqrt(2 * self.diffusion_coeff * self.t_step)
 
     def __repr__(self):
         pM = self.concentration(pM=True)
@@ -431,6 +643,10 @@ class ParticlesSimulation(object):
                 All the previously stored data in that file will be lost.
         """[1:]
 
+    def _store_fname(self, prefix):
+        """Return the file name of the store with given `prefix`."""
+        return '%s_%s.hdf5' % (prefix, self.compact_name())
+
     def _open_store(self, store, prefix='', path='./', chunksize=2**19,
                     chunkslice='bytes', mode='w'):
         """Open and setup the on-disk storage file (pytables HDF5 file).
@@ -446,19 +662,34 @@ class ParticlesSimulation(object):
         nparams = self.numeric_params
         self.chunksize = chunksize
         nparams.update(chunksize=(chunksize, 'Chunksize for arrays'))
-        store_fname = '%s_%s.hdf5' % (prefix, self.compact_name())
-        attr_params = dict(particles=self.particles.to_json(), box=self.box)
+        store_fname = self._store_fname(prefix)
+        attr_params = dict(box=self.box)
+        # HDF5 attributes are limited to 64 KB (about 700 particles in JSON)
+        if self.num_particles <= 500:
+            attr_params.update(particles=self.particles.to_json())
         kwargs = dict(path=path, nparams=nparams, attr_params=attr_params,
                       mode=mode)
         store = store(store_fname, **kwargs)
+        if mode == 'w':
+            store.add_particles(self.particles.to_array())
         return store
 
     def open_store_traj(self, path='./', chunksize=2**19, chunkslice='bytes',
-                        mode='w', radial=False):
+                        mode='w', radial=False, emission_format='dense',
+                        sparse_threshold=0.):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
         Arguments:
-        """ + self.__DOCS_STORE_ARGS___
+        """ + self.__DOCS_STORE_ARGS___ + """
+            emission_format ('dense' or 'sparse'): layout of the per-particle
+                emission array (see :class:`storage.SparseEmissionArray`).
+            sparse_threshold (float): with the 'sparse' format, only
+                emission values above this threshold are stored.
+
+        With `mode='a'` an existing file is opened and the arrays are
+        loaded from the file (`chunksize`, `chunkslice`, `radial`,
+        `emission_format` and `sparse_threshold` are ignored).
+        """
         if hasattr(self, 'store'):
             return
         self.store = self._open_store(TrajectoryStore,
@@ -467,6 +698,18 @@ class ParticlesSimulation(object):
                                       chunksize=chunksize,
                                       chunkslice=chunkslice,
                                       mode=mode)
+        if mode == 'a':
+            h5file = self.store.h5file
+            self.chunksize = self.store.numeric_params['chunksize']
+            self.psf_pytables = h5file.get_node('/psf/default_psf')
+            self.traj_group = h5file.root.trajectories
+            self.emission_tot = self.traj_group.emission_tot
+            self.emission = self.store.get_emission()
+            if 'position_rz' in self.traj_group:
+                self.position = self.traj_group.position_rz
+            else:
+                self.position = self.traj_group.position
+            return
 
         self.psf_pytables = self.psf.to_hdf5(self.store.h5file, '/psf')
         self.store.h5file.create_hard_link('/psf', 'default_psf',
@@ -477,7 +720,14 @@ class ParticlesSimulation(object):
 
         kwargs = dict(chunksize=self.chunksize, chunkslice=chunkslice)
         self.emission_tot = self.store.add_emission_tot(**kwargs)
-        self.emission = self.store.add_emission(**kwargs)
+        if emission_format == 'dense':
+            self.emission = self.store.add_emission(**kwargs)
+        elif emission_format == 'sparse':
+            self.emission = self.store.add_emission_sparse(
+                threshold=sparse_threshold, **kwargs)
+        else:
+            raise ValueError("Unknown emission_format '%s'. Valid formats "
+                             "are 'dense' and 'sparse'." % emission_format)
         self.position = self.store.add_position(radial=radial, **kwargs)
 
     def open_store_timestamp(self, path=None, chunksize=2**19,
@@ -500,7 +750,7 @@ class ParticlesSimulation(object):
 
     def _sim_trajectories(self, time_size, start_pos, rs,
                           total_emission=False, save_pos=False, radial=False,
-                          wrap_func=wrap_periodic):
+                          wrap_func=wrap_periodic, psf_support=None):
         """Simulate (in-memory) `time_size` steps of trajectories.
 
         Simulate Brownian motion diffusion and emission of all the particles.
@@ -511,13 +761,21 @@ class ParticlesSimulation(object):
             start_pos (array): shape (num_particles, 3), particles start
                 positions. This array is modified to store the end position
                 after this method is called.
-            rs (RandomState): a `numpy.random.RandomState` object used
-                to generate the random numbers.
+            rs (RandomState, Generator or StreamSet): object used
+                to generate the random numbers. With a :class:`rng.StreamSet`
+                each particle uses its own random stream.
             total_emission (bool): if True, store only the total emission array
                 containing the sum of emission of all the particles.
             save_pos (bool): if True, save the particles 3D trajectories
-            wrap_func (function): the function used to apply the boundary
-                condition (use :func:`wrap_periodic` or :func:`wrap_mirror`).
+            wrap_func (function or BoundaryCondition): the boundary
+                conditions, applied in-place to all the coordinates at once
+                (see :func:`boundary.get_boundary`). Use
+                :func:`wrap_periodic`, :func:`wrap_mirror` or an object
+                from :mod:`pybromo.boundary`.
+            psf_support (tuple or None): (r_max, z_max) in meters. Emission
+                of samples outside this support is zero and the PSF is not
+                evaluated (see :func:`eval_emission`). The number of culled
+                samples is added to `self.culled_samples`.
 
         Returns:
             POS (list): list of 3D trajectories arrays (3 x time_size)
@@ -530,24 +788,25 @@ class ParticlesSimulation(object):
         else:
             em = np.zeros((num_particles, time_size), dtype=np.float32)
 
+        boundary = get_boundary(wrap_func)
         POS = []
-        # pos_w = np.zeros((3, c_size))
         for i, sigma_1d in enumerate(self.sigma_1d):
-            delta_pos = rs.normal(loc=0, scale=sigma_1d,
-                                  size=3 * time_size)
+            rs_i = rs[i] if isinstance(rs, rng.StreamSet) else rs
+            delta_pos = rs_i.normal(loc=0, scale=sigma_1d,
+                                    size=3 * time_size)
             delta_pos = delta_pos.reshape(3, time_size)
             pos = np.cumsum(delta_pos, axis=-1, out=delta_pos)
             pos += start_pos[i]
 
             # Coordinates wrapping using the specified boundary conditions
-            for coord in (0, 1, 2):
-                pos[coord] = wrap_func(pos[coord], *self.box.b[coord])
+            boundary(pos, self.box.b)
 
             # Sample the PSF along i-th trajectory then square to account
             # for emission and detection PSF.
-            Ro = sqrt(pos[0]**2 + pos[1]**2)  # radial pos. on x-y plane
+            R2 = pos[0]**2 + pos[1]**2  # squared radial pos. on x-y plane
             Z = pos[2]
-            current_em = self.psf.eval_xz(Ro, Z)**2
+            current_em, culled = eval_emission(self.psf, R2, Z, psf_support)
+            self.culled_samples += culled
             if total_emission:
                 # Add the current particle emission to the total emission
                 em += current_em.astype(np.float32)
@@ -555,16 +814,379 @@ class ParticlesSimulation(object):
                 # Store the individual emission of current particle
                 em[i] = current_em.astype(np.float32)
             if save_pos:
-                pos_save = np.vstack((Ro, Z)) if radial else pos
+                pos_save = np.vstack((sqrt(R2), Z)) if radial else pos
                 POS.append(pos_save[np.newaxis, :, :])
             # Update start_pos in-place for current particle
             start_pos[i] = pos[:, -1:]
         return POS, em
 
+    def _sim_trajectories_batch(self, time_size, start_pos, rs,
+                                total_emission=False, save_pos=False,
+                                radial=False, wrap_func=wrap_periodic,
+                                block_size=None, dtype='float64',
+                                anchor_size=2**12, psf_support=None):
+        """Simulate (in-memory) `time_size` steps of trajectories in batches.
+
+        Same as :meth:`_sim_trajectories` but, instead of looping over
+        the particles, all the particles in a block of `block_size` are
+        advanced with a single (block_size, 3, time_size) array operation.
+        The random numbers are drawn in the same order as in
+        :meth:`_sim_trajectories`, therefore, with the default `dtype`,
+        the results are identical (bit-by-bit) for any `block_size`.
+
+        Arguments:
+            block_size (int or None): max number of particles simulated
+                in a single array operation. If None, simulate all the
+                particles at once. Peak memory is roughly
+                `block_size * time_size * 32` bytes (half with float32).
+            dtype (string or numpy dtype): 'float64' (default) or
+                'float32'. The latter computes steps, positions and PSF
+                arguments in float32 (see :func:`cumsum_anchored` for
+                the accuracy).
+            anchor_size (int): for float32 computations, the number of
+                steps summed in float32 before re-anchoring the cumulative
+                sum to a float64 position (see :func:`cumsum_anchored`).
+
+        See :meth:`_sim_trajectories` for the other arguments and the
+        returned values. Here, `POS` is a list of arrays with shape
+        (block_size, 3, time_size), one element per block.
+        """
+        time_size = int(time_size)
+        dtype = np.dtype(dtype)
+        num_particles = self.num_particles
+        if block_size is None:
+            block_size = num_particles
+        block_size = max(1, int(block_size))
+        if total_emission:
+            em = np.zeros(time_size, dtype=np.float32)
+        else:
+            em = np.zeros((num_particles, time_size), dtype=np.float32)
+
+        boundary = get_boundary(wrap_func)
+        sigma_1d = np.array(self.sigma_1d)
+        POS = []
+        for i_start, i_end in iter_chunk_index(num_particles, block_size):
+            sigma = sigma_1d[i_start:i_end].reshape(-1, 1, 1)
+            size = (i_end - i_start, 3, time_size)
+            rs_block = rs[i_start:i_end] if isinstance(rs, rng.StreamSet) \
+                else rs
+            pos = draw_steps(rs_block, sigma, size, dtype=dtype)
+            if dtype == np.float64:
+                np.cumsum(pos, axis=-1, out=pos)
+                pos += start_pos[i_start:i_end]
+                end_pos = pos[:, :, -1:]
+            else:
+                end_pos = cumsum_anchored(pos, start_pos[i_start:i_end],
+                                          anchor_size=anchor_size)
+
+            # Coordinates wrapping using the specified boundary conditions
+            boundary(pos, self.box.b)
+            if dtype != np.float64:
+                # Wrap the full-precision end position too
+                boundary(end_pos, self.box.b)
+
+            # Sample the PSF along the trajectories then square to account
+            # for emission and detection PSF.
+            R2 = pos[:, 0]**2 + pos[:, 1]**2  # squared radial pos.
+            Z = pos[:, 2]
+            current_em, culled = eval_emission(self.psf, R2, Z, psf_support)
+            self.culled_samples += culled
+            if total_emission:
+                # Accumulate one particle at a time to preserve the
+                # float32 summation order of the per-particle loop
+                for current_em_i in current_em.astype(np.float32):
+                    em += current_em_i
+            else:
+                em[i_start:i_end] = current_em
+            if save_pos:
+                pos_save = np.stack((sqrt(R2), Z), axis=1) if radial else pos
+                POS.append(pos_save)
+            # Update start_pos in-place for current particles
+            start_pos[i_start:i_end] = end_pos
+        return POS, em
+
+    def _sim_trajectories_fused(self, time_size, start_pos, rs,
+                                total_emission=False, save_pos=False,
+                                radial=False, wrap_func=wrap_periodic,
+                                use_numba=None, psf_support=None):
+        """Simulate (in-memory) `time_size` steps of trajectories (fused).
+
+        Same as :meth:`_sim_trajectories` but, for each particle, the
+        positions, the boundary conditions and the emission are computed
+        in a single pass by a fused kernel (see :mod:`pybromo.kernels`),
+        writing float32 emission (and positions) directly in the output
+        arrays. Only the array of random steps is allocated.
+        The random numbers are drawn in the same order as in
+        :meth:`_sim_trajectories` and the results are equal up to
+        floating point rounding.
+
+        Requires a `NumericPSF` with `table=True` (so that all the engines
+        compute the same emission for a given PSF hash) and periodic or
+        mirror boundary conditions (see :mod:`pybromo.boundary`).
+
+        Arguments:
+            use_numba (bool or None): if True use the numba-compiled kernel,
+                if False use the numpy kernel. If None, use numba when
+                installed.
+
+        See :meth:`_sim_trajectories` for the other arguments and the
+        returned values.
+        """
+        kernel = kernels.fused_kernel(use_numba)
+        boundary = get_boundary(wrap_func)
+        if boundary.kernel_id is None:
+            raise ValueError("The 'fused' engine supports only periodic "
+                             "and mirror boundary conditions.")
+        if not isinstance(self.psf, NumericPSF):
+            raise TypeError("The 'fused' engine requires a NumericPSF.")
+        if not self.psf.table:
+            raise ValueError("The 'fused' engine requires a NumericPSF "
+                             "with table=True.")
+        table, u0, u_step, z0, z_step, r2_index = self.psf.em_table()
+        r_max, z_max = (np.inf, np.inf) if psf_support is None \
+            else psf_support
+        psf_args = (u0, u_step, z0, z_step, table, r2_index, r_max**2, z_max)
+        bounds = np.asarray(self.box.b, dtype=np.float64)
+
+        time_size = int(time_size)
+        num_particles = self.num_particles
+        if total_emission:
+            em = np.zeros(time_size, dtype=np.float32)
+        else:
+            em = np.zeros((num_particles, time_size), dtype=np.float32)
+        pos = np.zeros((1, 1), dtype=np.float32)   # dummy when not saved
+
+        POS = []
+        for i, sigma_1d in enumerate(self.sigma_1d):
+            rs_i = rs[i] if isinstance(rs, rng.StreamSet) else rs
+            delta_pos = rs_i.normal(loc=0, scale=sigma_1d,
+                                    size=3 * time_size)
+            delta_pos = delta_pos.reshape(3, time_size)
+            if save_pos:
+                pos = np.zeros((2 if radial else 3, time_size),
+                               dtype=np.float32)
+            start = start_pos[i, :, 0].copy()
+            em_i = em if total_emission else em[i]
+            self.culled_samples += kernel(
+                delta_pos, start, bounds, boundary.kernel_id, *psf_args,
+                em_i, total_emission, pos, save_pos, radial)
+            # Update start_pos in-place for current particle
+            start_pos[i, :, 0] = start
+            if save_pos:
+                POS.append(pos[np.newaxis, :, :])
+        return POS, em
+
+    def _sim_trajectories_adaptive(self, time_size, start_pos, rs,
+                                   total_emission=False, save_pos=False,
+                                   radial=False, wrap_func=wrap_periodic,
+                                   psf_support=None, jump_size=2**10,
+                                   tol=1e-12):
+        """Simulate (in-memory) `time_size` steps with far-field jumps.
+
+        For each particle, the time is split in blocks of `jump_size` steps.
+        The position at the end of each block is drawn directly (the sum of
+        `jump_size` Gaussian steps is Gaussian with variance
+        `2 * D * jump_size * t_step`). Then, for each block, the probability
+        that the trajectory enters the PSF support is bounded with
+        :func:`bridge_hit_prob`. Blocks where this bound is below `tol`
+        (i.e. particles far from the PSF) are skipped: their emission is
+        zero and they are counted as culled samples. The other blocks are
+        filled at full resolution with a discrete Brownian bridge between
+        the block end-points, which has the exact distribution of the
+        random walk conditioned on the end-points.
+
+        The emission has the same distribution of the other engines, except
+        for events with probability less than `tol` per skipped block.
+        The random numbers are drawn in a different order, therefore the
+        results are not equal to the other engines for the same `rs`.
+
+        Requires `psf_support` and periodic boundary conditions.
+        The positions cannot be saved.
+
+        Arguments:
+            jump_size (int): number of time steps in each block.
+            tol (float): max probability (per block) of skipping a block
+                where the particle enters the PSF support.
+
+        See :meth:`_sim_trajectories` for the other arguments and the
+        returned values (`POS` is always an empty list).
+        """
+        if psf_support is None:
+            raise ValueError("The 'adaptive' engine requires psf_support.")
+        boundary = get_boundary(wrap_func)
+        if not isinstance(boundary, PeriodicBoundary):
+            raise ValueError("The 'adaptive' engine supports only "
+                             "periodic boundary conditions.")
+        if save_pos:
+            raise ValueError("The 'adaptive' engine cannot save positions.")
+        r_max, z_max = psf_support
+        half_widths = (r_max, r_max, z_max)
+        periods = self.box.b[:, 1] - self.box.b[:, 0]
+
+        time_size = int(time_size)
+        jump_size = max(1, min(int(jump_size), time_size))
+        num_particles = self.num_particles
+        if total_emission:
+            em = np.zeros(time_size, dtype=np.float32)
+        else:
+            em = np.zeros((num_particles, time_size), dtype=np.float32)
+
+        num_full, tail = divmod(time_size, jump_size)
+        lengths = np.full(num_full + (tail > 0), jump_size)
+        if tail > 0:
+            lengths[-1] = tail
+        for i, sigma_1d in enumerate(self.sigma_1d):
+            rs_i = rs[i] if isinstance(rs, rng.StreamSet) else rs
+            # End-points of the blocks (unwrapped coordinates)
+            jumps = rs_i.normal(size=(3, lengths.size))
+            jumps *= sigma_1d * np.sqrt(lengths)
+            ends = np.cumsum(jumps, axis=-1) + start_pos[i]
+            begins = np.hstack([start_pos[i], ends[:, :-1]])
+
+            # Find the blocks where the particle may enter the PSF support
+            var = sigma_1d**2 * lengths
+            hit_prob = np.ones(lengths.size)
+            for coord in (0, 1, 2):
+                hit_prob = np.minimum(hit_prob, bridge_hit_prob(
+                    begins[coord], ends[coord], var, half_widths[coord],
+                    periods[coord]))
+            refine = hit_prob >= tol
+            self.culled_samples += lengths[~refine].sum()
+
+            # Fill the blocks near the PSF with a discrete Brownian bridge
+            em_i = np.zeros(time_size, dtype=np.float32) if total_emission \
+                else em[i]
+            for block_len in np.unique(lengths[refine]):
+                idx = np.nonzero(refine & (lengths == block_len))[0]
+                steps = rs_i.normal(loc=0, scale=sigma_1d,
+                                    size=(idx.size, 3, block_len))
+                pos = np.cumsum(steps, axis=-1, out=steps)
+                delta = (ends[:, idx] - begins[:, idx]).T[:, :, np.newaxis]
+                frac = np.arange(1, block_len + 1) / block_len
+                pos -= frac * (pos[:, :, -1:] - delta)
+                pos += begins[:, idx].T[:, :, np.newaxis]
+                boundary(pos, self.box.b)
+                R2 = pos[:, 0]**2 + pos[:, 1]**2
+                current_em, culled = eval_emission(self.psf, R2, pos[:, 2],
+                                                   psf_support)
+                self.culled_samples += culled
+                if block_len == jump_size:
+                    em_blocks = em_i[:num_full * jump_size]
+                    em_blocks.reshape(num_full, jump_size)[idx] = current_em
+                else:
+                    em_i[num_full * jump_size:] = current_em[0]
+            if total_emission:
+                em += em_i
+            # Update start_pos in-place for current particle
+            start_pos[i] = boundary(ends[:, -1:].copy(), self.box.b)
+        return [], em
+
+    def _get_sim_trajectories(self, engine='loop', block_size=None,
+                              dtype='float64', psf_support=None,
+                              jump_size=2**10):
+        """Return the function simulating a trajectory chunk for `engine`.
+
+        Arguments:
+            engine (string): 'loop' to simulate one particle at a time
+                (:meth:`_sim_trajectories`), 'batch' to simulate blocks of
+                particles at once (:meth:`_sim_trajectories_batch`) or
+                'fused' to use a single-pass kernel for each particle
+                (:meth:`_sim_trajectories_fused`) or 'adaptive' to skip
+                the time blocks far from the PSF support
+                (:meth:`_sim_trajectories_adaptive`).
+            block_size (int or None): number of particles per block
+                for the 'batch' engine. Ignored by the other engines.
+            dtype (string): 'float64' or 'float32' (only 'batch' engine).
+            psf_support (tuple or None): (r_max, z_max) support of the PSF
+                used to cull the emission evaluation (all the engines).
+            jump_size (int): number of time steps of each block of the
+                'adaptive' engine. Ignored by the other engines.
+        """
+        if engine != 'batch' and np.dtype(dtype) != np.float64:
+            raise ValueError("Only the 'batch' engine supports float32.")
+        if engine == 'loop':
+            return partial(self._sim_trajectories, psf_support=psf_support)
+        elif engine == 'batch':
+            return partial(self._sim_trajectories_batch, block_size=block_size,
+                           dtype=dtype, psf_support=psf_support)
+        elif engine == 'fused':
+            return partial(self._sim_trajectories_fused,
+                           psf_support=psf_support)
+        elif engine == 'adaptive':
+            return partial(self._sim_trajectories_adaptive,
+                           psf_support=psf_support, jump_size=jump_size)
+        else:
+            raise ValueError("Unknown engine '%s'. Valid engines are "
+                             "'loop', 'batch', 'fused' and 'adaptive'." %
+                             engine)
+
+    def memory_budget(self, max_memory, stage='diffusion', engine='loop',
+                      dtype='float64', block_size=None, queue_depth=0,
+                      total_emission=False, save_pos=False, radial=False,
+                      **kwargs):
+        """Return the chunk sizes for a memory budget of `max_memory` bytes.
+
+        The peak memory of a chunk grows with `num_particles` times the
+        number of time steps. This method estimates the bytes per particle
+        and time step of each stage and returns a
+        :class:`iter_chunks.MemoryBudget` whose attributes `t_chunksize`,
+        `block_size` and `queue_depth` are the planned sizes.
+
+        Arguments:
+            max_memory (int): memory budget in bytes.
+            stage (string): 'diffusion' (:meth:`simulate_diffusion`),
+                'timestamps' (photons from the stored emission, see
+                :meth:`simulate_timestamps_mix_da`) or 'online'
+                (:meth:`simulate_timestamps_mix_da_online`).
+            engine, dtype (string): the diffusion engine and its dtype.
+                Only the 'batch' engine simulates more than one particle
+                at once (see :meth:`simulate_diffusion`).
+            block_size (int or None): maximum number of particles simulated
+                at once by the 'batch' engine. If None, all the particles.
+            queue_depth (int): maximum number of chunks queued by the
+                background writer ('diffusion' stage) or reader
+                ('timestamps' stage).
+            total_emission, save_pos, radial (bool): see
+                :meth:`simulate_diffusion`.
+            kwargs: passed to :class:`iter_chunks.MemoryBudget` (e.g.
+                `min_chunksize`, `max_chunksize` or `memory_fraction`).
+        """
+        itemsize = np.dtype(dtype).itemsize
+        # Steps, positions and R2 (dtype), emission (float64 and float32)
+        block_bytes = 4 * itemsize + 12
+        if engine != 'batch':
+            block_size = 1
+        if stage == 'diffusion':
+            sample_bytes = 0 if total_emission else _EMISSION_BYTES
+            if save_pos:
+                sample_bytes += (2 if radial else 3) * itemsize
+            queue_bytes = sample_bytes
+        elif stage == 'timestamps':
+            sample_bytes = _EMISSION_BYTES + _PHOTON_BYTES
+            block_bytes, block_size = 0, None
+            queue_bytes = _EMISSION_BYTES
+        elif stage == 'online':
+            sample_bytes = _EMISSION_BYTES + _PHOTON_BYTES
+            queue_bytes = 0
+        else:
+            raise ValueError("Unknown stage '%s'. Valid stages are "
+                             "'diffusion', 'timestamps' and 'online'." %
+                             stage)
+        return MemoryBudget(max_memory, self.num_particles, sample_bytes,
+                            block_bytes=block_bytes, queue_bytes=queue_bytes,
+                            queue_depth=queue_depth, block_size=block_size,
+                            **kwargs)
+
     def simulate_diffusion(self, save_pos=False, total_emission=True,
                            radial=False, rs=None, seed=1, path='./',
                            wrap_func=wrap_periodic,
-                           chunksize=2**19, chunkslice='times', verbose=True):
+                           chunksize=2**19, chunkslice='times', verbose=True,
+                           engine='loop', block_size=None, dtype='float64',
+                           num_processes=None, psf_support=None,
+                           emission_format='dense', sparse_threshold=0.,
+                           jump_size=2**10, checkpoint_every=None,
+                           resume=False, writer_queue_size=0,
+                           max_memory=None):
         """Simulate Brownian motion trajectories and emission rates.
 
         This method performs the Brownian motion simulation using the current
@@ -579,59 +1201,297 @@ class ParticlesSimulation(object):
             save_pos (bool): if True, save the particles 3D trajectories
             total_emission (bool): if True, store only the total emission array
                 containing the sum of emission of all the particles.
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState, Generator or StreamSet): random number
+                generator. If None, use a RandomState initialized from seed.
+                A :class:`rng.StreamSet` provides an independent stream
+                for each particle.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state, otherwise is ignored.
-            wrap_func (function): the function used to apply the boundary
-                condition (use :func:`wrap_periodic` or :func:`wrap_mirror`).
+            wrap_func (function or BoundaryCondition): the boundary
+                conditions (use :func:`wrap_periodic`, :func:`wrap_mirror`
+                or an object from :mod:`pybromo.boundary`).
             path (string): a folder where simulation data is saved.
             verbose (bool): if False, prints no output.
+            engine (string): 'loop' (default) simulates one particle at a
+                time, 'batch' simulates blocks of particles with a single
+                array operation. Both engines give identical results.
+                'fused' uses a single-pass kernel for each particle,
+                JIT-compiled when numba is installed (results equal up to
+                floating point rounding, requires a `NumericPSF` with
+                `table=True`). 'adaptive' draws directly the
+                position after `jump_size` steps and fills at full
+                resolution only the time blocks where the particle may
+                enter the PSF support (requires `psf_support`, see
+                :meth:`_sim_trajectories_adaptive`). The emission has the
+                same distribution of the other engines.
+            block_size (int or None): number of particles simulated at once
+                by the 'batch' engine. If None, simulate all the particles
+                at once. Ignored by the 'loop' engine.
+            dtype (string): 'float64' (default) or 'float32'. The latter
+                selects the float32 computation of the 'batch' engine,
+                which halves the memory of each chunk. Positions differ
+                from the float64 computation by less than 2e-12 m and the
+                emission by less than 1e-5 (see :func:`cumsum_anchored`).
+            num_processes (int or None): if not None, split the particles
+                in `num_processes` shards simulated in parallel by a pool
+                of processes. See :class:`ShardedTrajectories` for how the
+                random streams of each shard are derived from `rs`.
+            psf_support (tuple or None): (r_max, z_max) in meters. If not
+                None, the PSF is evaluated only for samples with r <= r_max
+                and |z| <= z_max, the emission of the other samples is
+                zero. The number of culled samples is saved in the
+                'culled_samples' attribute of `/trajectories`.
+            emission_format ('dense' or 'sparse'): on-disk layout of the
+                per-particle emission. The 'sparse' format stores only the
+                samples with emission > `sparse_threshold` (see
+                :class:`storage.SparseEmissionArray`). In both cases
+                `self.emission[:, i_start:i_end]` returns a dense array.
+            sparse_threshold (float): threshold for the 'sparse' format.
+                With 0 (default) the sparse format is lossless.
+            jump_size (int): number of time steps in each block of the
+                'adaptive' engine.
+            checkpoint_every (int or None): if not None, save a checkpoint
+                every `checkpoint_every` chunks (see :meth:`_save_checkpoint`).
+                A checkpoint is always saved at the end of the simulation.
+            resume (bool): if True and the trajectory file already exists,
+                resume the simulation from the last checkpoint saved in the
+                file. Data written after the checkpoint is discarded and the
+                random state is restored from the checkpoint (when `rs` is
+                not None its state is overwritten), so the results are
+                identical to an uninterrupted simulation. The other
+                arguments must be the same of the interrupted simulation.
+                If the file does not exist, start a new simulation.
+            writer_queue_size (int): if > 0, the chunks are compressed and
+                written to disk by a background thread while the next
+                chunk is simulated, with at most `writer_queue_size`
+                chunks waiting to be written (see
+                :class:`pipeline.ThreadedSink`). If 0 (default), write
+                each chunk before simulating the next one.
+            max_memory (int or None): if not None, memory budget in bytes
+                for the chunks in memory. The number of time steps of each
+                chunk (instead of the on-disk chunk size), `block_size`
+                and `writer_queue_size` (both used as upper bounds) are
+                derived from the budget and the chunks are shortened when
+                the memory available drops (see :meth:`memory_budget`).
         """
-        if rs is None:
-            rs = np.random.RandomState(seed=seed)
+        if num_processes is not None and (checkpoint_every or resume):
+            raise ValueError('Checkpoints are not supported with '
+                             'num_processes.')
+        mode = 'w'
+        if resume and Path(path, self._store_fname(self._PREFIX_TRAJ)).exists():
+            mode = 'a'
         self.open_store_traj(chunksize=chunksize, chunkslice=chunkslice,
-                             radial=radial, path=path)
-        # Save current random state for reproducibility
-        self.traj_group._v_attrs['init_random_state'] = rs.get_state()
-
-        em_store = self.emission_tot if total_emission else self.emission
+                             radial=radial, path=path, mode=mode,
+                             emission_format=emission_format,
+                             sparse_threshold=sparse_threshold)
+        if mode == 'a':
+            num_samples, par_start_pos, rs = self._load_checkpoint(rs)
+        else:
+            if rs is None:
+                rs = np.random.RandomState(seed=seed)
+            # Save current random state for reproducibility
+            rng.save_state(self.traj_group, 'init_random_state', rs)
+            self.culled_samples = 0
+            num_samples = 0
+            par_start_pos = self.particles.positions
+        t_chunksize, budget = self.emission.chunkshape[1], None
+        if max_memory is not None:
+            budget = self.memory_budget(
+                max_memory, 'diffusion', engine=engine, dtype=dtype,
+                block_size=block_size, queue_depth=writer_queue_size,
+                total_emission=total_emission, save_pos=save_pos,
+                radial=radial)
+            t_chunksize = budget.t_chunksize
+            block_size = budget.block_size
+            writer_queue_size = budget.queue_depth
+        if num_processes is None:
+            sim_trajectories = self._get_sim_trajectories(
+                engine, block_size, dtype, psf_support=psf_support,
+                jump_size=jump_size)
+        else:
+            sim_trajectories = ShardedTrajectories(
+                self, num_processes, rs, engine=engine, block_size=block_size,
+                dtype=dtype, psf_support=psf_support, jump_size=jump_size)
+            if sim_trajectories.seeds is not None:
+                self.traj_group._v_attrs['shard_seeds'] = \
+                    sim_trajectories.seeds
 
         print('- Start trajectories simulation - %s' % ctime(), flush=True)
         if verbose:
             print('[PID %d] Diffusion time:' % os.getpid(), end='')
-        i_chunk = 0
-        t_chunk_size = self.emission.chunkshape[1]
-        chunk_duration = t_chunk_size * self.t_step
+        chunks = diffusion_chunks(
+            self, rs, t_chunksize, i_start=num_samples,
+            start_pos=par_start_pos, sim_trajectories=sim_trajectories,
+            total_emission=total_emission, save_pos=save_pos, radial=radial,
+            wrap_func=wrap_func, budget=budget)
+        sink = TrajectorySink(self)
+        if writer_queue_size > 0:
+            sink = ThreadedSink(sink, writer_queue_size)
 
-        par_start_pos = self.particles.positions
         prev_time = 0
-        for time_size in iter_chunksize(self.n_samples, t_chunk_size):
+        try:
+            for i_chunk, chunk in enumerate(chunks, 1):
+                sink.append(chunk)
+                num_samples = chunk['i_end']
+                if verbose:
+                    curr_time = int(num_samples * self.t_step)
+                    if curr_time > prev_time:
+                        print(' %ds' % curr_time, end='', flush=True)
+                        prev_time = curr_time
+                if checkpoint_every and i_chunk % checkpoint_every == 0:
+                    if writer_queue_size > 0:
+                        sink.wait()
+                    self._save_checkpoint(num_samples, par_start_pos, rs)
+            sink.close()
+        finally:
+            if writer_queue_size > 0:
+                sink.join()
+            if num_processes is not None:
+                sim_trajectories.close()
+                self.culled_samples = sim_trajectories.culled_samples
+
+        if psf_support is not None:
+            self.traj_group._v_attrs['psf_support'] = tuple(psf_support)
+            self.traj_group._v_attrs['culled_samples'] = self.culled_samples
             if verbose:
-                curr_time = int(chunk_duration * (i_chunk + 1))
-                if curr_time > prev_time:
-                    print(' %ds' % curr_time, end='', flush=True)
-                    prev_time = curr_time
-
-            POS, em = self._sim_trajectories(time_size, par_start_pos, rs,
-                                             total_emission=total_emission,
-                                             save_pos=save_pos, radial=radial,
-                                             wrap_func=wrap_func)
-
-            ## Append em to the permanent storage
-            # if total_emission, data is just a linear array
-            # otherwise is a 2-D array (self.num_particles, c_size)
-            em_store.append(em)
-            if save_pos:
-                self.position.append(np.vstack(POS).astype('float32'))
-            i_chunk += 1
-            self.store.h5file.flush()
+                total = self.n_samples * self.num_particles
+                print('\n[PID %d] PSF support culling: %d of %d samples '
+                      '(%.1f%%)' % (os.getpid(), self.culled_samples, total,
+                                    100 * self.culled_samples / total),
+                      end='')
 
         # Save current random state
-        self.traj_group._v_attrs['last_random_state'] = rs.get_state()
-        self.store.h5file.flush()
+        rng.save_state(self.traj_group, 'last_random_state', rs)
+        if num_processes is not None and not isinstance(rs, rng.StreamSet):
+            self.traj_group._v_attrs['last_shard_random_states'] = \
+                [rng.state_to_attr(rs_i) for rs_i in sim_trajectories.rs_list]
+        self._save_checkpoint(num_samples, par_start_pos, rs)
         print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
+    def _save_checkpoint(self, num_samples, positions, rs):
+        """Save a checkpoint of the diffusion simulation in `/trajectories`.
+
+        The checkpoint is saved as attributes of `/trajectories`:
+        'checkpoint_positions' (the particles positions after `num_samples`
+        time steps, shape (num_particles, 3, 1)), 'checkpoint_random_state',
+        'checkpoint_culled_samples' and, last, 'checkpoint_samples' (the
+        number of time steps already stored). The data in the arrays must
+        be flushed before calling this method.
+        """
+        attrs = self.traj_group._v_attrs
+        attrs['checkpoint_positions'] = np.array(positions, dtype='float64')
+        rng.save_state(self.traj_group, 'checkpoint_random_state', rs)
+        attrs['checkpoint_culled_samples'] = self.culled_samples
+        attrs['checkpoint_samples'] = num_samples
+        self.store.h5file.flush()
+
+    def _load_checkpoint(self, rs=None):
+        """Restore the last checkpoint saved by :meth:`_save_checkpoint`.
+
+        The stored arrays are truncated to the data saved before the
+        checkpoint. If there is no checkpoint, the arrays are truncated to
+        zero length and the initial positions and random state are used.
+
+        Returns:
+            A tuple (num_samples, positions, rs) with the number of time steps
+            already stored, the particles positions and the random number
+            generator (`rs` with the state set from the checkpoint or, if `rs`
+            is None, a new one).
+        """
+        attrs = self.traj_group._v_attrs
+        if 'checkpoint_samples' in attrs:
+            num_samples = int(attrs['checkpoint_samples'])
+            positions = np.array(attrs['checkpoint_positions'])
+            state = rng.load_state(self.traj_group, 'checkpoint_random_state')
+            self.culled_samples = attrs['checkpoint_culled_samples']
+        else:
+            num_samples = 0
+            positions = self.particles.positions
+            state = rng.load_state(self.traj_group, 'init_random_state')
+            self.culled_samples = 0
+        if rs is None:
+            rs = rng.from_state(state)
+        else:
+            rng.set_state(rs, state)
+
+        for array in (self.emission_tot, self.emission, self.position):
+            if array.shape[-1] > num_samples:
+                array.truncate(num_samples)
+        self.store.h5file.flush()
+        print("INFO: Resuming simulation from time step %d." % num_samples)
+        return num_samples, positions, rs
+
+    def extend(self, t_extra, path=None, verbose=True, **kwargs):
+        """Extend a stored diffusion simulation by `t_extra` seconds.
+
+        The trajectory file is reopened and the simulation continues from
+        the final positions and random state saved in the file (see
+        :meth:`_save_checkpoint`), appending the new time steps to the
+        stored emission and position arrays. `t_max`, the hash and the
+        file name (which contains `t_max`) are updated accordingly.
+        When the stored duration is a multiple of the chunk length the
+        result is identical to a single simulation of the total duration.
+        Timestamps simulated before extending keep the previous file name.
+
+        For files without a checkpoint (saved by older versions), the final
+        positions are taken from the last time step of the stored (float32)
+        `position` array and the random state from 'last_random_state'.
+
+        Arguments:
+            t_extra (float): additional simulation time (seconds).
+            path (string): folder of the trajectory file. Ignored if the
+                store is already open. Default './'.
+            verbose (bool): print the simulation progress.
+            kwargs: additional arguments passed to :meth:`simulate_diffusion`
+                (e.g. `engine`, `wrap_func`, `block_size`). `save_pos`,
+                `total_emission`, `radial` and `psf_support` are taken
+                from the stored simulation.
+        """
+        if hasattr(self, 'store'):
+            path = self.store.filepath.parent
+            self.store.close()
+            del self.store
+        elif path is None:
+            path = './'
+        self.open_store_traj(path=path, mode='a')
+        attrs = self.traj_group._v_attrs
+        if 'last_shard_random_states' in attrs:
+            raise ValueError('Simulations with num_processes cannot be '
+                             'extended.')
+        if 'checkpoint_samples' not in attrs:
+            if (self.position.name != 'position' or
+                    self.position.shape[-1] == 0):
+                raise ValueError('No checkpoint nor 3D positions found in '
+                                 '"%s".' % self.store.filename)
+            self.culled_samples = attrs['culled_samples'] \
+                if 'culled_samples' in attrs else 0
+            rs = rng.from_state(rng.load_state(self.traj_group,
+                                               'last_random_state'))
+            self._save_checkpoint(self.position.shape[-1],
+                                  self.position[:, :, -1:], rs)
+        kwargs.update(
+            save_pos=self.position.shape[-1] > 0,
+            total_emission=self.emission_tot.shape[0] > 0,
+            radial=self.position.name == 'position_rz',
+            psf_support=attrs['psf_support'] if 'psf_support' in attrs
+            else None)
+        old_filepath = self.store.filepath
+        self.store.close()
+        del self.store
+
+        self.t_max += t_extra
+        self.n_samples = int(self.t_max / self.t_step)
+        filepath = Path(path, self._store_fname(self._PREFIX_TRAJ))
+        if filepath != old_filepath:
+            if filepath.exists():
+                raise ValueError('File "%s" already exists.' % filepath)
+            old_filepath.rename(filepath)
+        self.open_store_traj(path=path, mode='a')
+        self.store.set_sim_params(dict(t_max=self.numeric_params['t_max']),
+                                  {}, overwrite=True)
+        self.simulate_diffusion(path=path, resume=True, verbose=verbose,
+                                **kwargs)
+
     def _get_ts_name_mix_core(self, max_rates, populations, bg_rate,
                               timeslice=None):
         if timeslice is None:
@@ -649,7 +1509,7 @@ class ParticlesSimulation(object):
     def _get_ts_name_mix(self, max_rates, populations, bg_rate, rs,
                          hashsize=6):
         s = self._get_ts_name_mix_core(max_rates, populations, bg_rate)
-        return '%s_rs_%s' % (s, hash_(rs.get_state())[:hashsize])
+        return '%s_rs_%s' % (s, hash_(rng.get_state(rs))[:hashsize])
 
     def timestamps_match_pattern(self, pattern):
         return [t for t in self.timestamp_names if pattern in t]
@@ -679,84 +1539,129 @@ class ParticlesSimulation(object):
         return names
 
     def _sim_timestamps(self, max_rate, bg_rate, emission, i_start, rs,
-                        ip_start=0, scale=10, sort=True):
+                        ip_start=0, scale=10, sort=True, sampler='dense',
+                        counts_buffer=None, overflow='promote'):
         """Simulate timestamps from emission trajectories.
 
         Uses attributes: `.t_step`.
 
+        The timestamps are extracted from the counts matrix in time order
+        (and in particle order within a time bin) without sorting.
+        A bin with k > 1 counts yields k equal timestamps. The argument
+        `sort` is ignored and kept for backward compatibility.
+
+        Arguments:
+            sampler (string): 'dense' draws the counts of each bin with
+                :func:`sim_counts`,
+                'sparse' draws only the photons with
+                :func:`sim_timetrace_bg_sparse` (faster for low rates
+                when most bins have zero emission). The 'sparse' sampler
+                requires culled emission (see :attr:`emission_culled`)
+                and raises ValueError otherwise. The two samplers are
+                statistically equivalent but use the random numbers
+                differently. 'thinning' draws the photons
+                in continuous time with :func:`sim_photons_thinning`:
+                the timestamps are not quantized to `t_step` (only to
+                `t_step / scale`).
+            counts_buffer (CountsBuffer or None): reusable buffer for the
+                counts of the 'dense' sampler. If None, allocate a new
+                uint8 array.
+            overflow (string): overflow policy of the counts of the
+                'dense' sampler (see :func:`sim_counts`).
+
         Returns:
             A tuple of two arrays: timestamps and particles.
         """
-        counts_chunk = sim_timetrace_bg(emission, max_rate, bg_rate,
-                                        self.t_step, rs=rs)
-        nrows = emission.shape[0]
-        if bg_rate is not None:
-            nrows += 1
-        assert counts_chunk.shape == (nrows, emission.shape[1])
-        max_counts = counts_chunk.max()
-        if max_counts == 0:
+        if sampler == 'thinning':
+            times, i_par = sim_photons_thinning(emission, max_rate, bg_rate,
+                                                self.t_step, rs=rs)
+            if times.size == 0:
+                return (np.array([], dtype=np.int64),
+                        np.array([], dtype=np.int64))
+            times_chunk = (np.floor(times * scale).astype('int64') +
+                           i_start * scale)
+            return times_chunk, (i_par + ip_start).astype('u1')
+        elif sampler == 'dense':
+            nrows = emission.shape[0]
+            if bg_rate is not None:
+                nrows += 1
+            out = None
+            if counts_buffer is not None:
+                out = counts_buffer.get((nrows, emission.shape[1]))
+            counts_chunk = sim_counts(emission, max_rate, bg_rate,
+                                      self.t_step, rs=rs, out=out,
+                                      overflow=overflow)
+
+            # Indexes of the bins with counts, in time order
+            i_time, i_par = np.nonzero(counts_chunk.T)
+            counts = counts_chunk[i_par, i_time]
+        elif sampler == 'sparse':
+            if not self.emission_culled:
+                raise ValueError("The 'sparse' sampler requires the emission "
+                                 "culled with a PSF support (psf_support) "
+                                 "or stored in the sparse format.")
+            i_time, i_par, counts = sim_timetrace_bg_sparse(
+                emission, max_rate, bg_rate, self.t_step, rs=rs)
+        else:
+            raise ValueError("Unknown sampler '%s'. Valid samplers are "
+                             "'dense', 'sparse' and 'thinning'." % sampler)
+        if i_time.size == 0:
             return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
 
-        time_start = i_start * scale
-        time_stop = time_start + counts_chunk.shape[1] * scale
-        ts_range = np.arange(time_start, time_stop, scale, dtype='int64')
-
-        # Loop for each particle to compute timestamps
-        times_chunk_p = []
-        par_index_chunk_p = []
-        for ip, counts_chunk_ip in enumerate(counts_chunk):
-            # Compute timestamps for particle ip for all bins with counts
-            times_c_ip = []
-            for v in range(1, max_counts + 1):
-                times_c_ip.append(ts_range[counts_chunk_ip >= v])
-
-            # Stack the timestamps from different "counts"
-            t = np.hstack(times_c_ip)
-            # Append current particle
-            times_chunk_p.append(t)
-            par_index_chunk_p.append(np.full(t.size, ip + ip_start, dtype='u1'))
-
-        # Merge the arrays of different particles
-        times_chunk = np.hstack(times_chunk_p)
-        par_index_chunk = np.hstack(par_index_chunk_p)
-
-        if sort:
-            # Sort timestamps inside the merged chunk
-            index_sort = times_chunk.argsort(kind='mergesort')
-            times_chunk = times_chunk[index_sort]
-            par_index_chunk = par_index_chunk[index_sort]
+        times_chunk = (i_time + i_start).astype('int64') * scale
+        par_index_chunk = (i_par + ip_start).astype('u1')
 
+        # Repeat the timestamps of bins with more than one count
+        if counts.max() > 1:
+            times_chunk = np.repeat(times_chunk, counts)
+            par_index_chunk = np.repeat(par_index_chunk, counts)
         return times_chunk, par_index_chunk
 
     def _sim_timestamps_populations(self, emission, max_rates, populations,
-                                    bg_rates, i_start, rs, scale=10):
-            # Loop for each population
-            ts_chunk_pop_list, par_index_chunk_pop_list = [], []
-            for rate, pop, bg in zip(max_rates, populations, bg_rates):
-                emission_pop = emission[pop]
-                ts_chunk_pop, par_index_chunk_pop = \
-                    self._sim_timestamps(
-                        rate, bg, emission_pop, i_start, ip_start=pop.start,
-                        rs=rs, scale=scale, sort=False)
-
-                ts_chunk_pop_list.append(ts_chunk_pop)
-                par_index_chunk_pop_list.append(par_index_chunk_pop)
-
-            # Merge populations
-            times_chunk_s = np.hstack(ts_chunk_pop_list)
-            par_index_chunk_s = np.hstack(par_index_chunk_pop_list)
-
-            # Sort timestamps inside the merged chunk
-            index_sort = times_chunk_s.argsort(kind='mergesort')
-            times_chunk_s = times_chunk_s[index_sort]
-            par_index_chunk_s = par_index_chunk_s[index_sort]
+                                    bg_rates, i_start, rs, scale=10,
+                                    sampler='dense', counts_buffer=None,
+                                    overflow='promote'):
+        """Simulate the timestamps of a mixture of populations.
+
+        The timestamps of each population are in time order. They are merged
+        with a stable sort, so equal timestamps are in population order.
+        The merge sort of the k sorted runs takes O(n log k).
+
+        Returns:
+            A tuple of two arrays: timestamps and particles.
+        """
+        # Loop for each population
+        ts_chunk_pop_list, par_index_chunk_pop_list = [], []
+        for rate, pop, bg in zip(max_rates, populations, bg_rates):
+            emission_pop = emission[pop]
+            ts_chunk_pop, par_index_chunk_pop = \
+                self._sim_timestamps(
+                    rate, bg, emission_pop, i_start, ip_start=pop.start,
+                    rs=rs, scale=scale, sampler=sampler,
+                    counts_buffer=counts_buffer, overflow=overflow)
+
+            ts_chunk_pop_list.append(ts_chunk_pop)
+            par_index_chunk_pop_list.append(par_index_chunk_pop)
+
+        # Merge populations
+        times_chunk_s = np.hstack(ts_chunk_pop_list)
+        par_index_chunk_s = np.hstack(par_index_chunk_pop_list)
+        if len(ts_chunk_pop_list) == 1:
             return times_chunk_s, par_index_chunk_s
 
+        # Merge the time-ordered timestamps of the populations
+        index_sort = times_chunk_s.argsort(kind='mergesort')
+        times_chunk_s = times_chunk_s[index_sort]
+        par_index_chunk_s = par_index_chunk_s[index_sort]
+        return times_chunk_s, par_index_chunk_s
+
     def simulate_timestamps_mix(self, max_rates, populations, bg_rate,
                                 rs=None, seed=1, chunksize=2**16,
                                 comp_filter=None, overwrite=False,
                                 skip_existing=False, scale=10,
-                                path=None, t_chunksize=None, timeslice=None):
+                                path=None, t_chunksize=None, timeslice=None,
+                                reader_queue_size=0, max_memory=None,
+                                sampler='dense', num_processes=None):
         """Compute one timestamps array for a mixture of N populations.
 
         Timestamp data are saved to disk and accessible as pytables arrays in
@@ -788,11 +1693,43 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            reader_queue_size (int): number of emission chunks read ahead
+                (and decompressed) in a background thread while the
+                current chunk is converted to photons. If 0, read each
+                chunk when needed. See :class:`iter_chunks.ChunkReader`.
+            max_memory (int or None): if not None, memory budget in bytes
+                for the chunks in memory. `t_chunksize` and
+                `reader_queue_size` (used as upper bound) are derived
+                from the budget (see :meth:`memory_budget`).
+            sampler (string): 'dense' (default) draws a Poisson number for
+                each time bin and particle, 'sparse' draws only the
+                photons, skipping the bins with zero emission (faster for
+                low rates, requires the emission simulated with a
+                `psf_support` or stored in the sparse format, see
+                :attr:`emission_culled`). The samplers are statistically
+                equivalent but give different timestamps for the same
+                random state (see :func:`sim_timetrace_bg_sparse`).
+                'thinning' draws the
+                photons in continuous time, with a resolution of
+                `t_step / scale` instead of `t_step` (see
+                :func:`sim_photons_thinning`).
+            num_processes (int or None): if not None, the chunks are
+                simulated in parallel by `num_processes` processes (see
+                :class:`ParallelPhotons`). Each chunk uses its own random
+                stream, derived from the chunk index and a seed drawn from
+                `rs` (saved in the attribute 'chunk_seed'), so the
+                timestamps do not depend on `num_processes` (but differ
+                from a simulation with `num_processes=None`).
         """
         self.open_store_timestamp(chunksize=chunksize, path=path)
         rs = self._get_group_randomstate(rs, seed, self.ts_group)
         if t_chunksize is None:
             t_chunksize = self.emission.chunkshape[1]
+        if max_memory is not None:
+            budget = self.memory_budget(max_memory, 'timestamps',
+                                        queue_depth=reader_queue_size)
+            t_chunksize = budget.t_chunksize
+            reader_queue_size = budget.queue_depth
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
@@ -815,53 +1752,214 @@ class ParticlesSimulation(object):
             else:
                 raise e
 
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self._timestamps.attrs['init_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['init_random_state'] = rng.state_to_attr(rs)
+        self._timestamps.attrs['init_random_state'] = rng.state_to_attr(rs)
         self._timestamps.attrs['PyBroMo'] = __version__
 
-        ts_list, part_list = [], []
         # Load emission in chunks, and save only the final timestamps
-        bg_rates = [None] * (len(max_rates) - 1) + [bg_rate]
-        prev_time = 0
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
+        chunks = emission_chunks(self, t_chunksize, timeslice_size,
+                                 queue_depth=reader_queue_size)
+        chunks = progress(chunks, self.t_step, decimals=0)
+        if num_processes is not None:
+            seed = rng.draw_seed(rs)
+            self._timestamps.attrs['chunk_seed'] = seed
+            channels = [dict(max_rates=max_rates, bg_rate=bg_rate)]
+            chunks = ParallelPhotons(self, [name], channels, populations,
+                                     seed, num_processes, scale,
+                                     sampler)(chunks)
+        else:
+            chunks = Photons(name, self, max_rates, populations, bg_rate, rs,
+                             scale, sampler)(chunks)
+        run(chunks, TimestampSink({name: (self._timestamps,
+                                          self._tparticles)}))
+
+        # Save current random state so it can be resumed in the next session
+        self.ts_group._v_attrs['last_random_state'] = rng.state_to_attr(rs)
+        self._timestamps.attrs['last_random_state'] = rng.state_to_attr(rs)
+        self.ts_store.h5file.flush()
 
-            curr_time = np.around(i_start * self.t_step, decimals=0)
-            if curr_time > prev_time:
-                print(' %.1fs' % curr_time, end='', flush=True)
-                prev_time = curr_time
+    def _add_timestamps_channels(self, channels, populations, rs, scale=10,
+                                 chunksize=2**16, comp_filter=None,
+                                 overwrite=False, skip_existing=False):
+        """Create the on-disk timestamps arrays of each channel.
 
-            em_chunk = self.emission[:, i_start:i_end]
+        The arguments are described in :meth:`simulate_timestamps_multi`.
+        If an array already exists (and `overwrite` is False) no array is
+        created: returns None if `skip_existing` is True, otherwise
+        raises `ExistingArrayError`.
 
-            times_chunk_s, par_index_chunk_s = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates, populations, bg_rates, i_start,
-                    rs, scale)
+        Returns:
+            The list of channel names.
+        """
+        names = [ch.get('name') or
+                 self._get_ts_name_mix(ch['max_rates'],
+                                       ch.get('populations', populations),
+                                       ch['bg_rate'], ch.get('rs', rs))
+                 for ch in channels]
+        if len(set(names)) < len(names):
+            raise ValueError('Duplicated channel names %s: use the '
+                             'channel key `name`.' % names)
+        if not overwrite:
+            existing = [name for name in names if name in self.ts_group]
+            if existing and skip_existing:
+                print(' - Skipping already present timestamps array.')
+                return
+            elif existing:
+                raise ExistingArrayError('Timestamp array already exist '
+                                         '(%s)' % existing[0])
 
-            # Save sorted timestamps (suffix '_s') and corresponding particles
-            ts_list.append(times_chunk_s)
-            part_list.append(par_index_chunk_s)
+        kw = dict(clk_p=self.t_step / scale,
+                  num_particles=self.num_particles,
+                  bg_particle=self.num_particles,
+                  overwrite=overwrite, chunksize=chunksize)
+        if comp_filter is not None:
+            kw.update(comp_filter=comp_filter)
+        for name, ch in zip(names, channels):
+            timestamps, _ = self.ts_store.add_timestamps(
+                name=name, max_rates=ch['max_rates'], bg_rate=ch['bg_rate'],
+                populations=ch.get('populations', populations), **kw)
+            timestamps.attrs['init_random_state'] = \
+                rng.state_to_attr(ch.get('rs', rs))
+            timestamps.attrs['PyBroMo'] = __version__
+        self.ts_group._v_attrs['init_random_state'] = rng.state_to_attr(rs)
+        return names
 
-        for ts, part in zip(ts_list, part_list):
-            self._timestamps.append(ts)
-            self._tparticles.append(part)
+    def _run_timestamps_channels(self, chunks, names, channels, populations,
+                                 rs, scale, writer_queue_size=0,
+                                 sampler='dense', num_processes=None):
+        """Simulate the timestamps of each channel from `chunks`.
+
+        For each chunk, the photons of the channels are simulated in the
+        order of `channels` (see `pipeline`) and appended to the arrays
+        `names`, by a background thread if `writer_queue_size` is > 0.
+        If `num_processes` is not None, the chunks are simulated by a
+        :class:`ParallelPhotons` stage with random streams derived from
+        a seed drawn from `rs` (saved in the arrays attribute
+        'chunk_seed').
+        At the end, the random state is saved to allow resuming.
+        """
+        chunks = progress(chunks, self.t_step, decimals=1)
+        if num_processes is not None:
+            seed = rng.draw_seed(rs)
+            for name in names:
+                timestamps, _ = self.get_timestamps_part(name)
+                timestamps._v_attrs['chunk_seed'] = seed
+            chunks = ParallelPhotons(self, names, channels, populations,
+                                     seed, num_processes, scale,
+                                     sampler)(chunks)
+        else:
+            for name, ch in zip(names, channels):
+                chunks = Photons(name, self, ch['max_rates'],
+                                 ch.get('populations', populations),
+                                 ch['bg_rate'], ch.get('rs', rs), scale,
+                                 sampler)(chunks)
+        sink = TimestampSink({name: self.get_timestamps_part(name)
+                              for name in names})
+        if writer_queue_size > 0:
+            sink = ThreadedSink(sink, writer_queue_size)
+        run(chunks, sink)
 
         # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps.attrs['last_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['last_random_state'] = rng.state_to_attr(rs)
+        for name, ch in zip(names, channels):
+            timestamps, _ = self.get_timestamps_part(name)
+            timestamps._v_attrs['last_random_state'] = \
+                rng.state_to_attr(ch.get('rs', rs))
         self.ts_store.h5file.flush()
 
+    def simulate_timestamps_multi(self, channels, populations, rs=None,
+                                  seed=1, chunksize=2**16, comp_filter=None,
+                                  overwrite=False, skip_existing=False,
+                                  scale=10, path=None, t_chunksize=None,
+                                  timeslice=None, writer_queue_size=0,
+                                  reader_queue_size=0, max_memory=None,
+                                  sampler='dense', num_processes=None):
+        """Compute the timestamps of K channels for a mixture of populations.
+
+        This method reads the emission from disk once, and generates the
+        timestamps of all the channels (e.g. donor and acceptor, three
+        colors or the polarization components) from each chunk.
+
+        Timestamp data are saved to disk, one pair of arrays per channel,
+        accessible with :meth:`get_timestamps_part`.
+        The background generated timestamps are assigned a
+        conventional particle number (last particle index + 1).
+
+        Arguments:
+            channels (list of dict): one dict per channel with keys
+                'max_rates' (list of the peak emission rate in the channel
+                for each population), 'bg_rate' (rate of the Poisson
+                background in the channel, cps, or None) and, optionally,
+                'name' (name of the timestamps array, by default computed
+                from the rates as in :meth:`simulate_timestamps_mix`),
+                'populations' (the channel populations, overriding
+                `populations`) and 'rs' (the random number generator of
+                the channel, overriding `rs`; not supported with
+                `num_processes`).
+            populations (list of slices): slices to `self.particles`
+                defining each population (can be None if all the channels
+                define 'populations').
+
+        See :meth:`simulate_timestamps_mix_da` for the other arguments.
+
+        Returns:
+            The list of the timestamps array names, one per channel (None
+            if the simulation is skipped).
+        """
+        if num_processes is not None and any('rs' in ch for ch in channels):
+            raise ValueError("The channel key 'rs' is not supported with "
+                             "num_processes.")
+        self.open_store_timestamp(chunksize=chunksize, path=path)
+        rs = self._get_group_randomstate(rs, seed, self.ts_group)
+        if t_chunksize is None:
+            t_chunksize = self.emission.chunkshape[1]
+        if max_memory is not None:
+            budget = self.memory_budget(max_memory, 'timestamps',
+                                        queue_depth=reader_queue_size)
+            t_chunksize = budget.t_chunksize
+            reader_queue_size = budget.queue_depth
+        timeslice_size = self.n_samples
+        if timeslice is not None:
+            timeslice_size = timeslice // self.t_step
+
+        names = self._add_timestamps_channels(
+            channels, populations, rs, scale=scale, chunksize=chunksize,
+            comp_filter=comp_filter, overwrite=overwrite,
+            skip_existing=skip_existing)
+        if names is None:
+            return
+
+        # Load emission in chunks, and save only the final timestamps
+        chunks = emission_chunks(self, t_chunksize, timeslice_size,
+                                 queue_depth=reader_queue_size)
+        self._run_timestamps_channels(chunks, names, channels, populations,
+                                      rs, scale, writer_queue_size, sampler,
+                                      num_processes)
+        return names
+
+    def _set_timestamps_da(self, names):
+        """Set `._timestamps_d/a` and `._tparticles_d/a` from `names`."""
+        name_d, name_a = names
+        self._timestamps_d, self._tparticles_d = \
+            self.get_timestamps_part(name_d)
+        self._timestamps_a, self._tparticles_a = \
+            self.get_timestamps_part(name_a)
+
     def simulate_timestamps_mix_da(self, max_rates_d, max_rates_a,
                                    populations, bg_rate_d, bg_rate_a,
                                    rs=None, seed=1, chunksize=2**16,
                                    comp_filter=None, overwrite=False,
                                    skip_existing=False, scale=10,
                                    path=None, t_chunksize=2**19,
-                                   timeslice=None):
+                                   timeslice=None, writer_queue_size=0,
+                                   reader_queue_size=0, max_memory=None,
+                                   sampler='dense', num_processes=None):
 
         """Compute D and A timestamps arrays for a mixture of N populations.
 
         This method reads the emission from disk once, and generates a pair
         of timestamps arrays (e.g. donor and acceptor) from each chunk.
+        See :meth:`simulate_timestamps_multi` for more channels.
 
         Timestamp data are saved to disk and accessible as pytables arrays in
         `._timestamps_d/a` and `._tparticles_d/a`.
@@ -897,87 +1995,30 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            writer_queue_size (int): if > 0, append the timestamps in a
+                background thread. See :meth:`simulate_diffusion`.
+            reader_queue_size (int): number of emission chunks read ahead
+                in a background thread. See :meth:`simulate_timestamps_mix`.
+            max_memory (int or None): if not None, derive `t_chunksize`
+                and `reader_queue_size` from a memory budget in bytes.
+                See :meth:`simulate_timestamps_mix`.
+            sampler (string): 'dense', 'sparse' or 'thinning' photon
+                sampler. See :meth:`simulate_timestamps_mix`.
+            num_processes (int or None): if not None, simulate the chunks
+                in parallel. See :meth:`simulate_timestamps_mix`.
         """
-        self.open_store_timestamp(chunksize=chunksize, path=path)
-        rs = self._get_group_randomstate(rs, seed, self.ts_group)
-        if t_chunksize is None:
-            t_chunksize = self.emission.chunkshape[1]
-        timeslice_size = self.n_samples
-        if timeslice is not None:
-            timeslice_size = timeslice // self.t_step
-
-        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs)
-        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs)
-
-        kw = dict(clk_p=self.t_step / scale,
-                  populations=populations,
-                  num_particles=self.num_particles,
-                  bg_particle=self.num_particles,
-                  overwrite=overwrite, chunksize=chunksize)
-        if comp_filter is not None:
-            kw.update(comp_filter=comp_filter)
-
-        kw.update(name=name_d, max_rates=max_rates_d, bg_rate=bg_rate_d)
-        try:
-            self._timestamps_d, self._tparticles_d = (self.ts_store
-                                                      .add_timestamps(**kw))
-        except ExistingArrayError as e:
-            if skip_existing:
-                print(' - Skipping already present timestamps array.')
-                return
-            else:
-                raise e
-
-        kw.update(name=name_a, max_rates=max_rates_a, bg_rate=bg_rate_a)
-        try:
-            self._timestamps_a, self._tparticles_a = (self.ts_store
-                                                      .add_timestamps(**kw))
-        except ExistingArrayError as e:
-            if skip_existing:
-                print(' - Skipping already present timestamps array.')
-                return
-            else:
-                raise e
-
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self._timestamps_d.attrs['init_random_state'] = rs.get_state()
-        self._timestamps_d.attrs['PyBroMo'] = __version__
-        self._timestamps_a.attrs['init_random_state'] = rs.get_state()
-        self._timestamps_a.attrs['PyBroMo'] = __version__
-
-        # Load emission in chunks, and save only the final timestamps
-        bg_rates_d = [None] * (len(max_rates_d) - 1) + [bg_rate_d]
-        bg_rates_a = [None] * (len(max_rates_a) - 1) + [bg_rate_a]
-        prev_time = 0
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
-
-            curr_time = np.around(i_start * self.t_step, decimals=1)
-            if curr_time > prev_time:
-                print(' %.1fs' % curr_time, end='', flush=True)
-                prev_time = curr_time
-
-            em_chunk = self.emission[:, i_start:i_end]
-
-            times_chunk_s_d, par_index_chunk_s_d = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_d, populations, bg_rates_d, i_start,
-                    rs, scale)
-
-            times_chunk_s_a, par_index_chunk_s_a = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_a, populations, bg_rates_a, i_start,
-                    rs, scale)
-
-            # Save sorted timestamps (suffix '_s') and corresponding particles
-            self._timestamps_d.append(times_chunk_s_d)
-            self._tparticles_d.append(par_index_chunk_s_d)
-            self._timestamps_a.append(times_chunk_s_a)
-            self._tparticles_a.append(par_index_chunk_s_a)
-
-        # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
-        self.ts_store.h5file.flush()
+        channels = [dict(max_rates=max_rates_d, bg_rate=bg_rate_d),
+                    dict(max_rates=max_rates_a, bg_rate=bg_rate_a)]
+        names = self.simulate_timestamps_multi(
+            channels, populations, rs=rs, seed=seed, chunksize=chunksize,
+            comp_filter=comp_filter, overwrite=overwrite,
+            skip_existing=skip_existing, scale=scale, path=path,
+            t_chunksize=t_chunksize, timeslice=timeslice,
+            writer_queue_size=writer_queue_size,
+            reader_queue_size=reader_queue_size, max_memory=max_memory,
+            sampler=sampler, num_processes=num_processes)
+        if names is not None:
+            self._set_timestamps_da(names)
 
     def simulate_timestamps_mix_da_online(self, max_rates_d, max_rates_a,
                                  populations, bg_rate_d, bg_rate_a,
@@ -985,7 +2026,11 @@ class ParticlesSimulation(object):
                                  comp_filter=None, overwrite=False,
                                  skip_existing=False, scale=10,
                                  path=None, t_chunksize=2**19,
-                                 timeslice=None):
+                                 timeslice=None, engine='loop',
+                                 block_size=None, dtype='float64',
+                                 psf_support=None, jump_size=2**10,
+                                 writer_queue_size=0, max_memory=None,
+                                 sampler='dense'):
         """Compute D and A timestamps arrays for a mixture of N populations.
 
         This method simulates the diffusion, emission and generates a pair
@@ -1021,7 +2066,36 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            engine (string): diffusion engine, 'loop', 'batch', 'fused'
+                or 'adaptive'. See :meth:`simulate_diffusion`.
+            block_size (int or None): number of particles simulated at once
+                by the 'batch' engine. See :meth:`simulate_diffusion`.
+            dtype (string): 'float64' or 'float32' ('batch' engine only).
+                See :meth:`simulate_diffusion`.
+            psf_support (tuple or None): (r_max, z_max) PSF support used
+                to cull the emission evaluation. See
+                :meth:`simulate_diffusion`.
+            jump_size (int): block size of the 'adaptive' engine.
+                See :meth:`simulate_diffusion`.
+            writer_queue_size (int): if > 0, append the timestamps in a
+                background thread. See :meth:`simulate_diffusion`.
+            max_memory (int or None): if not None, memory budget in bytes
+                for the chunks in memory. `t_chunksize` and `block_size`
+                (used as upper bound) are derived from the budget and the
+                chunks are shortened when the memory available drops
+                (see :meth:`memory_budget`).
+            sampler (string): 'dense', 'sparse' or 'thinning' photon
+                sampler. See :meth:`simulate_timestamps_mix`.
         """
+        budget = None
+        if max_memory is not None:
+            budget = self.memory_budget(max_memory, 'online', engine=engine,
+                                        dtype=dtype, block_size=block_size)
+            t_chunksize = budget.t_chunksize
+            block_size = budget.block_size
+        sim_trajectories = self._get_sim_trajectories(
+            engine, block_size, dtype, psf_support=psf_support,
+            jump_size=jump_size)
         self.open_store_timestamp(chunksize=chunksize, path=path)
         rs = self._get_group_randomstate(rs, seed, self.ts_group)
         if t_chunksize is None:
@@ -1030,145 +2104,240 @@ class ParticlesSimulation(object):
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs)
-        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs)
+        channels = [dict(max_rates=max_rates_d, bg_rate=bg_rate_d),
+                    dict(max_rates=max_rates_a, bg_rate=bg_rate_a)]
+        names = self._add_timestamps_channels(
+            channels, populations, rs, scale=scale, chunksize=chunksize,
+            comp_filter=comp_filter, overwrite=overwrite,
+            skip_existing=skip_existing)
+        if names is None:
+            return
+        self._set_timestamps_da(names)
+        self.ts_group.attrs['Diffusion'] = 1
 
-        kw = dict(clk_p=self.t_step / scale,
-                  populations=populations,
-                  num_particles=self.num_particles,
-                  bg_particle=self.num_particles,
-                  overwrite=overwrite, chunksize=chunksize)
-        if comp_filter is not None:
-            kw.update(comp_filter=comp_filter)
+        print('- Start trajectories simulation - %s' % ctime(), flush=True)
+        par_start_pos = self.particles.positions
 
-        kw.update(name=name_d, max_rates=max_rates_d, bg_rate=bg_rate_d)
-        try:
-            self._timestamps_d, self._tparticles_d = (self.ts_store
-                                                      .add_timestamps(**kw))
-        except ExistingArrayError as e:
-            if skip_existing:
-                print(' - Skipping, timestamps array already present.')
-                return
-            else:
-                raise e
+        # Simulate the emission in chunks, and save only the final timestamps
+        chunks = diffusion_chunks(self, rs, t_chunksize, timeslice_size,
+                                  start_pos=par_start_pos,
+                                  sim_trajectories=sim_trajectories,
+                                  budget=budget)
+        self._run_timestamps_channels(chunks, names, channels, populations,
+                                      rs, scale, writer_queue_size, sampler)
+        print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
-        kw.update(name=name_a, max_rates=max_rates_a, bg_rate=bg_rate_a)
-        try:
-            self._timestamps_a, self._tparticles_a = (self.ts_store
-                                                      .add_timestamps(**kw))
-        except ExistingArrayError as e:
-            if skip_existing:
-                print(' - Skipping, timestamps array already present.')
-                return
-            else:
-                raise e
 
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self.ts_group.attrs['Diffusion'] = 1
-        self._timestamps_d.attrs['init_random_state'] = rs.get_state()
-        self._timestamps_d.attrs['PyBroMo'] = __version__
-        self._timestamps_a.attrs['PyBroMo'] = __version__
+# Simulation object of the current worker process (see ShardedTrajectories)
+_shard_sim = None
 
-        print('- Start trajectories simulation - %s' % ctime(), flush=True)
-        par_start_pos = self.particles.positions
 
-        # Load emission in chunks, and save only the final timestamps
-        bg_rates_d = [None] * (len(max_rates_d) - 1) + [bg_rate_d]
-        bg_rates_a = [None] * (len(max_rates_a) - 1) + [bg_rate_a]
-        prev_time = 0
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
-
-            curr_time = np.around(i_start * self.t_step, decimals=1)
-            if curr_time > prev_time:
-                print(' %.1fs' % curr_time, end='', flush=True)
-                prev_time = curr_time
-
-            _, em_chunk = self._sim_trajectories(t_chunksize, par_start_pos,
-                                                 rs,
-                                                 total_emission=False,
-                                                 save_pos=False, radial=False,
-                                                 wrap_func=wrap_periodic)
-
-            times_chunk_s_d, par_index_chunk_s_d = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_d, populations, bg_rates_d, i_start,
-                    rs, scale)
-
-            times_chunk_s_a, par_index_chunk_s_a = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_a, populations, bg_rates_a, i_start,
-                    rs, scale)
-
-            # Save sorted timestamps (suffix '_s') and corresponding particles
-            self._timestamps_d.append(times_chunk_s_d)
-            self._tparticles_d.append(par_index_chunk_s_d)
-            self._timestamps_a.append(times_chunk_s_a)
-            self._tparticles_a.append(par_index_chunk_s_a)
+def _init_shard_worker(t_step, t_max, particles, box, psf,
+                       emission_culled=None):
+    """Initialize a worker process of :class:`ShardedTrajectories`."""
+    global _shard_sim
+    _shard_sim = dict(t_step=t_step, t_max=t_max, particles=particles,
+                      box=box, psf=psf, emission_culled=emission_culled,
+                      shards={})
 
-        # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
-        self.ts_store.h5file.flush()
-        print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
-def sim_timetrace(emission, max_rate, t_step):
-    """Draw random emitted photons from Poisson(emission_rates).
+def _get_shard_sim(shard):
+    """Return the simulation of a shard of particles in a worker process.
+
+    The ParticlesSimulation objects are created on the first call and
+    cached for the following chunks.
+    """
+    shards = _shard_sim['shards']
+    key = (shard.start, shard.stop)
+    if key not in shards:
+        r0, D = _shard_sim['particles']
+        particles = Particles(num_particles=None, D=None,
+                              box=_shard_sim['box'],
+                              particles=(r0[shard], D[shard]))
+        shards[key] = ParticlesSimulation(
+            t_step=_shard_sim['t_step'], t_max=_shard_sim['t_max'],
+            particles=particles, box=_shard_sim['box'],
+            psf=_shard_sim['psf'])
+        if _shard_sim['emission_culled'] is not None:
+            shards[key].emission_culled = _shard_sim['emission_culled']
+    return shards[key]
+
+
+def _sim_shard_chunk(args):
+    """Simulate a chunk of trajectories for a shard of particles.
+
+    Executed in a worker process of :class:`ShardedTrajectories`.
+    """
+    shard, time_size, start_pos, rs, engine_kw, kwargs = args
+    S = _get_shard_sim(shard)
+    S.culled_samples = 0
+    sim_trajectories = S._get_sim_trajectories(**engine_kw)
+    POS, em = sim_trajectories(time_size, start_pos, rs, **kwargs)
+    return POS, em, start_pos, rs, S.culled_samples
+
+
+class ShardedTrajectories:
+    """Simulate trajectories with particles split across processes.
+
+    The particles are split in `num_processes` contiguous shards, each one
+    simulated by a process of a `multiprocessing.Pool`. The random streams
+    of the shards are derived from `rs` as follows:
+
+    - RandomState: each shard uses a RandomState seeded with a number drawn
+      from `rs` (seeds are saved in `self.seeds`). Results depend on
+      `num_processes`.
+    - Generator: each shard uses a Generator spawned from a seed drawn
+      from `rs` (see :func:`rng.spawn`). Results depend on `num_processes`.
+    - StreamSet: each shard uses the streams of its particles, which are
+      updated in-place. Results are identical to a single-process
+      simulation for any `num_processes`.
+
+    The keyword arguments `engine_kw` select the engine used by each
+    process (see :meth:`ParticlesSimulation._get_sim_trajectories`).
+
+    Instances are callables with the same signature of
+    :meth:`ParticlesSimulation._sim_trajectories` (the `rs` argument is
+    ignored) and must be closed with :meth:`close` after use.
+    The samples culled by all the processes are counted in
+    `self.culled_samples`.
     """
-    emission_rates = emission * max_rate * t_step
-    return np.random.poisson(lam=emission_rates).astype(np.uint8)
 
-def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None):
-    """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
+    def __init__(self, S, num_processes, rs, **engine_kw):
+        index = np.arange(S.num_particles)
+        self.shards = [slice(int(idx[0]), int(idx[-1]) + 1)
+                       for idx in np.array_split(index, num_processes)
+                       if idx.size > 0]
+        self.seeds, self.streams = None, None
+        if isinstance(rs, rng.StreamSet):
+            self.streams = rs
+            self.rs_list = [rs[shard] for shard in self.shards]
+        elif isinstance(rs, np.random.RandomState):
+            self.seeds = rs.randint(0, 2**31 - 1, size=len(self.shards))
+            self.rs_list = [np.random.RandomState(seed=seed)
+                            for seed in self.seeds]
+        else:
+            self.rs_list = rng.spawn(rs, len(self.shards))
+        self.engine_kw = engine_kw
+        self.culled_samples = 0
+        particles = (S.particles.r0, S.particles.diffusion_coeff)
+        initargs = (S.t_step, S.t_max, particles, S.box, S.psf)
+        self.pool = multiprocessing.Pool(len(self.shards),
+                                         initializer=_init_shard_worker,
+                                         initargs=initargs)
+
+    def __call__(self, time_size, start_pos, rs=None, total_emission=False,
+                 **kwargs):
+        kwargs.update(total_emission=total_emission)
+        tasks = [(shard, time_size, start_pos[shard], rs_i, self.engine_kw,
+                  kwargs)
+                 for shard, rs_i in zip(self.shards, self.rs_list)]
+        results = self.pool.map(_sim_shard_chunk, tasks)
+
+        POS, em_list = [], []
+        for i, (shard, res) in enumerate(zip(self.shards, results)):
+            POS_i, em_i, start_pos[shard], self.rs_list[i], culled = res
+            self.culled_samples += culled
+            if self.streams is not None:
+                self.streams[shard] = self.rs_list[i]
+            POS += POS_i
+            em_list.append(em_i)
+        if total_emission:
+            em = em_list[0]
+            for em_i in em_list[1:]:
+                em += em_i
+        else:
+            em = np.vstack(em_list)
+        return POS, em
 
-    Arguments:
-        emission (2D array): array of normalized emission rates. One row per
-            particle (axis = 0). Columns are the different time steps.
-        max_rate (float): the peak emission rate in Hz.
-        bg_rate (float or None): rate of a constant Poisson background (Hz).
-            Background is added as an additional row in the returned array
-            of counts. If None, no background simulated.
-        t_step (float): duration of a time step in seconds.
-        rs (RandomState or None): object used to draw the random numbers.
-            If None, a new RandomState is created using a random seed.
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
-    Returns:
-        `counts` an 2D uint8 array of counts in each time bin, for each
-        particle. If `bg_rate` is None counts.shape == emission.shape.
-        Otherwise, `counts` has one row more than `emission` for storing
-        the constant Poisson background.
+
+def _sim_photons_chunk(args):
+    """Simulate the timestamps of all the channels for a chunk of emission.
+
+    Executed in a worker process of :class:`ParallelPhotons`.
     """
-    if rs is None:
-        rs = np.random.RandomState()
-    em = np.atleast_2d(emission).astype('float64', copy=False)
-    counts_nrows = em.shape[0]
-    if bg_rate is not None:
-        counts_nrows += 1   # add a row for poisson background
-    counts = np.zeros((counts_nrows, em.shape[1]), dtype='u1')
-    # In-place computation
-    # NOTE: the caller will see the modification
-    em *= (max_rate * t_step)
-    # Use automatic type conversion int64 (counts_par) -> uint8 (counts)
-    counts_par = rs.poisson(lam=em)
-    if bg_rate is None:
-        counts[:] = counts_par
-    else:
-        counts[:-1] = counts_par
-        counts[-1] = rs.poisson(lam=bg_rate * t_step, size=em.shape[1])
-    return counts
-
-def sim_timetrace_bg2(emission, max_rate, bg_rate, t_step, rs=None):
-    """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
-
-    This is an alternative implementation of :func:`sim_timetrace_bg`.
+    emission, i_start, i_chunk, seed, channels, scale, sampler = args
+    S = _get_shard_sim(slice(0, len(_shard_sim['particles'][0])))
+    counts_buffer = _shard_sim.setdefault('counts_buffer', CountsBuffer())
+    rs = rng.chunk_generator(seed, i_chunk)
+    timestamps = []
+    for max_rates, populations, bg_rate in channels:
+        bg_rates = [None] * (len(max_rates) - 1) + [bg_rate]
+        timestamps.append(S._sim_timestamps_populations(
+            emission, max_rates, populations, bg_rates, i_start, rs, scale,
+            sampler, counts_buffer))
+    return timestamps
+
+
+class ParallelPhotons:
+    """Pipeline stage simulating the photons of the chunks in parallel.
+
+    Each chunk is processed by a worker of a `multiprocessing.Pool`, which
+    simulates the timestamps of all the channels (in order) using the
+    random stream of the chunk, derived from `seed` and the chunk index
+    (see :func:`rng.chunk_generator`). The chunks are yielded in order,
+    so the timestamps are identical for any `num_processes`.
+
+    Arguments:
+        S (ParticlesSimulation): the simulation object.
+        names (list of strings): names of the channels in
+            `chunk['timestamps']`.
+        channels (list of dict): channels as in
+            :meth:`ParticlesSimulation.simulate_timestamps_multi`.
+        populations (list of slices): default populations of the channels.
+        seed (int): seed of the random streams of the chunks.
+        num_processes (int): number of worker processes.
+        scale (int): timestamps unit is `S.t_step / scale`.
+        sampler (string): 'dense', 'sparse' or 'thinning' photon sampler.
+        queue_depth (int or None): max number of chunks in the pool.
+            If None, use 2 * `num_processes`.
     """
-    if rs is None:
-        rs = np.random.RandomState()
-    emiss_bin_rate = np.zeros((emission.shape[0] + 1, emission.shape[1]),
-                              dtype='float64')
-    emiss_bin_rate[:-1] = emission * max_rate * t_step
-    if bg_rate is not None:
-        emiss_bin_rate[-1] = bg_rate * t_step
-        counts = rs.poisson(lam=emiss_bin_rate).astype('uint8')
-    else:
-        counts = rs.poisson(lam=emiss_bin_rate[:-1]).astype('uint8')
-    return counts
+
+    def __init__(self, S, names, channels, populations, seed, num_processes,
+                 scale=10, sampler='dense', queue_depth=None):
+        self.S = S
+        self.names = names
+        self.channels = [(ch['max_rates'], ch.get('populations', populations),
+                          ch['bg_rate']) for ch in channels]
+        self.seed = seed
+        self.num_processes = num_processes
+        self.scale = scale
+        self.sampler = sampler
+        if queue_depth is None:
+            queue_depth = 2 * num_processes
+        self.queue_depth = max(queue_depth, 1)
+
+    def _merge(self, chunk, result):
+        timestamps = chunk.setdefault('timestamps', {})
+        timestamps.update(zip(self.names, result.get()))
+        return chunk
+
+    def __call__(self, chunks):
+        S = self.S
+        particles = (S.particles.r0, S.particles.diffusion_coeff)
+        initargs = (S.t_step, S.t_max, particles, S.box, S.psf,
+                    S.emission_culled)
+        pool = multiprocessing.Pool(self.num_processes,
+                                    initializer=_init_shard_worker,
+                                    initargs=initargs)
+        pending = deque()
+        try:
+            for i_chunk, chunk in enumerate(chunks):
+                task = (chunk['emission'], chunk['i_start'], i_chunk,
+                        self.seed, self.channels, self.scale, self.sampler)
+                pending.append((chunk, pool.apply_async(_sim_photons_chunk,
+                                                        (task,))))
+                if len(pending) >= self.queue_depth:
+                    yield self._merge(*pending.popleft())
+            while pending:
+                yield self._merge(*pending.popleft())
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
@@ -12,9 +12,19 @@ Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
 This module implements iterator functions to loop over arrays in chunks.
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import threading
 import numpy as np
 
 
+# The HDF5 library is not thread-safe: threads accessing HDF5 files
+# concurrently (e.g. background readers and writers) must hold this lock
+hdf5_lock = threading.RLock()
+
+
 def iter_chunksize(num_samples, chunksize):
     """Iterator used to iterate in chunks over an array of size `num_samples`.
     At each iteration returns `chunksize` except for the last iteration.
@@ -51,19 +61,302 @@ def iter_chunk_index(num_samples, chunksize):
         i += c_size
 
 
-def reduce_chunk(func, array):
+class ChunkReader(object):
+    """Read an on-disk array in chunks, reading ahead in a background thread.
+
+    While the consumer processes chunk k, a background thread reads (and
+    decompresses) the next chunks. The slices are read holding
+    `hdf5_lock`: other threads must hold the same lock while accessing
+    HDF5 files.
+
+    Arguments:
+        array: a pytables array (or an object with the same slicing
+            interface, `shape` and `dtype`, e.g. `SparseEmissionArray`).
+            Chunks are taken along the last axis.
+        queue_depth (int): maximum number of chunks read ahead. With 0,
+            chunks are read synchronously, with 1 the reads are
+            double-buffered.
+        max_memory (int or None): maximum size in bytes of the chunks read
+            ahead. The effective queue depth is reduced (down to 0) so that
+            `queue_depth * chunk_bytes <= max_memory`.
+    """
+
+    def __init__(self, array, queue_depth=2, max_memory=None):
+        self.array = array
+        self.queue_depth = queue_depth
+        self.max_memory = max_memory
+        self._executor = None
+        self._ahead = None
+
+    def chunk_bytes(self, chunksize):
+        """Size in bytes of a chunk of `chunksize` elements (last axis)."""
+        size = int(np.prod(self.array.shape[:-1])) * int(chunksize)
+        return size * np.dtype(self.array.dtype).itemsize
+
+    def depth(self, chunksize):
+        """Number of chunks of size `chunksize` to read ahead."""
+        depth = self.queue_depth
+        if self.max_memory is not None:
+            depth = min(depth, self.max_memory // self.chunk_bytes(chunksize))
+        return max(int(depth), 0)
+
+    def _read(self, start, stop):
+        with hdf5_lock:
+            return self.array[..., start:stop]
+
+    def iter_chunks(self, chunksize=None, start=0, stop=None):
+        """Iterate over the chunks of the array in [start, stop).
+
+        Arguments:
+            chunksize (int or None): size of each chunk (last axis). If
+                None, use `array.chunkshape[-1]`.
+            start, stop (int or None): range of the last axis to read.
+                If `stop` is None, read until the end of the array.
+
+        Yields:
+            Tuples (i_start, i_end, data), where `data` is
+            `array[..., i_start:i_end]`.
+        """
+        if chunksize is None:
+            chunksize = self.array.chunkshape[-1]
+        if stop is None:
+            stop = self.array.shape[-1]
+        index = ((start + i_start, start + i_end) for i_start, i_end
+                 in iter_chunk_index(max(stop - start, 0), chunksize))
+        depth = self.depth(chunksize)
+        if depth == 0:
+            for i_start, i_end in index:
+                yield i_start, i_end, self._read(i_start, i_end)
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque((i_start, i_end,
+                             executor.submit(self._read, i_start, i_end))
+                            for i_start, i_end in itertools.islice(index,
+                                                                   depth))
+            try:
+                while pending:
+                    i_start, i_end, future = pending.popleft()
+                    data = future.result()
+                    for i0, i1 in itertools.islice(index, 1):
+                        pending.append((i0, i1,
+                                        executor.submit(self._read, i0, i1)))
+                    yield i_start, i_end, data
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
+    def read(self, start, stop):
+        """Return `array[..., start:stop]` and read ahead the next window.
+
+        The window [stop, 2 * stop - start) is read in background (if the
+        queue depth allows it) and returned without waiting by the next
+        call with the same range. Used for scrolling through the array.
+        """
+        if self._ahead is not None and self._ahead[0] == (start, stop):
+            data = self._ahead[1].result()
+        else:
+            data = self._read(start, stop)
+        self._ahead = None
+        next_stop = min(2 * stop - start, self.array.shape[-1])
+        if next_stop > stop and self.depth(stop - start) > 0:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._ahead = ((stop, next_stop),
+                           self._executor.submit(self._read, stop, next_stop))
+        return data
+
+    def close(self):
+        """Stop the background thread used by `read()`."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._ahead = None
+
+
+def available_memory():
+    """Return the available physical memory in bytes (None if unknown).
+
+    Reads `MemAvailable` from /proc/meminfo (Linux) and falls back to the
+    number of free pages reported by `os.sysconf`.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class MemoryBudget(object):
+    """Derive the chunk sizes of a simulation from a memory budget.
+
+    The peak memory of a chunk of T time steps is estimated as::
+
+        T * (num_particles * (sample_bytes + queue_depth * queue_bytes)
+             + block_size * block_bytes)
+
+    where `sample_bytes` is the memory per particle and time step of the
+    arrays held for the whole chunk (e.g. the emission), `block_bytes` the
+    memory of the temporary arrays of a block of `block_size` particles
+    processed at once and `queue_bytes` the memory of each chunk waiting
+    in a read-ahead (or write-behind) queue.
+
+    The plan prefers long chunks: the time-chunk length is the largest
+    power of 2 fitting in the budget (up to `max_chunksize`). The queue
+    depth and then the block size are reduced only when a chunk of
+    `min_chunksize` time steps does not fit.
+
+    As a safeguard against memory pressure (e.g. other processes on the
+    same machine), the budget is capped to `memory_fraction` of the
+    memory available when the plan is computed and :meth:`shrink`
+    halves the chunk length when the available memory drops during the
+    simulation. When the memory available is not enough even for the
+    smallest plan, the smallest plan is used anyway.
+
+    Arguments:
+        max_memory (int): memory budget in bytes.
+        num_particles (int): number of particles.
+        sample_bytes (float): bytes per particle and time step of the
+            arrays held for the whole chunk.
+        block_bytes (float): bytes per particle and time step of the
+            temporary arrays of a block of particles.
+        queue_bytes (float): bytes per particle and time step of each
+            queued chunk.
+        queue_depth (int): maximum queue depth.
+        block_size (int or None): maximum block size. If None, all the
+            particles.
+        min_chunksize, max_chunksize (int): bounds of the time-chunk
+            length (powers of 2).
+        memory_fraction (float or None): fraction of the available memory
+            that can be used. If None, ignore the available memory.
+
+    Attributes:
+        t_chunksize, block_size, queue_depth (int): the planned sizes.
+    """
+
+    def __init__(self, max_memory, num_particles, sample_bytes,
+                 block_bytes=0, queue_bytes=0, queue_depth=0,
+                 block_size=None, min_chunksize=2**10, max_chunksize=2**22,
+                 memory_fraction=0.8):
+        self.max_memory = int(max_memory)
+        self.num_particles = int(num_particles)
+        self.sample_bytes = sample_bytes
+        self.block_bytes = block_bytes
+        self.queue_bytes = queue_bytes
+        self.min_chunksize = int(min_chunksize)
+        self.max_chunksize = int(max_chunksize)
+        self.memory_fraction = memory_fraction
+        if block_size is None:
+            block_size = self.num_particles
+        block_size = max(1, min(int(block_size), self.num_particles))
+        queue_depth = max(0, int(queue_depth))
+
+        if self.step_bytes(1, 0) * self.min_chunksize > self.max_memory:
+            raise ValueError(
+                'A chunk of %d time steps needs at least %d bytes, more '
+                'than the memory budget (%d bytes).' %
+                (self.min_chunksize, self.step_bytes(1, 0) *
+                 self.min_chunksize, self.max_memory))
+        memory = self.memory()
+        while True:
+            t_chunksize = self._fit_chunksize(memory, block_size, queue_depth)
+            if t_chunksize >= self.min_chunksize:
+                break
+            if queue_depth > 0:
+                queue_depth -= 1
+            elif block_size > 1:
+                block_size = (block_size + 1) // 2
+            else:
+                # Under memory pressure, use the smallest plan
+                t_chunksize = self.min_chunksize
+                break
+        self.t_chunksize = t_chunksize
+        self.block_size = block_size
+        self.queue_depth = queue_depth
+
+    def __repr__(self):
+        return ('MemoryBudget(max_memory=%d): t_chunksize=%d, block_size=%d, '
+                'queue_depth=%d' % (self.max_memory, self.t_chunksize,
+                                    self.block_size, self.queue_depth))
+
+    def memory(self):
+        """Memory usable by a chunk: the budget capped by the available."""
+        memory = self.max_memory
+        if self.memory_fraction is not None:
+            available = available_memory()
+            if available is not None:
+                memory = min(memory, int(available * self.memory_fraction))
+        return memory
+
+    def step_bytes(self, block_size=None, queue_depth=None):
+        """Estimated bytes per time step of a chunk."""
+        if block_size is None:
+            block_size = self.block_size
+        if queue_depth is None:
+            queue_depth = self.queue_depth
+        per_particle = self.sample_bytes + queue_depth * self.queue_bytes
+        return (self.num_particles * per_particle +
+                min(block_size, self.num_particles) * self.block_bytes)
+
+    def chunk_bytes(self, t_chunksize):
+        """Estimated peak memory of a chunk of `t_chunksize` time steps."""
+        return int(np.ceil(t_chunksize * self.step_bytes()))
+
+    def _fit_chunksize(self, memory, block_size, queue_depth):
+        step_bytes = self.step_bytes(block_size, queue_depth)
+        if step_bytes <= 0:
+            return self.max_chunksize
+        t_chunksize = min(int(memory // step_bytes), self.max_chunksize)
+        if t_chunksize < self.min_chunksize:
+            return t_chunksize
+        return 2**int(np.log2(t_chunksize))
+
+    def shrink(self, t_chunksize=None):
+        """Return a chunk length fitting in the memory available now.
+
+        `t_chunksize` (default `self.t_chunksize`) is halved, down to
+        `min_chunksize`, until a chunk fits in the memory returned by
+        :meth:`memory`. The result is stored in `self.t_chunksize`.
+        """
+        if t_chunksize is None:
+            t_chunksize = self.t_chunksize
+        memory = self.memory()
+        while (t_chunksize // 2 >= self.min_chunksize and
+               self.chunk_bytes(t_chunksize) > memory):
+            t_chunksize //= 2
+        self.t_chunksize = t_chunksize
+        return t_chunksize
+
+
+def reduce_chunk(func, array, queue_depth=0, max_memory=None):
     """Reduce with `func`, chunk by chunk, the passed pytable `array`.
+
+    With `queue_depth` > 0 the chunks are read ahead in a background
+    thread (see :class:`ChunkReader`).
     """
     res = []
-    for slice in iter_chunk_slice(array.shape[-1], array.chunkshape[-1]):
-        res.append(func(array[..., slice]))
+    reader = ChunkReader(array, queue_depth, max_memory)
+    for _, _, chunk in reader.iter_chunks():
+        res.append(func(chunk))
     return func(res)
 
 
-def map_chunk(func, array, out_array):
+def map_chunk(func, array, out_array, queue_depth=0, max_memory=None):
     """Map with `func`, chunk by chunk, the input pytable `array`.
     The result is stored in the output pytable array `out_array`.
+
+    With `queue_depth` > 0 the chunks are read ahead in a background
+    thread (see :class:`ChunkReader`).
     """
-    for slice in iter_chunk_slice(array.shape[-1], array.chunkshape[-1]):
-        out_array.append(func(array[..., slice]))
+    reader = ChunkReader(array, queue_depth, max_memory)
+    for _, _, chunk in reader.iter_chunks():
+        result = func(chunk)
+        with hdf5_lock:
+            out_array.append(result)
     return out_array
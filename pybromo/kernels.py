@@ -0,0 +1,225 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module contains the fused diffusion kernel used by the 'fused' engine
+of :class:`pybromo.diffusion.ParticlesSimulation`.
+
+The kernel takes the start position and the (already drawn) steps of a
+particle and, in a single pass over memory, computes the positions,
+applies the boundary conditions, interpolates the squared PSF (emission)
+and writes it as float32 in the output buffer. No full-size temporary
+array is created.
+
+When `numba` is installed, the kernel is JIT-compiled. Otherwise,
+a pure-numpy implementation processing the chunk in small time tiles
+(that fit in the CPU cache) is used.
+
+The emission is evaluated by bilinear interpolation of the table of the
+squared PSF returned by `NumericPSF.em_table()`, and is zero outside the
+table. This is the same function computed by `NumericPSF.eval_r2z_squared`,
+so the results of the fused engine are equal to the other engines up to
+floating point rounding.
+
+Samples outside the PSF support (r**2 > `r2_max` or |z| > `z_max`) are
+culled: their emission is set to zero without interpolating the table.
+The kernels return the number of culled samples.
+"""
+
+import numpy as np
+
+from .boundary import PERIODIC, MIRROR, periodic_inplace, mirror_inplace
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+has_numba = numba is not None
+
+
+def _fused_kernel(steps, start, bounds, boundary, u0, du, z0, dz, table,
+                  r2_index, r2_max, z_max, em, accumulate, pos, save_pos,
+                  radial):
+    """Single-pass diffusion, boundary conditions and PSF evaluation.
+
+    Arguments:
+        steps (array): float64 steps of one particle, shape (3, T).
+        start (array): float64 start position, shape (3,). Updated in-place
+            with the end position (after applying boundary conditions).
+        bounds (array): box boundaries, shape (3, 2).
+        boundary (int): `PERIODIC` or `MIRROR` boundary conditions.
+        u0, du, z0, dz (floats): origin and step of the table along the
+            radial (u) and the z axis (in um).
+        table (2D array): the squared PSF table, shape (num z values,
+            num u values), as returned by `NumericPSF.em_table()`.
+        r2_index (bool): if True, u is r**2 (um^2), otherwise u is r (um).
+        r2_max, z_max (floats): PSF support (m^2 and m). The emission of
+            samples with r**2 > r2_max or |z| > z_max is zero.
+        em (array): float32 output array for the emission, shape (T,).
+        accumulate (bool): if True add the emission to `em`.
+        pos (2D array): float32 output array for the positions, shape (3, T)
+            or (2, T) when `radial` is True. Ignored if `save_pos` is False.
+        save_pos, radial (bool): whether and how to save the positions.
+
+    Returns:
+        The number of culled samples.
+    """
+    nz, nu = table.shape
+    culled = 0
+    time_size = steps.shape[1]
+    if time_size == 0:
+        return culled   # `start` unchanged
+    p = np.empty(3)
+    w = np.empty(3)
+    p[0], p[1], p[2] = start[0], start[1], start[2]
+    for t in range(time_size):
+        for c in range(3):
+            p[c] += steps[c, t]
+            a1, a2 = bounds[c, 0], bounds[c, 1]
+            a = p[c]
+            if boundary == PERIODIC:
+                a = (a - a1) % (a2 - a1) + a1
+            else:
+                # Same operations of `boundary.mirror_inplace`
+                if a > a2:
+                    a = a2 - (a - a2)
+                if a < a1:
+                    a = a1 + (a1 - a)
+                if a < a1 or a > a2:
+                    size = a2 - a1
+                    a = a2 - abs((a - a1) % (2 * size) - size)
+            w[c] = a
+        r2 = w[0] * w[0] + w[1] * w[1]
+
+        # Bilinear interpolation of the squared PSF table (zero outside)
+        u = r2 * 1e12 if r2_index else np.sqrt(r2) * 1e6
+        fu = (u - u0) / du
+        fz = (w[2] * 1e6 - z0) / dz
+        v = 0.
+        if r2 > r2_max or abs(w[2]) > z_max:
+            culled += 1
+        elif fu >= 0 and fu <= nu - 1 and fz >= 0 and fz <= nz - 1:
+            iu = min(int(fu), nu - 2)
+            wu = fu - iu
+            iz = min(int(fz), nz - 2)
+            wz = fz - iz
+            v = ((1 - wz) * ((1 - wu) * table[iz, iu] +
+                             wu * table[iz, iu + 1]) +
+                 wz * ((1 - wu) * table[iz + 1, iu] +
+                       wu * table[iz + 1, iu + 1]))
+        if accumulate:
+            em[t] += np.float32(v)
+        else:
+            em[t] = v
+        if save_pos:
+            if radial:
+                pos[0, t] = np.sqrt(r2)
+                pos[1, t] = w[2]
+            else:
+                pos[0, t], pos[1, t], pos[2, t] = w[0], w[1], w[2]
+    start[0], start[1], start[2] = w[0], w[1], w[2]
+    return culled
+
+
+if has_numba:
+    _fused_kernel_jit = numba.njit(nogil=True)(_fused_kernel)
+
+
+def _interp_table(u, z, u0, du, z0, dz, table):
+    """Bilinear interpolation of the squared PSF table (zero outside).
+
+    `u` and `z` are arrays in the units of the table (see
+    :func:`_fused_kernel`).
+    """
+    nz, nu = table.shape
+    flat = table.ravel()
+    fu = (u - u0) / du
+    fz = (z - z0) / dz
+    outside = (fu < 0) | (fu > nu - 1) | (fz < 0) | (fz > nz - 1)
+    np.clip(fu, 0, nu - 1, out=fu)
+    np.clip(fz, 0, nz - 1, out=fz)
+    iu = np.minimum(fu.astype(np.intp), nu - 2)
+    iz = np.minimum(fz.astype(np.intp), nz - 2)
+    wu, wz = fu - iu, fz - iz
+    k = iz * nu + iu
+    v = ((1 - wz) * ((1 - wu) * flat[k] + wu * flat[k + 1]) +
+         wz * ((1 - wu) * flat[k + nu] + wu * flat[k + nu + 1]))
+    v[outside] = 0
+    return v
+
+
+def _fused_kernel_numpy(steps, start, bounds, boundary, u0, du, z0, dz,
+                        table, r2_index, r2_max, z_max, em, accumulate, pos,
+                        save_pos, radial, tile_size=2**13):
+    """Pure-numpy version of :func:`_fused_kernel`.
+
+    The chunk is processed in tiles of `tile_size` time steps, so that
+    all the temporary arrays are small and stay in the CPU cache.
+    Tiles entirely outside the PSF support skip the interpolation.
+    """
+    culled = 0
+    time_size = steps.shape[1]
+    if time_size == 0:
+        return culled   # `start` unchanged
+    p_start = start.reshape(3, 1).copy()
+    lo, hi = bounds[:, :1], bounds[:, 1:]
+    if boundary != PERIODIC:
+        mask = np.empty((2, 3, min(tile_size, time_size)), dtype=bool)
+    for i_start in range(0, time_size, tile_size):
+        i_end = min(i_start + tile_size, time_size)
+        p = np.cumsum(steps[:, i_start:i_end], axis=-1)
+        p += p_start
+        p_start = p[:, -1:].copy()
+        if boundary == PERIODIC:
+            periodic_inplace(p, lo, hi)
+        else:
+            mirror_inplace(p, lo, hi, mask=mask[..., :i_end - i_start])
+        r2 = p[0]**2 + p[1]**2
+
+        # Interpolate the squared PSF table only inside the PSF support
+        inside = (r2 <= r2_max) & (np.abs(p[2]) <= z_max)
+        num_inside = np.count_nonzero(inside)
+        culled += inside.size - num_inside
+        if num_inside == inside.size:
+            u = r2 * 1e12 if r2_index else np.sqrt(r2) * 1e6
+            v = _interp_table(u, p[2] * 1e6, u0, du, z0, dz, table)
+        else:
+            v = np.zeros(inside.size)
+            if num_inside > 0:
+                r2_in, z_in = r2[inside], p[2][inside]
+                u = r2_in * 1e12 if r2_index else np.sqrt(r2_in) * 1e6
+                v[inside] = _interp_table(u, z_in * 1e6, u0, du, z0, dz,
+                                          table)
+        if accumulate:
+            em[i_start:i_end] += v.astype(np.float32)
+        else:
+            em[i_start:i_end] = v
+        if save_pos:
+            if radial:
+                pos[0, i_start:i_end] = np.sqrt(r2)
+                pos[1, i_start:i_end] = p[2]
+            else:
+                pos[:, i_start:i_end] = p
+    start[:] = p[:, -1]
+    return culled
+
+
+def fused_kernel(use_numba=None):
+    """Return the fused kernel function.
+
+    Arguments:
+        use_numba (bool or None): if None, use the numba kernel when numba
+            is installed, otherwise use the numpy kernel. If True, raise
+            an error if numba is not installed.
+    """
+    if use_numba is None:
+        use_numba = has_numba
+    if use_numba:
+        if not has_numba:
+            raise ImportError('The numba kernel requires numba.')
+        return _fused_kernel_jit
+    return _fused_kernel_numpy
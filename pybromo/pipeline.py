@@ -0,0 +1,500 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module implements a streaming pipeline to compose the simulation
+stages chunk by chunk.
+
+A pipeline is made of:
+
+- a *producer*: a generator of chunks. A chunk is a dict with the time
+  index range of the chunk ('i_start', 'i_end') and the arrays computed
+  so far: 'emission' (shape (num_particles, T)), 'emission_tot'
+  (shape (T,)), 'position' (list of position arrays, one per particle)
+  and 'timestamps' (a dict of channel name -> (timestamps, particles)).
+  The producers are :func:`diffusion_chunks` (simulates the diffusion)
+  and :func:`emission_chunks` (reads the stored emission).
+- zero or more *stages*: callables taking an iterable of chunks and
+  returning a generator of chunks with new items added
+  (:class:`Photons`, :class:`ChannelSplit`, :func:`progress`).
+- one or more *sinks*: objects with the methods `append(chunk)` and
+  `close()` (:class:`TrajectorySink`, :class:`TimestampSink`,
+  :class:`PhotonHDF5Sink` and :class:`MemorySink`). A sink can be wrapped
+  in a :class:`ThreadedSink` to write the chunks in a background thread.
+
+The chunks are generated lazily: only one chunk is in memory at any time
+and the random numbers are drawn in the same order of a loop performing
+all the stages on one chunk before simulating the next one.
+
+Example:
+
+    chunks = diffusion_chunks(S, rs, t_chunksize=2**16)
+    chunks = Photons('d', S, max_rates_d, populations, bg_rate_d, rs)(chunks)
+    chunks = Photons('a', S, max_rates_a, populations, bg_rate_a, rs)(chunks)
+    sink = MemorySink(['d', 'a'])
+    run(chunks, sink)
+    ts_d, par_d = sink.timestamps['d']
+"""
+
+import queue
+import threading
+import numpy as np
+
+from .iter_chunks import ChunkReader, hdf5_lock
+from .boundary import wrap_periodic
+from .sampling import CountsBuffer
+from . import rng
+from ._version import get_versions
+__version__ = get_versions()['version']
+
+
+def run(chunks, *sinks):
+    """Consume `chunks` appending each chunk to all the `sinks`.
+
+    After the last chunk, the `close()` method of each sink is called.
+    Returns the list of sinks.
+    """
+    try:
+        for chunk in chunks:
+            for sink in sinks:
+                sink.append(chunk)
+    except BaseException:
+        # Stop the background writers before propagating the error
+        for sink in sinks:
+            if isinstance(sink, ThreadedSink):
+                sink.join()
+        raise
+    for sink in sinks:
+        sink.close()
+    return list(sinks)
+
+
+##
+#  Producers
+#
+
+def diffusion_chunks(S, rs, t_chunksize, num_samples=None, i_start=0,
+                     start_pos=None, sim_trajectories=None,
+                     total_emission=False, save_pos=False, radial=False,
+                     wrap_func=wrap_periodic, budget=None, **engine_kw):
+    """Generate chunks by simulating the diffusion of the particles in `S`.
+
+    Arguments:
+        S (ParticlesSimulation): the simulation object.
+        rs (RandomState, Generator or StreamSet): random number generator.
+        t_chunksize (int): number of time steps of each chunk.
+        num_samples (int or None): number of time steps to simulate.
+            If None, simulate until `S.n_samples`.
+        i_start (int): time index of the first chunk.
+        start_pos (array or None): start positions, shape
+            (num_particles, 3, 1), updated in-place at each chunk.
+            If None, start from `S.particles.positions`.
+        sim_trajectories (callable or None): function simulating a chunk
+            (see :meth:`ParticlesSimulation._get_sim_trajectories`). If
+            None, it is created passing `engine_kw` (e.g. `engine`,
+            `block_size`, `dtype`, `psf_support`, `jump_size`).
+        total_emission, save_pos, radial, wrap_func: see
+            :meth:`ParticlesSimulation.simulate_diffusion`.
+        budget (MemoryBudget or None): if not None, before each chunk
+            `t_chunksize` is reduced when the memory available is not
+            enough (see :meth:`iter_chunks.MemoryBudget.shrink`).
+
+    Yields:
+        Chunks with 'emission' (or 'emission_tot' when `total_emission`
+        is True) and, if `save_pos` is True, 'position'.
+    """
+    if sim_trajectories is None:
+        sim_trajectories = S._get_sim_trajectories(**engine_kw)
+    if num_samples is None:
+        num_samples = S.n_samples - i_start
+    if start_pos is None:
+        start_pos = S.particles.positions
+    i_stop = i_start + int(num_samples)
+    while i_start < i_stop:
+        if budget is not None:
+            t_chunksize = budget.shrink(t_chunksize)
+        time_size = min(int(t_chunksize), i_stop - i_start)
+        POS, em = sim_trajectories(time_size, start_pos, rs,
+                                   total_emission=total_emission,
+                                   save_pos=save_pos, radial=radial,
+                                   wrap_func=wrap_func)
+        chunk = dict(i_start=i_start, i_end=i_start + time_size)
+        chunk['emission_tot' if total_emission else 'emission'] = em
+        if save_pos:
+            chunk['position'] = POS
+        yield chunk
+        i_start += time_size
+
+
+def emission_chunks(S, t_chunksize=None, num_samples=None, i_start=0,
+                    queue_depth=0, max_memory=None):
+    """Generate chunks reading the emission stored in `S.emission`.
+
+    Arguments:
+        S (ParticlesSimulation): the simulation object.
+        t_chunksize (int or None): number of time steps of each chunk.
+            If None, use the chunk size of the on-disk array.
+        num_samples (int or None): number of time steps to read.
+            If None, read until `S.n_samples`.
+        i_start (int): time index of the first chunk.
+        queue_depth (int): number of chunks read ahead (and decompressed)
+            in a background thread. If 0, read each chunk when requested.
+        max_memory (int or None): maximum bytes of the chunks read ahead.
+            See :class:`iter_chunks.ChunkReader`.
+
+    Yields:
+        Chunks with 'emission'.
+    """
+    if num_samples is None:
+        num_samples = S.n_samples - i_start
+    reader = ChunkReader(S.emission, queue_depth, max_memory)
+    for i_start, i_end, emission in reader.iter_chunks(
+            t_chunksize, i_start, i_start + int(num_samples)):
+        yield dict(i_start=i_start, i_end=i_end, emission=emission)
+
+
+##
+#  Stages
+#
+
+def progress(chunks, t_step, decimals=1):
+    """Stage printing the time at the start of each chunk (in seconds)."""
+    prev_time = 0
+    for chunk in chunks:
+        curr_time = np.around(chunk['i_start'] * t_step, decimals=decimals)
+        if curr_time > prev_time:
+            print(' %.1fs' % curr_time, end='', flush=True)
+            prev_time = curr_time
+        yield chunk
+
+
+class Photons(object):
+    """Stage simulating the photons of a mixture of populations.
+
+    The timestamps are computed from the chunk 'emission' (not modified)
+    as in :meth:`ParticlesSimulation.simulate_timestamps_mix` and stored
+    in `chunk['timestamps'][name]`.
+
+    Arguments:
+        name (string): name of the channel.
+        S (ParticlesSimulation): the simulation object.
+        max_rates (list): peak emission rate of each population.
+        populations (list of slices): particles in each population.
+        bg_rate (float or None): rate of the Poisson background (cps).
+        rs (RandomState or Generator): random number generator.
+        scale (int): timestamps unit is `S.t_step / scale`.
+        sampler (string): 'dense', 'sparse' or 'thinning', the photon
+            sampler (see :meth:`ParticlesSimulation._sim_timestamps`).
+        counts_dtype (string): 'uint8' or 'uint16', dtype of the counts
+            buffer reused for each chunk by the 'dense' sampler.
+        overflow (string): policy for counts not fitting `counts_dtype`
+            (see :func:`sampling.sim_counts`).
+    """
+
+    def __init__(self, name, S, max_rates, populations, bg_rate, rs,
+                 scale=10, sampler='dense', counts_dtype='uint8',
+                 overflow='promote'):
+        self.name = name
+        self.S = S
+        self.max_rates = max_rates
+        self.populations = populations
+        self.bg_rate = bg_rate
+        self.rs = rs
+        self.scale = scale
+        self.sampler = sampler
+        self.counts_buffer = CountsBuffer(counts_dtype)
+        self.overflow = overflow
+
+    def __call__(self, chunks):
+        bg_rates = [None] * (len(self.max_rates) - 1) + [self.bg_rate]
+        for chunk in chunks:
+            timestamps = chunk.setdefault('timestamps', {})
+            timestamps[self.name] = self.S._sim_timestamps_populations(
+                chunk['emission'], self.max_rates, self.populations,
+                bg_rates, chunk['i_start'], self.rs, self.scale,
+                self.sampler, self.counts_buffer, self.overflow)
+            yield chunk
+
+
+class ChannelSplit(object):
+    """Stage splitting the photons of a channel in several channels.
+
+    Each photon of particle `p` goes to channel `names[k]` with probability
+    `probs[k][p]`. For example, with a FRET efficiency `E[p]` for each
+    particle, `probs = [1 - E, E]` splits the photons in donor and
+    acceptor channels.
+
+    Arguments:
+        source (string): name of the channel to split.
+        names (list of strings): names of the output channels.
+        probs (2D array): shape (len(names), num_particles + 1), probability
+            for each particle (including the background particle) of
+            each output channel. The probabilities of each particle must
+            sum to 1.
+        rs (RandomState or Generator): random number generator.
+        keep_source (bool): if False, remove the source channel.
+    """
+
+    def __init__(self, source, names, probs, rs, keep_source=False):
+        probs = np.asarray(probs, dtype='float64')
+        if probs.shape[0] != len(names):
+            raise ValueError('`probs` must have one row per channel.')
+        if not np.allclose(probs.sum(0), 1):
+            raise ValueError('The probabilities of each particle must '
+                             'sum to 1.')
+        self.source = source
+        self.names = names
+        self.cum_probs = np.cumsum(probs, axis=0)[:-1]
+        self.rs = rs
+        self.keep_source = keep_source
+
+    def __call__(self, chunks):
+        for chunk in chunks:
+            timestamps = chunk['timestamps']
+            if self.keep_source:
+                times, particles = timestamps[self.source]
+            else:
+                times, particles = timestamps.pop(self.source)
+            u = rng.uniform(self.rs, times.size)
+            channel = (u >= self.cum_probs[:, particles]).sum(0)
+            for ich, name in enumerate(self.names):
+                mask = channel == ich
+                timestamps[name] = times[mask], particles[mask]
+            yield chunk
+
+
+##
+#  Sinks
+#
+
+class TrajectorySink(object):
+    """Sink appending emission and positions to the trajectory store of `S`.
+    """
+
+    def __init__(self, S):
+        self.S = S
+
+    def append(self, chunk):
+        S = self.S
+        if 'position' in chunk:
+            position = np.vstack(chunk['position']).astype('float32')
+        with hdf5_lock:
+            if 'emission' in chunk:
+                S.emission.append(chunk['emission'])
+            if 'emission_tot' in chunk:
+                S.emission_tot.append(chunk['emission_tot'])
+            if 'position' in chunk:
+                S.position.append(position)
+            S.store.h5file.flush()
+
+    def close(self):
+        with hdf5_lock:
+            self.S.store.h5file.flush()
+
+
+class TimestampSink(object):
+    """Sink appending timestamps to on-disk arrays.
+
+    Arguments:
+        arrays (dict): channel name -> (timestamps, particles) pytables
+            arrays, as returned by `TimestampStore.add_timestamps()`.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def append(self, chunk):
+        with hdf5_lock:
+            for name, (ts_array, par_array) in self.arrays.items():
+                times, particles = chunk['timestamps'][name]
+                ts_array.append(times)
+                par_array.append(particles)
+
+    def close(self):
+        with hdf5_lock:
+            for ts_array, _ in self.arrays.values():
+                ts_array._v_file.flush()
+
+
+class ThreadedSink(object):
+    """Wrap a sink to append the chunks in a background writer thread.
+
+    `append()` puts the chunk in a bounded queue (blocking when the queue
+    is full) and returns, so the next chunk is computed while the writer
+    thread appends (i.e. compresses and writes) the queued chunks. Only the
+    writer thread calls `sink.append()`, holding `hdf5_lock` (the on-disk
+    sinks take the same lock, so they can also be used without this
+    wrapper while a :class:`iter_chunks.ChunkReader` reads ahead).
+    An exception raised in the writer thread is raised again by the next
+    call to `append()`, `wait()` or `close()`.
+
+    Arguments:
+        sink: the sink to wrap.
+        queue_size (int): maximum number of chunks waiting to be written.
+            With 1 (default) the writes are double-buffered.
+    """
+
+    def __init__(self, sink, queue_size=1):
+        self.sink = sink
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            chunk = self.queue.get()
+            try:
+                if chunk is None:
+                    return
+                if self.error is None:
+                    with hdf5_lock:
+                        self.sink.append(chunk)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def append(self, chunk):
+        self._raise_error()
+        self.queue.put(chunk)
+
+    def wait(self):
+        """Wait until all the queued chunks have been written."""
+        self.queue.join()
+        self._raise_error()
+
+    def join(self):
+        """Write the queued chunks and stop the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def close(self):
+        self.join()
+        self._raise_error()
+        self.sink.close()
+
+
+class MemorySink(object):
+    """Sink collecting timestamps in memory.
+
+    After `close()`, `self.timestamps` is a dict of channel name ->
+    (timestamps, particles) arrays.
+
+    Arguments:
+        names (list of strings): names of the channels to collect.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._chunks = {name: [] for name in self.names}
+        self.timestamps = {}
+
+    def append(self, chunk):
+        for name in self.names:
+            self._chunks[name].append(chunk['timestamps'][name])
+
+    def close(self):
+        for name, chunks in self._chunks.items():
+            if len(chunks) == 0:
+                chunks = [(np.array([], dtype='int64'),
+                           np.array([], dtype='uint8'))]
+            times, particles = zip(*chunks)
+            self.timestamps[name] = np.hstack(times), np.hstack(particles)
+        self._chunks = {name: [] for name in self.names}
+
+
+class PhotonHDF5Sink(MemorySink):
+    """Sink saving the timestamps of one or more channels to Photon-HDF5.
+
+    The timestamps of all the channels are merged and the detector of
+    each photon is the index of its channel in `names`. The file is written
+    by `close()` using `phconvert`.
+
+    Arguments:
+        filename (string or Path): the Photon-HDF5 file name.
+        names (list of strings): names of the channels (detectors 0, 1, ...).
+        clk_p (float): timestamps unit in seconds.
+        acquisition_duration (float): measurement duration in seconds.
+        description (string): description saved in the file.
+        setup (dict or None): the Photon-HDF5 `/setup` group. If None,
+            use a single-spot setup with one spectral channel per detector.
+        measurement_specs (dict or None): the Photon-HDF5
+            `/photon_data/measurement_specs`. If None and there are 2
+            channels, use 'smFRET' (donor first, acceptor second).
+        identity (dict or None): the Photon-HDF5 `/identity` group.
+        provenance (dict or None): the Photon-HDF5 `/provenance` group.
+            If None, the provenance filename is `filename`.
+        overwrite (bool): if True overwrite an existing file.
+    """
+
+    def __init__(self, filename, names, clk_p, acquisition_duration,
+                 description='', setup=None, measurement_specs=None,
+                 identity=None, provenance=None, overwrite=True):
+        super().__init__(names)
+        num_ch = len(self.names)
+        if measurement_specs is None:
+            if num_ch != 2:
+                raise ValueError('`measurement_specs` is required for %d '
+                                 'channels.' % num_ch)
+            measurement_specs = dict(
+                measurement_type = 'smFRET',
+                detectors_specs = dict(spectral_ch1 = np.atleast_1d(0),
+                                       spectral_ch2 = np.atleast_1d(1)))
+        if setup is None:
+            setup = dict(
+                num_pixels = num_ch,
+                num_spots = 1,
+                num_spectral_ch = num_ch,
+                num_polarization_ch = 1,
+                num_split_ch = 1,
+                modulated_excitation = False,
+                lifetime = False)
+        self.filename = str(filename)
+        if provenance is None:
+            provenance = dict(filename=self.filename, software='PyBroMo',
+                              software_version=__version__)
+        self.clk_p = clk_p
+        self.acquisition_duration = acquisition_duration
+        self.description = description
+        self.setup = setup
+        self.measurement_specs = measurement_specs
+        self.identity = identity if identity is not None else dict()
+        self.provenance = provenance
+        self.overwrite = overwrite
+
+    def close(self):
+        import phconvert as phc
+
+        super().close()
+        ts_list, det_list, par_list = [], [], []
+        for ich, name in enumerate(self.names):
+            times, particles = self.timestamps[name]
+            ts_list.append(times)
+            par_list.append(particles)
+            det_list.append(np.full(times.size, ich, dtype='uint8'))
+        ts = np.hstack(ts_list)
+        index_sort = ts.argsort(kind='mergesort')
+        photon_data = dict(
+            timestamps = ts[index_sort],
+            timestamps_specs = dict(timestamps_unit=self.clk_p),
+            detectors = np.hstack(det_list)[index_sort],
+            particles = np.hstack(par_list)[index_sort],
+            measurement_specs = self.measurement_specs)
+        data = dict(
+            acquisition_duration = round(self.acquisition_duration),
+            description = self.description,
+            photon_data = photon_data,
+            setup = self.setup,
+            provenance = self.provenance,
+            identity = self.identity)
+        phc.hdf5.save_photon_hdf5(data, h5_fname=self.filename,
+                                  overwrite=self.overwrite)
@@ -6,6 +6,8 @@ from matplotlib import cm
 import seaborn as sns
 sns.set_style('whitegrid')
 
+from .iter_chunks import ChunkReader, hdf5_lock
+
 
 class ScrollPlotter:
     """Base class for plots scrolling with a QT scrollbar."""
@@ -28,6 +30,8 @@ class ScrollPlotter:
         self.smax = self.time_size
 
         self.create_figure()
+        # Stop the emission reader thread when the figure is closed
+        self.fig.canvas.mpl_connect('close_event', self.close)
         # Retrive the QMainWindow used by current figure and add a toolbar
         # to host the new widgets
         QMainWin = self.fig.canvas.parent()
@@ -60,6 +64,12 @@ class ScrollPlotter:
         slice_ = (pos, pos + self.duration_steps, self.decimate)
         self.update(slice_)
 
+    def close(self, event=None):
+        """Stop the background thread of the emission reader (if any)."""
+        reader = getattr(self, 'reader', None)
+        if reader is not None:
+            reader.close()
+
     def create_figure(self):
         pass
 
@@ -78,6 +88,7 @@ class EmissionPlotter(ScrollPlotter):
         self.particles = particles
         self.color_pop = color_pop
         self.S = S
+        self.reader = ChunkReader(S.emission, queue_depth=1)
         super().__init__(S.n_samples, duration, S.t_step, decimate)
 
     def create_figure(self):
@@ -118,7 +129,7 @@ class EmissionPlotter(ScrollPlotter):
             slice_ = (0, self.duration_steps, self.decimate)
         slice_ = slice(*slice_[:2])
         assert (slice_.stop - slice_.start) // self.decimate == self.num_points
-        emission = self.S.emission[:, slice_]
+        emission = self.reader.read(slice_.start, slice_.stop)
         dec_shape = (emission.shape[0], emission.shape[1] // self.decimate,
                      self.decimate)
         emission = emission.reshape(*dec_shape).max(axis=-1)
@@ -140,6 +151,7 @@ class TrackEmPlotterR(ScrollPlotter):
             particles = list(range(S.num_particles))
         self.particles = particles
         self.S = S
+        self.reader = ChunkReader(S.emission, queue_depth=1)
         self.position = S.position
         self.color_pop = color_pop
         super().__init__(S.n_samples, duration, S.t_step, decimate)
@@ -206,8 +218,9 @@ class TrackEmPlotterR(ScrollPlotter):
             slice_ = (0, self.duration_steps, self.decimate)
         slice_ = slice(*slice_)
         assert (slice_.stop - slice_.start) // self.decimate == self.num_points
-        pos = self.position[:, :, slice_]
-        emission = self.S.emission[:, slice_]
+        with hdf5_lock:
+            pos = self.position[:, :, slice_]
+        emission = self.reader.read(slice_.start, slice_.stop)
 
         self.fig.canvas.restore_region(self.background)
         for ip, l_rz, l_em in zip(self.particles,
@@ -231,6 +244,7 @@ class TrackEmPlotter(ScrollPlotter):
             particles = list(range(S.num_particles))
         self.particles = particles
         self.S = S
+        self.reader = ChunkReader(S.emission, queue_depth=1)
         self.position = S.position
         self.color_pop = color_pop
         super().__init__(S.n_samples, duration, S.t_step, decimate)
@@ -311,8 +325,9 @@ class TrackEmPlotter(ScrollPlotter):
             slice_ = (0, self.duration_steps, self.decimate)
         slice_ = slice(*slice_)
         assert (slice_.stop - slice_.start) // self.decimate == self.num_points
-        pos = self.position[:, :, slice_]
-        emission = self.S.emission[:, slice_]
+        with hdf5_lock:
+            pos = self.position[:, :, slice_]
+        emission = self.reader.read(slice_.start, slice_.stop)
 
         self.fig.canvas.restore_region(self.background)
         for ip, l_xy, l_zy, l_em in zip(self.particles,
@@ -19,58 +19,167 @@ import scipy.interpolate as SI
 import numexpr as NE
 import numpy as np
 import hashlib
-import collections
+
+
+def _hash_attributes(obj, extra=()):
+    """Return an hash string computed on the (non-callable) attributes.
+
+    Private attributes (i.e. derived data, like lookup tables) are skipped.
+    The strings in `extra` are appended to the hashed values.
+    """
+    hash_list = []
+    for key, value in sorted(obj.__dict__.items()):
+        if not callable(value) and not key.startswith('_'):
+            if isinstance(value, np.ndarray):
+                hash_list.append(value.tobytes())
+            else:
+                hash_list.append(str(value))
+    hash_list.extend(extra)
+    return hashlib.md5(repr(hash_list).encode()).hexdigest()
 
 
 class GaussianPSF:
-    """This class implements a Gaussian-shaped PSF function."""
+    """This class implements a Gaussian-shaped PSF function.
+
+    To be used in a simulation, the center and sigmas must be in meters
+    and the PSF must be rotationally symmetric around z (i.e. `xc` = `yc`
+    = 0 and `sx` = `sy`). In this case :meth:`eval_xz_squared` computes the
+    emission-detection profile (the squared PSF) with a single precompiled
+    numexpr expression, without any interpolation.
+    """
 
-    def __init__(self, xc=0, yc=0, zc=0, sx=1, sy=1, sz=1):
+    # numexpr expressions, compiled on first use and then cached by numexpr
+    _expr = ('exp(-((x - xc)**2 / (2 * sx**2) + (y - yc)**2 / (2 * sy**2) + '
+             '(z - zc)**2 / (2 * sz**2)))')
+    _expr_xz = 'exp(-(x**2 / (2 * sx**2) + (z - zc)**2 / (2 * sz**2)))'
+    _expr_xz_squared = 'exp(-(x**2 / sx**2 + (z - zc)**2 / sz**2))'
+    _expr_r2z_squared = 'exp(-(r2 / sx**2 + (z - zc)**2 / sz**2))'
+
+    def __init__(self, xc=0, yc=0, zc=0, sx=1, sy=1, sz=1,
+                 psf_pytables=None):
         """Create a Gaussian PSF object with given center and sigmas.
         `xc`, `yc`, `zc`: position of hte center of the gaussian
         `sx`, `sy`, `sz`: sigmas of the gaussian function.
+
+        If `psf_pytables` is not None, the parameters are loaded from
+        this pytables node (see :meth:`to_hdf5`).
         """
+        if psf_pytables is not None:
+            xc, yc, zc, sx, sy, sz = [psf_pytables.get_attr(name) for name in
+                                      ('xc', 'yc', 'zc', 'sx', 'sy', 'sz')]
+        xc, yc, zc, sx, sy, sz = [float(v) for v in (xc, yc, zc, sx, sy, sz)]
         self.xc, self.yc, self.zc = xc, yc, zc
         self.rc = np.array([xc, yc, zc])
         self.sx, self.sy, self.sz = sx, sy, sz
         self.s = np.array([sx, sy, sz])
         self.kind = "gauss"
+        self.fname = 'gaussian_psf'
+
+    def _params(self):
+        return dict(xc=self.xc, yc=self.yc, zc=self.zc,
+                    sx=self.sx, sy=self.sy, sz=self.sz)
+
+    def _check_symmetric(self):
+        if self.xc != 0 or self.yc != 0 or self.sx != self.sy:
+            raise ValueError('The PSF is not rotationally symmetric around '
+                             'z (requires xc = yc = 0 and sx = sy).')
 
     def eval(self, x, y, z):
         """Evaluate the function in (x, y, z)."""
-        xc, yc, zc = self.rc
-        sx, sy, sz = self.s
+        return NE.evaluate(self._expr,
+                           local_dict=dict(x=x, y=y, z=z, **self._params()))
 
-        ## Method1: direct evaluation
-        #return exp(-(((x-xc)**2)/(2*sx**2) + ((y-yc)**2)/(2*sy**2) +\
-        #        ((z-zc)**2)/(2*sz**2)))
+    def eval_xz(self, x, z):
+        """Evaluate the function in (x, z), where x is the radial position.
+        The function must be rotationally symmetric around z.
+        """
+        self._check_symmetric()
+        params = self._params()
+        return NE.evaluate(self._expr_xz,
+                           local_dict=dict(x=x, z=z, zc=params['zc'],
+                                           sx=params['sx'], sz=params['sz']))
+
+    def eval_xz_squared(self, x, z):
+        """Evaluate the squared function (emission-detection profile)
+        in (x, z), where x is the radial position.
 
-        ## Method2: evaluation using numexpr
-        def arg(s):
-            return "((%s-%sc)**2)/(2*s%s**2)" % (s, s, s)
-        return NE.evaluate("exp(-(%s + %s + %s))" %
-                           (arg("x"), arg("y"), arg("z")))
+        This is computed analytically, in a single pass on the input arrays.
+        """
+        self._check_symmetric()
+        params = self._params()
+        return NE.evaluate(self._expr_xz_squared,
+                           local_dict=dict(x=x, z=z, zc=params['zc'],
+                                           sx=params['sx'], sz=params['sz']))
+
+    def eval_r2z_squared(self, r2, z):
+        """Evaluate the squared function (emission-detection profile)
+        in (r2, z), where r2 is the squared radial position.
+        """
+        self._check_symmetric()
+        params = self._params()
+        return NE.evaluate(self._expr_r2z_squared,
+                           local_dict=dict(r2=r2, z=z, zc=params['zc'],
+                                           sx=params['sx'], sz=params['sz']))
+
+    def to_hdf5(self, file_handle, parent_node='/'):
+        """Store the PSF parameters in `file_handle` (pytables) in
+        `parent_node`.
+
+        The parameters are saved in an array named `fname` (in the order
+        xc, yc, zc, sx, sy, sz) and as attributes of the same array.
+        """
+        params = self._params()
+        names = ('xc', 'yc', 'zc', 'sx', 'sy', 'sz')
+        tarray = file_handle.create_array(
+            parent_node, name=self.fname,
+            obj=np.array([params[name] for name in names]),
+            title='Gaussian PSF parameters (xc, yc, zc, sx, sy, sz)')
+        for name in names:
+            file_handle.set_node_attr(tarray, name, params[name])
+        file_handle.set_node_attr(tarray, 'kind', self.kind)
+        return tarray
 
-        ## Method3: evaluation with partial function
-        #g_arg = lambda t, mu, sig: -((t-mu)**2)/(2*sig**2)
-        #return exp(g_arg(x, xc, sx) + g_arg(y, yc, sy) + g_arg(z, zc, sz))
+    def hash(self):
+        """Return an hash string computed on the PSF parameters."""
+        return _hash_attributes(self)
 
 
 class NumericPSF:
+    """A rotationally symmetric PSF interpolated from numeric (PSFLab) data.
+
+    In simulations, the emission-detection profile (the squared PSF) is
+    computed by default squaring the (bilinear) spline interpolation of
+    the PSF. When `table` is True, it is computed instead from a table
+    of PSF**2 on a uniform grid, by bilinear interpolation with direct
+    index arithmetic (see :meth:`eval_r2z_squared`), as in the 'fused'
+    engine. The table is indexed either by the radial position r (the
+    PSFLab grid) or, when `r2_index` is True, by r**2 (so that no square
+    root needs to be computed). Outside the table the squared PSF is zero.
+    The two methods give slightly different emission, so `table` and
+    `r2_index` are part of the PSF hash (when True).
+    """
+
     def __init__(self, fname='xz_realistic_z50_150_160_580nm_n1335_HR2',
                  dir_=None, x_step=0.5 / 8, z_step=0.5 / 8,
-                 psf_pytables=None):
+                 psf_pytables=None, table=False, r2_index=False):
         """Create a PSF object for interpolation from numeric data.
 
         `dir_+fname`: should be a valid path
 
         If `dir_` is None use the "system" folder where the PSF shipped with
         pybromo are placed.
+
+        If `table` is True, the squared PSF is evaluated from a table of
+        PSF**2. If `r2_index` is True (implies `table`), the table is
+        indexed by r**2 (with a step of `x_step`**2) instead of r.
         """
         if psf_pytables is not None:
             self.psflab_psf_raw = psf_pytables[:]
             for name in ['fname', 'dir_', 'x_step', 'z_step']:
                 setattr(self, name, psf_pytables.get_attr(name))
+            attrs = psf_pytables.attrs
+            table = 'table' in attrs and bool(attrs['table'])
+            r2_index = 'r2_index' in attrs and bool(attrs['r2_index'])
         else:
             self.fname = fname
             if dir_ is None:
@@ -89,6 +198,45 @@ class NumericPSF:
         self.xi, self.zi, self.hdata, self.zm = xi, zi, hdata, zm
         self.x_step, self.z_step = xi[1] - xi[0], zi[1] - zi[0]
         self.kind = 'numeric'
+        self._r2_index = bool(r2_index)
+        self._table = bool(table) or self._r2_index
+        self._init_em_table()
+
+    @property
+    def table(self):
+        """True if the squared PSF is evaluated from a table of PSF**2."""
+        return self._table
+
+    @property
+    def r2_index(self):
+        """True if the table of PSF**2 is indexed by r**2."""
+        return self._r2_index
+
+    def _init_em_table(self):
+        """Compute the table of the squared PSF used by `eval_r2z_squared`.
+        """
+        if self._r2_index:
+            # Uniform grid in r**2 (um^2), resampled from the PSFLab grid
+            u_step = self.x_step**2
+            u = np.arange(int(round(self.xi[-1]**2 / u_step)) + 1) * u_step
+            table = self._fun_um(np.sqrt(u), self.zi).T**2
+        else:
+            u_step = self.x_step
+            table = self.hdata**2
+        self._em_table = np.ascontiguousarray(table, dtype=np.float64)
+        self._em_u_step = u_step
+
+    def em_table(self):
+        """Return the table of the squared PSF and its grid parameters.
+
+        Returns:
+            A tuple (table, u0, u_step, z0, z_step, r2_index). `table` is a
+            2D array of shape (num z values, num u values) where u is r
+            (um) or, if `r2_index` is True, r**2 (um^2). `u0`, `z0` are the
+            first grid values and `u_step`, `z_step` the grid steps.
+        """
+        return (self._em_table, 0., self._em_u_step, self.zi[0],
+                self.z_step, self._r2_index)
 
     def eval_xz(self, x, z):
         """Evaluate the function in (x, z) (micro-meters).
@@ -96,6 +244,43 @@ class NumericPSF:
         """
         return self._fun_um.ev(x * 1e6, z * 1e6)
 
+    def eval_xz_squared(self, x, z):
+        """Evaluate the squared function (emission-detection profile)
+        in (x, z) (meters), where x is the radial position.
+        """
+        if not self._table:
+            return self.eval_xz(x, z)**2
+        return self.eval_r2z_squared(x**2, z)
+
+    def eval_r2z_squared(self, r2, z):
+        """Evaluate the squared function (emission-detection profile)
+        in (r2, z) (meters), where r2 is the squared radial position.
+
+        If `table` is False, squares the spline interpolation of the PSF.
+        Otherwise, uses bilinear interpolation of the table of the squared
+        PSF and returns zero outside the table.
+        """
+        if not self._table:
+            return self.eval_xz(np.sqrt(r2), z)**2
+        table, u0, u_step, z0, z_step, r2_index = self.em_table()
+        nz, nu = table.shape
+        u = r2 * 1e12 if r2_index else np.sqrt(r2) * 1e6
+        fu = np.asarray((u - u0) / u_step, dtype=np.float64)
+        fz = np.asarray((z * 1e6 - z0) / z_step, dtype=np.float64)
+        outside = (fu < 0) | (fu > nu - 1) | (fz < 0) | (fz > nz - 1)
+        np.clip(fu, 0, nu - 1, out=fu)
+        np.clip(fz, 0, nz - 1, out=fz)
+        iu = np.minimum(fu.astype(np.intp), nu - 2)
+        iz = np.minimum(fz.astype(np.intp), nz - 2)
+        wu, wz = fu - iu, fz - iz
+        # Index of the lower-left grid point in the flattened table
+        k = iz * nu + iu
+        flat = table.ravel()
+        em = ((1 - wz) * ((1 - wu) * flat[k] + wu * flat[k + 1]) +
+              wz * ((1 - wu) * flat[k + nu] + wu * flat[k + nu + 1]))
+        em[outside] = 0
+        return em
+
     def eval(self, x, y, z):
         """Evaluate the function in (x, y, z).
         The function is rotationally symmetric around z.
@@ -109,25 +294,33 @@ class NumericPSF:
         """Store the PSF data in `file_handle` (pytables) in `parent_node`.
 
         The raw PSF array name is stored with same name as the original fname.
-        Also, the following attribues are set: fname, dir_, x_step, z_step.
+        Also, the following attribues are set: fname, dir_, x_step, z_step
+        and, when True, table and r2_index.
         """
         tarray = file_handle.create_array(parent_node, name=self.fname,
                                           obj=self.psflab_psf_raw,
                                           title='PSF x-z slice (PSFLab array)')
         for name in ['fname', 'dir_', 'x_step', 'z_step']:
             file_handle.set_node_attr(tarray, name, getattr(self, name))
+        for name in ['table', 'r2_index']:
+            if getattr(self, name):
+                file_handle.set_node_attr(tarray, name, True)
         return tarray
 
     def hash(self):
-        """Return an hash string computed on the PSF data."""
-        hash_list = []
-        for key, value in sorted(self.__dict__.items()):
-            if not isinstance(value, collections.Callable):
-                if isinstance(value, np.ndarray):
-                    hash_list.append(value.tostring())
-                else:
-                    hash_list.append(str(value))
-        return hashlib.md5(repr(hash_list).encode()).hexdigest()
+        """Return an hash string computed on the PSF data.
+
+        The default (spline) PSF has the same hash of previous versions.
+        """
+        extra = [name for name in ('table', 'r2_index') if getattr(self, name)]
+        return _hash_attributes(self, extra)
+
+
+def psf_from_hdf5(psf_pytables):
+    """Return the PSF object stored in the pytables node `psf_pytables`."""
+    if 'kind' in psf_pytables.attrs and psf_pytables.get_attr('kind') == 'gauss':
+        return GaussianPSF(psf_pytables=psf_pytables)
+    return NumericPSF(psf_pytables=psf_pytables)
 
 
 def load_PSFLab_file(fname):
@@ -0,0 +1,281 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module provides functions to handle the random number generators used
+in the simulations.
+
+Three kinds of random number generators are supported:
+
+- `numpy.random.RandomState`: the legacy generator (the default).
+- `numpy.random.Generator`: the modern generator, usually with a `PCG64`
+  or `Philox` bit generator. It is faster (e.g. ziggurat normals) and
+  supports parallel-safe seeding through `numpy.random.SeedSequence`.
+- :class:`StreamSet`: a sequence of independent `Generator`, one per
+  particle, spawned from a single `SeedSequence`.
+
+For parallel timestamps simulations, each time chunk uses its own
+`Generator` derived from a seed and the chunk index
+(see :func:`chunk_generator`).
+
+The state of RandomState objects is saved in the HDF5 stores as a tuple
+(as returned by `RandomState.get_state()`). The state of the other
+generators is saved as a (compact) JSON string.
+"""
+
+import json
+
+import numpy as np
+
+
+# Max size (in bytes) of a random state saved as HDF5 attribute
+_MAX_ATTR_SIZE = 60000
+
+
+def new_generator(seed=None, bit_generator='PCG64'):
+    """Return a `numpy.random.Generator` seeded through a SeedSequence.
+
+    Arguments:
+        seed (int, SeedSequence or None): the seed (entropy) for the
+            SeedSequence. If None, use fresh entropy from the OS.
+        bit_generator (string): name of the bit generator class in
+            `numpy.random`, for example 'PCG64' or 'Philox'.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    BitGenerator = getattr(np.random, bit_generator)
+    return np.random.Generator(BitGenerator(seed))
+
+
+def spawn_generators(seed, num, bit_generator='PCG64'):
+    """Return a list of `num` independent `numpy.random.Generator`.
+
+    The generators are spawned from the SeedSequence created from `seed`.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [new_generator(s, bit_generator) for s in seed.spawn(num)]
+
+
+class StreamSet:
+    """A sequence of independent random generators, one per particle.
+
+    All the generators are spawned from a single `numpy.random.SeedSequence`.
+    Since each particle uses its own stream, simulation results do not
+    depend on how the particles are grouped (e.g. in blocks or in shards
+    simulated by different processes).
+
+    Indexing with an integer returns the `Generator` of a particle.
+    Indexing with a slice returns a new StreamSet sharing the same
+    `Generator` objects.
+    """
+
+    def __init__(self, seed, num_streams, bit_generator='PCG64'):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_seq = seed
+        self.bit_generator = bit_generator
+        self.generators = spawn_generators(seed, num_streams, bit_generator)
+
+    @classmethod
+    def _from_generators(cls, generators, seed_seq, bit_generator):
+        streams = cls.__new__(cls)
+        streams.seed_seq = seed_seq
+        streams.bit_generator = bit_generator
+        streams.generators = list(generators)
+        return streams
+
+    def __len__(self):
+        return len(self.generators)
+
+    def __iter__(self):
+        return iter(self.generators)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._from_generators(self.generators[i], self.seed_seq,
+                                         self.bit_generator)
+        return self.generators[i]
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            self.generators[i] = list(value)
+        else:
+            self.generators[i] = value
+
+    def get_state(self):
+        """Return a dict with the state of all the streams."""
+        return dict(kind='StreamSet', entropy=self.seed_seq.entropy,
+                    spawn_key=list(self.seed_seq.spawn_key),
+                    bit_generator=self.bit_generator,
+                    states=[g.bit_generator.state for g in self.generators])
+
+    def set_state(self, state):
+        """Set the state of all the streams from a dict (see `get_state`)."""
+        assert len(state['states']) == len(self.generators)
+        for generator, state_g in zip(self.generators, state['states']):
+            generator.bit_generator.state = state_g
+
+    @classmethod
+    def from_state(cls, state):
+        """Create a StreamSet from a dict returned by `get_state`."""
+        seed_seq = np.random.SeedSequence(state['entropy'],
+                                          spawn_key=state['spawn_key'])
+        streams = cls(seed_seq, len(state['states']), state['bit_generator'])
+        streams.set_state(state)
+        return streams
+
+
+def get_state(rs):
+    """Return the state of the random number generator `rs`."""
+    if isinstance(rs, np.random.RandomState):
+        return rs.get_state()
+    elif isinstance(rs, np.random.Generator):
+        return rs.bit_generator.state
+    return rs.get_state()
+
+
+def set_state(rs, state):
+    """Set the state of the random number generator `rs`."""
+    if isinstance(rs, np.random.RandomState):
+        rs.set_state(state)
+    elif isinstance(rs, np.random.Generator):
+        rs.bit_generator.state = state
+    else:
+        rs.set_state(state)
+
+
+def from_state(state):
+    """Return a new random number generator with the given `state`.
+
+    The kind of generator (RandomState, Generator or StreamSet)
+    is inferred from `state`.
+    """
+    if isinstance(state, tuple):
+        rs = np.random.RandomState()
+        rs.set_state(state)
+    elif state.get('kind') == 'StreamSet':
+        rs = StreamSet.from_state(state)
+    else:
+        rs = np.random.Generator(getattr(np.random, state['bit_generator'])())
+        rs.bit_generator.state = state
+    return rs
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj))
+
+
+def _bit_generator_state_from_json(state):
+    """Convert the lists in a bit generator state back to uint64 arrays."""
+    for key, value in state['state'].items():
+        if isinstance(value, list):
+            state['state'][key] = np.array(value, dtype=np.uint64)
+    if isinstance(state.get('buffer'), list):
+        state['buffer'] = np.array(state['buffer'], dtype=np.uint64)
+    return state
+
+
+def state_to_attr(rs):
+    """Return the state of `rs` in a form suitable for an HDF5 attribute.
+
+    The state of a RandomState is returned as a tuple (as in
+    `RandomState.get_state()`), all the other states as a JSON string.
+    """
+    state = get_state(rs)
+    if isinstance(state, tuple):
+        return state
+    return json.dumps(state, default=_to_json, separators=(',', ':'))
+
+
+def state_from_attr(value):
+    """Return a random state from a value returned by :func:`state_to_attr`.
+    """
+    if isinstance(value, (str, bytes)):
+        state = json.loads(value)
+        if state.get('kind') == 'StreamSet':
+            state['states'] = [_bit_generator_state_from_json(s)
+                               for s in state['states']]
+        else:
+            state = _bit_generator_state_from_json(state)
+        return state
+    return value
+
+
+def save_state(node, name, rs):
+    """Save the state of `rs` as attribute `name` of the pytables `node`.
+
+    States too large for an HDF5 attribute (i.e. a StreamSet with many
+    streams) are saved in an array `name` inside the group `node`.
+    """
+    value = state_to_attr(rs)
+    if isinstance(value, str) and len(value) > _MAX_ATTR_SIZE:
+        h5file = node._v_file
+        if name in node:
+            h5file.remove_node(node, name)
+        h5file.create_array(node, name, title='Random state (JSON string)',
+                            obj=np.frombuffer(value.encode(), dtype='u1'))
+        if name in node._v_attrs:
+            del node._v_attrs[name]
+    else:
+        node._v_attrs[name] = value
+
+
+def load_state(node, name):
+    """Load a random state saved with :func:`save_state`. None if missing.
+    """
+    if name in node._v_attrs:
+        return state_from_attr(node._v_attrs[name])
+    if hasattr(node, '_v_children') and name in node:
+        return state_from_attr(node._f_get_child(name).read().tobytes())
+    return None
+
+
+def uniform(rs, size):
+    """Draw `size` samples uniformly distributed in [0, 1)."""
+    if isinstance(rs, np.random.RandomState):
+        return rs.rand(size)
+    return rs.random(size)
+
+
+def draw_seed(rs):
+    """Draw an integer seed from the random number generator `rs`."""
+    if isinstance(rs, np.random.RandomState):
+        return int(rs.randint(0, 2**31 - 1))
+    return int(rs.integers(0, 2**63 - 1))
+
+
+def spawn(rs, num):
+    """Return a list of `num` independent random number generators.
+
+    For a `RandomState`, the children are RandomState objects seeded with
+    numbers drawn from `rs`. For a `Generator`, the children are spawned
+    (with the same bit generator) from a SeedSequence seeded with a number
+    drawn from `rs`. In both cases the children depend only on the state
+    of `rs`, which is advanced: a simulation can be reproduced from the
+    saved state of `rs` and the next call returns different children.
+    """
+    if isinstance(rs, np.random.RandomState):
+        seeds = rs.randint(0, 2**31 - 1, size=num)
+        return [np.random.RandomState(seed=seed) for seed in seeds]
+    bit_generator = type(rs.bit_generator).__name__
+    return spawn_generators(draw_seed(rs), num, bit_generator)
+
+
+def chunk_generator(seed, index, bit_generator='PCG64'):
+    """Return the `numpy.random.Generator` of the chunk `index`.
+
+    The generator is initialized from `SeedSequence(seed, spawn_key=(index,))`
+    (i.e. the child `index` spawned from `SeedSequence(seed)`): the stream
+    of each chunk depends only on `seed` and `index`, so chunks can be
+    simulated in any order and by any process.
+    """
+    seed_seq = np.random.SeedSequence(seed, spawn_key=(index,))
+    return new_generator(seed_seq, bit_generator)
@@ -0,0 +1,346 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module contains the functions drawing the photons from the emission
+rates (the "samplers" of :meth:`ParticlesSimulation._sim_timestamps`).
+
+- :func:`sim_counts` (with :class:`CountsBuffer`): the 'dense' sampler,
+  drawing a Poisson number of counts for each time bin.
+- :func:`sim_timetrace_bg_sparse`: the 'sparse' sampler, drawing only the
+  photons of the bins with nonzero emission.
+- :func:`sim_photons_thinning`: the 'thinning' sampler, drawing the
+  photons in continuous time.
+
+This module does not depend on the simulation classes, so it is imported
+at top level by both :mod:`pybromo.diffusion` and :mod:`pybromo.pipeline`.
+"""
+
+import numpy as np
+
+from .iter_chunks import iter_chunk_index
+
+
+def sim_timetrace(emission, max_rate, t_step):
+    """Draw random emitted photons from Poisson(emission_rates).
+    """
+    emission_rates = emission * max_rate * t_step
+    return np.random.poisson(lam=emission_rates).astype(np.uint8)
+
+class CountsBuffer(object):
+    """Reusable output buffer for the counts of :func:`sim_counts`.
+
+    Arguments:
+        dtype (string or numpy dtype): 'uint8' (default) or 'uint16'.
+    """
+
+    def __init__(self, dtype='uint8'):
+        self.dtype = np.dtype(dtype)
+        self.buffer = np.zeros(0, dtype=self.dtype)
+
+    def get(self, shape):
+        """Return an uninitialized array of `shape` using the buffer."""
+        size = int(np.prod(shape))
+        if self.buffer.size < size:
+            self.buffer = np.empty(size, dtype=self.dtype)
+        return self.buffer[:size].reshape(shape)
+
+
+def _store_counts(counts, start, values, overflow):
+    """Store `values` in the flattened `counts` from index `start`.
+
+    Returns `counts` or, if promoted, a copy with a larger dtype.
+    """
+    max_value = np.iinfo(counts.dtype).max
+    if values.size > 0 and values.max() > max_value:
+        if overflow == 'raise':
+            raise OverflowError('Photon counts (%d) do not fit in %s.' %
+                                (values.max(), counts.dtype))
+        elif overflow == 'clip':
+            np.minimum(values, max_value, out=values)
+        elif overflow == 'promote':
+            dtype = 'uint16' if values.max() <= np.iinfo('uint16').max \
+                else 'uint32'
+            counts = counts.astype(dtype)
+    counts.reshape(-1)[start:start + values.size] = values
+    return counts
+
+
+def sim_counts(emission, max_rate, bg_rate, t_step, rs=None, out=None,
+               overflow='promote', block_size=2**16):
+    """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
+
+    Low-memory version of :func:`sim_timetrace_bg`, using the same random
+    numbers. The Poisson rates (float64) and the draws (int64) are
+    computed in blocks of `block_size` elements: `emission` (e.g.
+    float32) is not upcast nor modified and the counts are written
+    directly in `out`.
+
+    Arguments:
+        emission, max_rate, bg_rate, t_step, rs: see
+            :func:`sim_timetrace_bg`.
+        out (array or None): C-contiguous uint8 or uint16 array of shape
+            (nrows, emission.shape[1]), with one row more than `emission`
+            when `bg_rate` is not None (see :class:`CountsBuffer`).
+            If None, a new uint8 array is allocated.
+        overflow (string): policy for counts not fitting the dtype of
+            `out`: 'promote' (default) returns a copy of the counts with
+            a larger dtype (uint16 or uint32), 'clip' saturates the counts
+            to the max value, 'raise' raises OverflowError and 'wrap'
+            keeps the low bits.
+        block_size (int): number of elements drawn at once.
+
+    Returns:
+        The array of counts (`out`, unless promoted).
+    """
+    if overflow not in ('promote', 'clip', 'raise', 'wrap'):
+        raise ValueError("Unknown overflow policy '%s'. Valid policies are "
+                         "'promote', 'clip', 'raise' and 'wrap'." % overflow)
+    if rs is None:
+        rs = np.random.RandomState()
+    em = np.atleast_2d(emission)
+    counts_nrows = em.shape[0]
+    if bg_rate is not None:
+        counts_nrows += 1   # add a row for poisson background
+    counts = out
+    if counts is None:
+        counts = np.empty((counts_nrows, em.shape[1]), dtype='u1')
+    assert counts.shape == (counts_nrows, em.shape[1])
+    assert counts.flags.c_contiguous
+
+    # Draw the counts in the same order of a single poisson() call
+    em_flat = em.reshape(-1)
+    for i_start, i_end in iter_chunk_index(em_flat.size, block_size):
+        lam = em_flat[i_start:i_end].astype('float64')
+        lam *= max_rate * t_step
+        counts = _store_counts(counts, i_start, rs.poisson(lam=lam),
+                               overflow)
+    if bg_rate is not None:
+        for i_start, i_end in iter_chunk_index(em.shape[1], block_size):
+            counts = _store_counts(
+                counts, em_flat.size + i_start,
+                rs.poisson(lam=bg_rate * t_step, size=i_end - i_start),
+                overflow)
+    return counts
+
+
+def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None):
+    """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
+
+    Arguments:
+        emission (2D array): array of normalized emission rates. One row per
+            particle (axis = 0). Columns are the different time steps.
+            The array is not modified.
+        max_rate (float): the peak emission rate in Hz.
+        bg_rate (float or None): rate of a constant Poisson background (Hz).
+            Background is added as an additional row in the returned array
+            of counts. If None, no background simulated.
+        t_step (float): duration of a time step in seconds.
+        rs (RandomState or None): object used to draw the random numbers.
+            If None, a new RandomState is created using a random seed.
+
+    Returns:
+        `counts` an 2D uint8 array of counts in each time bin, for each
+        particle. If `bg_rate` is None counts.shape == emission.shape.
+        Otherwise, `counts` has one row more than `emission` for storing
+        the constant Poisson background. Counts above 255 wrap around
+        (see :func:`sim_counts` for the other overflow policies).
+    """
+    return sim_counts(emission, max_rate, bg_rate, t_step, rs=rs,
+                      overflow='wrap')
+
+def sim_timetrace_bg2(emission, max_rate, bg_rate, t_step, rs=None):
+    """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
+
+    This is an alternative implementation of :func:`sim_timetrace_bg`.
+    """
+    if rs is None:
+        rs = np.random.RandomState()
+    emiss_bin_rate = np.zeros((emission.shape[0] + 1, emission.shape[1]),
+                              dtype='float64')
+    emiss_bin_rate[:-1] = emission * max_rate * t_step
+    if bg_rate is not None:
+        emiss_bin_rate[-1] = bg_rate * t_step
+        counts = rs.poisson(lam=emiss_bin_rate).astype('uint8')
+    else:
+        counts = rs.poisson(lam=emiss_bin_rate[:-1]).astype('uint8')
+    return counts
+
+def _sorted_poisson_points(total, rs):
+    """Points of a unit-rate Poisson process in [0, total), sorted.
+
+    The number of points is Poisson(total). The sorted points are drawn
+    in O(n) as the normalized cumulative sum of n + 1 exponential gaps.
+    """
+    num_points = rs.poisson(total)
+    if num_points == 0:
+        return np.zeros(0, dtype='float64')
+    points = np.cumsum(rs.exponential(size=num_points + 1))
+    return points[:-1] * (total / points[-1])
+
+
+def _count_repeats(index):
+    """Return the unique values of the sorted `index` and their counts."""
+    if index.size == 0:
+        return index, index
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    return index[starts], np.diff(np.r_[starts, index.size])
+
+
+def _block_sums(a, block_size):
+    """Return the float64 sums of the blocks of `block_size` elements of `a`.
+
+    `a` is a 1D array (e.g. float32), which is not upcast to float64.
+    """
+    num_full = a.size // block_size
+    sums = a[:num_full * block_size].reshape(num_full, block_size).sum(
+        axis=1, dtype='float64')
+    if a.size > num_full * block_size:
+        sums = np.append(sums, a[num_full * block_size:].sum(dtype='float64'))
+    return sums
+
+
+def sim_timetrace_bg_sparse(emission, max_rate, bg_rate, t_step, rs=None,
+                            block_size=2**14):
+    """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
+
+    Statistically equivalent to :func:`sim_timetrace_bg`, but only the
+    bins with counts are returned and the random numbers are drawn only
+    for the photons: the number of photons is Poisson(sum of the bin
+    rates) and each photon falls in a bin with probability proportional
+    to the bin rate (inverse CDF of the sorted points of a Poisson
+    process). The background photons are placed uniformly in time in
+    the same way.
+
+    The flattened emission is split in blocks of `block_size` bins.
+    The sum of each block is computed in a single pass without
+    temporary arrays, then the photons are placed in the blocks and
+    only the blocks with photons are searched (with a float64
+    cumulative sum of `block_size` elements). Besides the pass summing
+    the emission, the cost is O(number of photons * block_size), so
+    this sampler is faster than :func:`sim_timetrace_bg` when most bins
+    have zero emission (e.g. with a PSF support, see
+    :meth:`ParticlesSimulation.simulate_diffusion`) and the rates are low.
+
+    Arguments:
+        emission (2D array): array of normalized emission rates. One row per
+            particle (axis = 0). Columns are the different time steps.
+            The array is not modified.
+        max_rate (float): the peak emission rate in Hz.
+        bg_rate (float or None): rate of a constant Poisson background (Hz).
+            The background counts have row index `emission.shape[0]`.
+            If None, no background simulated.
+        t_step (float): duration of a time step in seconds.
+        rs (RandomState or None): object used to draw the random numbers.
+            If None, a new RandomState is created using a random seed.
+        block_size (int): number of bins of each block.
+
+    Returns:
+        A tuple of three int64 arrays (i_time, i_row, counts): the time
+        index, the row index and the number of counts of the bins with
+        counts, in time order (and row order within a time bin).
+    """
+    if rs is None:
+        rs = np.random.RandomState()
+    em = np.atleast_2d(emission)
+    nrows, num_bins = em.shape
+    em_flat = em.reshape(-1)
+    rate = max_rate * t_step
+
+    # Place the photons in the blocks, then in the bins of each block
+    cum_block = np.cumsum(_block_sums(em_flat, block_size)) * rate
+    total = cum_block[-1] if cum_block.size > 0 else 0.
+    points = _sorted_poisson_points(total, rs)
+    i_block = np.searchsorted(cum_block, points, side='right')
+    np.minimum(i_block, cum_block.size - 1, out=i_block)
+    index = np.empty(points.size, dtype='int64')
+    i_point = 0
+    for block, num_points in zip(*_count_repeats(i_block)):
+        start = block * block_size
+        offset = cum_block[block - 1] if block > 0 else 0.
+        cum = np.cumsum(em_flat[start:start + block_size], dtype='float64')
+        cum *= rate
+        block_points = points[i_point:i_point + num_points] - offset
+        i_bin = np.searchsorted(cum, block_points, side='right')
+        # Points beyond the end of the block (by rounding) go in the last
+        # bin with emission
+        np.minimum(i_bin, np.searchsorted(cum, cum[-1]), out=i_bin)
+        index[i_point:i_point + num_points] = i_bin + start
+        i_point += num_points
+    index, counts = _count_repeats(index)
+    i_row, i_time = np.divmod(index, max(num_bins, 1))
+    cells = i_time * (nrows + 1) + i_row
+    if bg_rate is not None:
+        bg_counts = bg_rate * t_step
+        points = _sorted_poisson_points(bg_counts * num_bins, rs)
+        bg_time = (points / bg_counts).astype('int64')
+        np.minimum(bg_time, num_bins - 1, out=bg_time)
+        bg_time, bg_counts = _count_repeats(bg_time)
+        cells = np.hstack([cells, bg_time * (nrows + 1) + nrows])
+        counts = np.hstack([counts, bg_counts])
+
+    # Sort the bins in time order (and row order within a time bin)
+    cells, counts = cells.astype('int64'), counts.astype('int64')
+    index_sort = cells.argsort(kind='mergesort')
+    cells, counts = cells[index_sort], counts[index_sort]
+    return cells // (nrows + 1), cells % (nrows + 1), counts
+
+
+def sim_photons_thinning(emission, max_rate, bg_rate, t_step, rs=None):
+    """Draw photons in continuous time by thinning a Poisson process.
+
+    For each particle, candidate photons are drawn from a homogeneous
+    Poisson process at rate `max_rate * em_max` (exponential
+    inter-arrival times, see :func:`_sorted_poisson_points`), where
+    `em_max = max(1, emission.max())`. A candidate at time t is
+    accepted with probability `emission[p, t // t_step] / em_max`.
+    The emission is piecewise constant during each time step, so the
+    photons follow the same rates of :func:`sim_timetrace_bg`, but the
+    times are not quantized to the time steps. The background photons
+    are drawn directly with exponential gaps. The cost is proportional
+    to the number of candidate photons, not to the number of time bins.
+
+    Arguments:
+        emission (2D array): array of normalized emission rates. One row per
+            particle (axis = 0). Columns are the different time steps.
+            The array is not modified.
+        max_rate (float): the peak emission rate in Hz.
+        bg_rate (float or None): rate of a constant Poisson background (Hz).
+            The background photons have row index `emission.shape[0]`.
+            If None, no background simulated.
+        t_step (float): duration of a time step in seconds.
+        rs (RandomState or None): object used to draw the random numbers.
+            If None, a new RandomState is created using a random seed.
+
+    Returns:
+        A tuple of two arrays (times, rows): the photon times in units
+        of `t_step` from the start of `emission` (float64) and the row
+        index of each photon (int64), in time order.
+    """
+    if rs is None:
+        rs = np.random.RandomState()
+    em = np.atleast_2d(emission)
+    nrows, num_bins = em.shape
+    em_max = max(1., float(em.max())) if em.size > 0 else 1.
+
+    # Candidates of all the particles, each assigned to a random particle
+    rate = max_rate * em_max * t_step    # candidates per time step
+    times = _sorted_poisson_points(rate * nrows * num_bins, rs) / nrows / rate
+    rows = (rs.uniform(size=times.size) * nrows).astype('int64')
+    np.minimum(rows, nrows - 1, out=rows)
+    i_time = times.astype('int64')
+    np.minimum(i_time, num_bins - 1, out=i_time)
+    accept = rs.uniform(size=times.size) * em_max < em[rows, i_time]
+    times, rows = times[accept], rows[accept]
+    if bg_rate is None:
+        return times, rows
+
+    bg_counts = bg_rate * t_step
+    bg_times = _sorted_poisson_points(bg_counts * num_bins, rs) / bg_counts
+    times = np.hstack([times, bg_times])
+    rows = np.hstack([rows, np.full(bg_times.size, nrows, dtype='int64')])
+    index_sort = times.argsort(kind='mergesort')
+    return times[index_sort], rows[index_sort]
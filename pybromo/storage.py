@@ -14,8 +14,10 @@ Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
 
 from pathlib import Path
 import time
+import numpy as np
 import tables
 
+from .iter_chunks import iter_chunk_index, hdf5_lock
 from ._version import get_versions
 __version__ = get_versions()['version']
 
@@ -32,6 +34,155 @@ class ExistingArrayError(Exception):
     pass
 
 
+class SparseEmissionArray(object):
+    """Per-particle emission stored in a sparse (CSR) format.
+
+    The emission is appended in time chunks. For each chunk, only the
+    samples with emission > `threshold` are stored, sorted by particle and
+    then by time (i.e. one CSR matrix per chunk). The data is stored in
+    a pytables group with the following arrays:
+
+    'index' (uint32)
+        time index of each stored sample, relative to the chunk start.
+    'values' (float32)
+        emission of each stored sample.
+    'indptr' (int64, shape (num_chunks, num_particles + 1))
+        for each chunk, the CSR row pointers in the 'index'/'values' arrays
+        (absolute offsets, i.e. the samples of particle `i` in chunk `k` are
+        in `indptr[k, i]:indptr[k, i + 1]`).
+    'chunk_stop' (int64)
+        cumulative number of time samples at the end of each chunk.
+
+    Slicing (e.g. `array[:, i_start:i_end]`) returns a dense float32 array,
+    so objects of this class can be used in place of the dense pytables
+    `emission` array. With `threshold=0` the conversion is lossless.
+    """
+
+    dtype = np.dtype('float32')
+
+    def __init__(self, group):
+        self.group = group
+        self.index = group.index
+        self.values = group.values
+        self.indptr = group.indptr
+        self.chunk_stop = group.chunk_stop
+        self.num_particles = int(group._v_attrs['num_particles'])
+        self.threshold = float(group._v_attrs['threshold'])
+        self.chunkshape = (self.num_particles,
+                           int(group._v_attrs['t_chunksize']))
+        self._load_chunks()
+
+    @classmethod
+    def create(cls, h5file, where, name, num_particles, t_chunksize,
+               threshold=0., comp_filter=default_compression, title=''):
+        """Create a new (empty) sparse emission array in `where/name`."""
+        group = h5file.create_group(where, name, title)
+        group._v_attrs['num_particles'] = num_particles
+        group._v_attrs['threshold'] = threshold
+        group._v_attrs['t_chunksize'] = int(t_chunksize)
+        group._v_attrs['format'] = 'csr'
+        kw = dict(shape=(0,), filters=comp_filter)
+        h5file.create_earray(group, 'index', atom=tables.UInt32Atom(),
+                             title='Time index (relative to chunk start)',
+                             **kw)
+        h5file.create_earray(group, 'values', atom=tables.Float32Atom(),
+                             title='Emission values', **kw)
+        h5file.create_earray(group, 'chunk_stop', atom=tables.Int64Atom(),
+                             title='Last time index (+1) of each chunk', **kw)
+        h5file.create_earray(group, 'indptr', atom=tables.Int64Atom(),
+                             shape=(0, num_particles + 1), filters=comp_filter,
+                             title='CSR row pointers of each chunk')
+        group._v_attrs['PyBroMo'] = __version__
+        group._v_attrs['creation_time'] = current_time()
+        return cls(group)
+
+    def _load_chunks(self):
+        self._chunk_stop = self.chunk_stop.read()
+        self._chunk_start = np.concatenate(([0], self._chunk_stop[:-1]))
+
+    @property
+    def shape(self):
+        n_samples = int(self._chunk_stop[-1]) if self._chunk_stop.size else 0
+        return (self.num_particles, n_samples)
+
+    @property
+    def nnz(self):
+        """Number of stored samples."""
+        return self.values.nrows
+
+    def append(self, em):
+        """Append a chunk of emission `em` (shape (num_particles, T))."""
+        em = np.asarray(em, dtype=np.float32)
+        assert em.shape[0] == self.num_particles
+        mask = em > self.threshold
+        rows, cols = np.nonzero(mask)
+        indptr = np.zeros(self.num_particles + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(mask, axis=1), out=indptr[1:])
+        indptr += self.values.nrows
+        self.index.append(cols.astype(np.uint32))
+        self.values.append(em[rows, cols])
+        self.indptr.append(indptr[np.newaxis, :])
+        self.chunk_stop.append([self.shape[1] + em.shape[1]])
+        self._load_chunks()
+
+    def truncate(self, size):
+        """Truncate the array to `size` time samples (a chunk boundary)."""
+        if size >= self.shape[1]:
+            return
+        num_chunks = int(np.searchsorted(self._chunk_stop, size,
+                                         side='right'))
+        if num_chunks > 0 and self._chunk_stop[num_chunks - 1] != size:
+            raise ValueError('Size %d is not a chunk boundary.' % size)
+        if num_chunks < self._chunk_stop.size:
+            nnz = int(self.indptr[num_chunks][0])
+            self.index.truncate(nnz)
+            self.values.truncate(nnz)
+            self.indptr.truncate(num_chunks)
+            self.chunk_stop.truncate(num_chunks)
+            self._load_chunks()
+
+    def flush(self):
+        self.group._v_file.flush()
+
+    def read(self, start=None, stop=None):
+        """Return the dense emission in [start, stop) as a float32 array."""
+        n_samples = self.shape[1]
+        start, stop, _ = slice(start, stop).indices(n_samples)
+        stop = max(start, stop)
+        em = np.zeros((self.num_particles, stop - start), dtype=np.float32)
+        k_first = np.searchsorted(self._chunk_stop, start, side='right')
+        k_last = np.searchsorted(self._chunk_start, stop, side='left')
+        for k in range(k_first, k_last):
+            indptr = self.indptr[k]
+            index = self.index[indptr[0]:indptr[-1]].astype(np.int64)
+            values = self.values[indptr[0]:indptr[-1]]
+            rows = np.repeat(np.arange(self.num_particles), np.diff(indptr))
+            index += self._chunk_start[k] - start
+            valid = (index >= 0) & (index < stop - start)
+            em[rows[valid], index[valid]] = values[valid]
+        return em
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if key[0] is Ellipsis:
+            key = (slice(None),) + key[1:]
+        particles, times = key
+        if isinstance(times, slice):
+            start = None if times.start is None else int(times.start)
+            stop = None if times.stop is None else int(times.stop)
+            step = None if times.step is None else int(times.step)
+            return self.read(start, stop)[:, ::step][particles]
+        return self.read()[:, times][particles]
+
+    def __len__(self):
+        return self.num_particles
+
+    def __repr__(self):
+        return ('SparseEmissionArray: shape %s, %d stored samples, '
+                'threshold %g' % (self.shape, self.nnz, self.threshold))
+
+
 class BaseStore(object):
 
     @staticmethod
@@ -86,7 +237,7 @@ class BaseStore(object):
         """Reopen a file after has been closed (uses the store filename)."""
         self.__init__(self.h5file.filename, mode='r')
 
-    def set_sim_params(self, nparams, attr_params):
+    def set_sim_params(self, nparams, attr_params, overwrite=False):
         """Store parameters in `params` in `h5file.root.parameters`.
 
         `nparams` (dict)
@@ -99,20 +250,40 @@ class BaseStore(object):
                 second element is a string used as "title" (description)
         `attr_params` (dict)
             A dict whole items are stored as attributes in '/parameters'
+        `overwrite` (bool)
+            If True, replace the parameters already stored.
         """
         for name, value in nparams.items():
+            if overwrite and name in self.h5file.root.parameters:
+                self.h5file.remove_node('/parameters', name)
             val = value[0] if value[0] is not None else 'none'
             self.h5file.create_array('/parameters', name, obj=val,
                                      title=value[1])
         for name, value in attr_params.items():
             self.h5file.set_node_attr('/parameters', name, value)
 
+    def add_particles(self, particles):
+        """Store the particles table in '/parameters/particles'.
+
+        `particles` is a structured array as returned by
+        `Particles.to_array()`.
+        """
+        return self.h5file.create_table('/parameters', 'particles',
+                                        obj=particles,
+                                        title='Particles (D, x0, y0, z0)')
+
+    def get_particles(self):
+        """Return the particles table as a structured array (or None)."""
+        if 'particles' not in self.h5file.root.parameters:
+            return None
+        return self.h5file.root.parameters.particles.read()
+
     @property
     def numeric_params(self):
         """Return a dict containing all (key, values) stored in '/parameters'
         """
         nparams = dict()
-        for p in self.h5file.root.parameters:
+        for p in self.h5file.root.parameters._f_iter_nodes('Array'):
             nparams[p.name] = p.read()
         return nparams
 
@@ -124,7 +295,7 @@ class BaseStore(object):
         in ParticlesSimulation().
         """
         nparams = dict()
-        for p in self.h5file.root.parameters:
+        for p in self.h5file.root.parameters._f_iter_nodes('Array'):
             nparams[p.name] = (p.read(), p.title)
         return nparams
 
@@ -145,7 +316,7 @@ class TrajectoryStore(BaseStore):
         """
         super().__init__(datafile, path=path, nparams=nparams,
                          attr_params=attr_params, mode=mode)
-        if mode != 'r':
+        if mode != 'r' and 'trajectories' not in self.h5file.root:
             # Create the groups
             self.h5file.create_group('/', 'trajectories',
                                      'Simulated trajectories')
@@ -210,6 +381,83 @@ class TrajectoryStore(BaseStore):
                                    title='Emission trace of each particle',
                                    params=params)
 
+    def add_emission_sparse(self, chunksize=2**19, threshold=0.,
+                            comp_filter=default_compression, overwrite=False,
+                            chunkslice='bytes'):
+        """Add the sparse `emission_sparse` array in '/trajectories'.
+
+        The time-chunk size is the same of the dense `emission` array
+        created by :meth:`add_emission` with the same `chunksize`.
+        See :class:`SparseEmissionArray` for the format.
+        """
+        group = self.h5file.root.trajectories
+        name = 'emission_sparse'
+        if name in group:
+            print("%s already exists ..." % name, end='')
+            if overwrite:
+                self.h5file.remove_node(group, name, recursive=True)
+                print(" deleted.")
+            else:
+                print(" old returned.")
+                return SparseEmissionArray(group._f_get_child(name))
+
+        num_particles = self.numeric_params['np']
+        chunkshape = self.calc_chunkshape(chunksize, (num_particles, 0))
+        return SparseEmissionArray.create(
+            self.h5file, group, name, num_particles=num_particles,
+            t_chunksize=int(chunkshape[1]), threshold=threshold,
+            comp_filter=comp_filter,
+            title='Sparse emission trace of each particle')
+
+    def get_emission(self):
+        """Return the per-particle emission array (dense or sparse).
+
+        Returns the pytables `emission` array when present, otherwise
+        the :class:`SparseEmissionArray` in 'emission_sparse'.
+        """
+        group = self.h5file.root.trajectories
+        if 'emission' in group:
+            return group.emission
+        return SparseEmissionArray(group.emission_sparse)
+
+    def emission_to_sparse(self, threshold=0., overwrite=False,
+                           comp_filter=default_compression):
+        """Convert the dense `emission` array to `emission_sparse`.
+
+        The dense array is read one chunk at a time and is not removed.
+        """
+        emission = self.h5file.root.trajectories.emission
+        t_chunksize = emission.chunkshape[1]
+        sparse = self.add_emission_sparse(
+            chunksize=t_chunksize * emission.shape[0], threshold=threshold,
+            overwrite=overwrite, comp_filter=comp_filter)
+        if sparse.shape[1] > 0:
+            return sparse
+        for i_start, i_end in iter_chunk_index(emission.shape[1],
+                                               t_chunksize):
+            sparse.append(emission[:, i_start:i_end])
+        self.h5file.flush()
+        return sparse
+
+    def emission_to_dense(self, overwrite=False,
+                          comp_filter=default_compression):
+        """Convert `emission_sparse` to a dense `emission` array.
+
+        The sparse array is read one chunk at a time and is not removed.
+        """
+        group = self.h5file.root.trajectories
+        sparse = SparseEmissionArray(group.emission_sparse)
+        num_particles, t_chunksize = sparse.chunkshape
+        emission = self.add_emission(chunksize=t_chunksize * num_particles,
+                                     overwrite=overwrite,
+                                     comp_filter=comp_filter)
+        if emission.shape[1] > 0:
+            return emission
+        for i_start, i_end in iter_chunk_index(sparse.shape[1], t_chunksize):
+            emission.append(sparse[:, i_start:i_end])
+        self.h5file.flush()
+        return emission
+
     def add_position(self, radial=False, chunksize=2**19, chunkslice='bytes',
                      comp_filter=default_compression, overwrite=False,
                      params=dict()):
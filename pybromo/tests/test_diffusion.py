@@ -7,6 +7,8 @@ Running the tests requires `py.test`.
 import pytest
 import numpy as np
 import json
+import tables
+from scipy import stats
 
 import pybromo as pbm
 
@@ -79,11 +81,14 @@ def test_Particles():
     Di, counts = list(zip(*P.diffusion_coeff_counts))
     rs2 = np.random.RandomState()
     rs2.set_state(P.init_random_state)
-    P2_list = pbm.Particles._generate(num_particles=counts[0], D=Di[0],
-                                      box=P.box, rs=rs2)
-    P2_list += pbm.Particles._generate(num_particles=counts[1], D=Di[1],
-                                       box=P.box, rs=rs2)
-    assert P.to_list() == P2_list
+    r0_1, D_1 = pbm.Particles._generate(num_particles=counts[0], D=Di[0],
+                                        box=P.box, rs=rs2)
+    r0_2, D_2 = pbm.Particles._generate(num_particles=counts[1], D=Di[1],
+                                        box=P.box, rs=rs2)
+    assert (P.r0 == np.vstack([r0_1, r0_2])).all()
+    assert (P.diffusion_coeff == np.hstack([D_1, D_2])).all()
+    assert P.positions.shape == (35, 3, 1)
+    assert P == P.to_list()
 
     # Test Particles random states
     assert randomstate_equal(P.rs, rs.get_state())
@@ -95,6 +100,11 @@ def test_Particles():
     P3 = pbm.Particles.from_json(P_json)
     assert P.to_list() == P3.to_list()
 
+    # Test binary (structured array) serialization
+    P4 = pbm.Particles.from_array(P.to_array())
+    assert P4 == P and P4.to_list() == P.to_list()
+    assert P4[3] == P[3] and P4[1:4] == P[1:4]
+
 
 def test_diffusion_sim_random_state():
     # Initialize the random state
@@ -173,6 +183,34 @@ def test_diffusion_sim_core():
     assert np.abs(D - D_fitted) < 0.01
 
 
+def test_diffusion_sim_batch_engine():
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box, rs=rs)
+    P.add(num_particles=15, D=6e-12)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.001,
+                                particles=P, box=box, psf=psf)
+    time_size = 1001
+    for wrap_func in [pbm.diffusion.wrap_mirror, pbm.diffusion.wrap_periodic]:
+        for total_emission in [True, False]:
+            for radial in [True, False]:
+                kw = dict(total_emission=total_emission, save_pos=True,
+                          radial=radial, wrap_func=wrap_func)
+                start_pos = S.particles.positions
+                POS, em = S._sim_trajectories(
+                    time_size, start_pos, rs=np.random.RandomState(_SEED),
+                    **kw)
+                for block_size in [None, 1, 8]:
+                    start_pos_b = S.particles.positions
+                    POS_b, em_b = S._sim_trajectories_batch(
+                        time_size, start_pos_b, rs=np.random.RandomState(_SEED),
+                        block_size=block_size, **kw)
+                    assert (em == em_b).all()
+                    assert (np.vstack(POS) == np.vstack(POS_b)).all()
+                    assert (start_pos == start_pos_b).all()
+
+
 def test_simulate_timestamps():
     hash_ = create_diffusion_sim()
     S = pbm.ParticlesSimulation.from_datafile(hash_, mode='w')
@@ -224,3 +262,1104 @@ def test_TimestampSimulation():
     rs = np.random.RandomState(_SEED)
     mix_sim.run(rs=rs, overwrite=False)
     mix_sim.save_photon_hdf5()
+
+
+def test_diffusion_sim_sharded(tmp_path):
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                particles=P, box=box, psf=psf)
+    S.simulate_diffusion(total_emission=False, save_pos=True,
+                         rs=np.random.RandomState(_SEED), chunksize=2**11,
+                         num_processes=3, engine='batch', path=str(tmp_path))
+    emission, position = S.emission[:], S.position[:]
+    t_chunksize = S.emission.chunkshape[1]
+    seeds = S.traj_group._v_attrs['shard_seeds']
+    S.store.close()
+
+    # Simulate each shard in-process with the same seeds
+    shards = [slice(0, 4), slice(4, 7), slice(7, 10)]
+    for shard, seed in zip(shards, seeds):
+        Ps = pbm.Particles(num_particles=None, D=None, box=box,
+                           particles=P.to_list()[shard])
+        Ss = pbm.ParticlesSimulation(t_step=S.t_step, t_max=S.t_max,
+                                     particles=Ps, box=box, psf=psf)
+        rs_shard = np.random.RandomState(seed)
+        start_pos = Ss.particles.positions
+        em_list, pos_list = [], []
+        for time_size in pbm.diffusion.iter_chunksize(Ss.n_samples,
+                                                      t_chunksize):
+            POS, em = Ss._sim_trajectories(time_size, start_pos, rs_shard,
+                                           save_pos=True)
+            em_list.append(em)
+            pos_list.append(np.vstack(POS).astype('float32'))
+        assert (np.hstack(em_list) == emission[shard]).all()
+        assert (np.concatenate(pos_list, axis=-1) == position[shard]).all()
+
+
+def test_rng_states():
+    for rs in [np.random.RandomState(_SEED),
+               pbm.rng.new_generator(_SEED),
+               pbm.rng.new_generator(_SEED, bit_generator='Philox'),
+               pbm.rng.StreamSet(_SEED, 5)]:
+        rs_attr = pbm.rng.state_to_attr(rs)
+        rs2 = pbm.rng.from_state(pbm.rng.state_from_attr(rs_attr))
+        if isinstance(rs, pbm.rng.StreamSet):
+            rs, rs2 = rs[3], rs2[3]
+        assert (rs.normal(size=10) == rs2.normal(size=10)).all()
+        if not isinstance(rs, pbm.rng.StreamSet):
+            # Children depend only on the (saved) state of the parent,
+            # which is advanced
+            state = pbm.rng.get_state(rs)
+            children = pbm.rng.spawn(rs, 2)
+            children2 = pbm.rng.spawn(pbm.rng.from_state(state), 2)
+            for child, child2 in zip(children, children2):
+                assert (child.normal(size=10) == child2.normal(size=10)).all()
+            assert (pbm.rng.uniform(rs, 10) !=
+                    pbm.rng.uniform(pbm.rng.from_state(state), 10)).all()
+
+
+def test_diffusion_sim_streams(tmp_path):
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                particles=P, box=box, psf=psf)
+    streams = pbm.rng.StreamSet(_SEED, S.num_particles)
+    S.simulate_diffusion(total_emission=False, save_pos=True, rs=streams,
+                         chunksize=2**11, num_processes=3,
+                         path=str(tmp_path))
+    emission, position = S.emission[:], S.position[:]
+    t_chunksize = S.emission.chunkshape[1]
+    saved_state = pbm.rng.load_state(S.traj_group, 'last_random_state')
+    S.store.close()
+    assert saved_state == streams.get_state()
+
+    # Per-particle streams give the same results with any engine
+    for engine in ['loop', 'batch']:
+        streams = pbm.rng.StreamSet(_SEED, S.num_particles)
+        sim_trajectories = S._get_sim_trajectories(engine, block_size=4)
+        start_pos = S.particles.positions
+        em_list, pos_list = [], []
+        for time_size in pbm.diffusion.iter_chunksize(S.n_samples,
+                                                      t_chunksize):
+            POS, em = sim_trajectories(time_size, start_pos, streams,
+                                       save_pos=True)
+            em_list.append(em)
+            pos_list.append(np.vstack(POS).astype('float32'))
+        assert (np.hstack(em_list) == emission).all()
+        assert (np.concatenate(pos_list, axis=-1) == position).all()
+
+
+def test_diffusion_sim_float32():
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01,
+                                particles=P, box=box, psf=psf)
+    kw = dict(save_pos=True, wrap_func=pbm.diffusion.wrap_periodic)
+    pos_start64, pos_start32 = S.particles.positions, S.particles.positions
+    rs64, rs32 = np.random.RandomState(_SEED), np.random.RandomState(_SEED)
+    for i in range(4):
+        POS64, em64 = S._sim_trajectories_batch(
+            S.n_samples // 4, pos_start64, rs64, **kw)
+        POS32, em32 = S._sim_trajectories_batch(
+            S.n_samples // 4, pos_start32, rs32, dtype='float32',
+            anchor_size=2**10, **kw)
+        assert POS32[0].dtype == np.float32
+        assert np.abs(POS32[0] - POS64[0]).max() < 2e-12
+        assert np.abs(em32 - em64).max() < 1e-5
+    assert np.abs(pos_start64 - pos_start32).max() < 2e-12
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+def test_diffusion_sim_fused_engine(use_numba):
+    if use_numba:
+        pytest.importorskip('numba')
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF(table=True)
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01,
+                                particles=P, box=box, psf=psf)
+    time_size = 10001
+    for wrap_func in [pbm.diffusion.wrap_mirror, pbm.diffusion.wrap_periodic]:
+        for total_emission in [True, False]:
+            for radial in [True, False]:
+                kw = dict(total_emission=total_emission, save_pos=True,
+                          radial=radial, wrap_func=wrap_func)
+                start_pos = S.particles.positions
+                POS, em = S._sim_trajectories(
+                    time_size, start_pos, rs=np.random.RandomState(_SEED),
+                    **kw)
+                start_pos_f = S.particles.positions
+                POS_f, em_f = S._sim_trajectories_fused(
+                    time_size, start_pos_f, rs=np.random.RandomState(_SEED),
+                    use_numba=use_numba, **kw)
+                assert np.allclose(em, em_f, rtol=1e-5, atol=1e-7)
+                assert np.allclose(np.vstack(POS), np.vstack(POS_f),
+                                   rtol=0, atol=1e-12)
+                assert np.allclose(start_pos, start_pos_f, rtol=0, atol=1e-15)
+    # An empty chunk leaves the start positions unchanged
+    start_pos = S.particles.positions
+    start_pos_f = start_pos.copy()
+    POS_f, em_f = S._sim_trajectories_fused(
+        0, start_pos_f, rs=np.random.RandomState(_SEED), save_pos=True,
+        use_numba=use_numba)
+    assert em_f.shape == (S.num_particles, 0)
+    assert POS_f[0].shape == (1, 3, 0)
+    assert (start_pos_f == start_pos).all()
+
+
+def test_gaussian_psf(tmp_path):
+    psf = pbm.GaussianPSF(sx=0.2e-6, sy=0.2e-6, sz=0.8e-6)
+    x = np.linspace(0, 2e-6, 50)
+    z = np.linspace(-3e-6, 3e-6, 50)
+    em = psf.eval_xz_squared(x, z)
+    assert np.allclose(em, psf.eval_xz(x, z)**2)
+    assert np.allclose(em, psf.eval(x, np.zeros_like(x), z)**2)
+    assert psf.eval_xz_squared(np.zeros(1), np.zeros(1))[0] == 1
+    assert psf.hash() == pbm.GaussianPSF(sx=0.2e-6, sy=0.2e-6,
+                                         sz=0.8e-6).hash()
+    assert psf.hash() != pbm.GaussianPSF(sx=0.2e-6, sy=0.2e-6,
+                                         sz=0.9e-6).hash()
+    with pytest.raises(ValueError):
+        pbm.GaussianPSF(sx=0.2e-6, sy=0.3e-6).eval_xz_squared(x, z)
+
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01,
+                                particles=P, box=box, psf=psf)
+    S.simulate_diffusion(save_pos=True, total_emission=False, radial=True,
+                         rs=rs, path=str(tmp_path))
+    em, pos = S.emission[:], S.position[:]
+    S.store.close()
+    assert np.allclose(em, psf.eval_xz_squared(pos[:, 0], pos[:, 1]))
+
+    S2 = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=tmp_path,
+                                               ignore_timestamps=True)
+    assert isinstance(S2.psf, pbm.GaussianPSF)
+    assert S2.psf.hash() == psf.hash()
+    assert S2.hash() == S.hash()
+    S2.store.close()
+
+
+def test_numeric_psf_table():
+    psf_spline = pbm.NumericPSF()
+    psf = pbm.NumericPSF(table=True)
+    psf_r2 = pbm.NumericPSF(r2_index=True)
+    assert len({psf_spline.hash(), psf.hash(), psf_r2.hash()}) == 3
+    # By default, the squared spline interpolation (as in previous versions)
+    r, z = np.linspace(0, 5e-6, 100), np.linspace(-7e-6, 7e-6, 100)
+    assert (psf_spline.eval_r2z_squared(r**2, z) ==
+            psf_spline.eval_xz(r, z)**2).all()
+    # The fused engine requires the table
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=2, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01, particles=P,
+                                box=box, psf=psf_spline)
+    with pytest.raises(ValueError):
+        S._sim_trajectories_fused(10, S.particles.positions,
+                                  rs=np.random.RandomState(_SEED))
+    # On the grid nodes the table is exact
+    R, Z = np.meshgrid(psf.xi * 1e-6, psf.zi * 1e-6)
+    assert np.allclose(psf.eval_xz_squared(R, Z), psf.hdata**2)
+    assert np.allclose(psf_r2.eval_xz_squared(R, Z), psf.hdata**2)
+    # Between the nodes it is close to the (squared) spline interpolation
+    rs = np.random.RandomState(_SEED)
+    r = rs.uniform(0, 4e-6, size=10000)
+    z = rs.uniform(-6e-6, 6e-6, size=10000)
+    em = psf.eval_xz(r, z)**2
+    assert np.allclose(psf.eval_xz_squared(r, z), em, rtol=0, atol=3e-2)
+    # (linear in r**2 near the axis, so it differs more from the spline)
+    assert np.allclose(psf_r2.eval_xz_squared(r, z), em, rtol=0, atol=8e-2)
+    assert np.allclose(psf.eval_r2z_squared(r**2, z),
+                       psf.eval_xz_squared(r, z))
+    # Zero outside the table
+    r_out = np.array([4.01e-6, 5e-6, 0, 0])
+    z_out = np.array([0, 0, 6.01e-6, -7e-6])
+    assert (psf.eval_xz_squared(r_out, z_out) == 0).all()
+    assert (psf_r2.eval_xz_squared(r_out, z_out) == 0).all()
+
+
+def test_psf_support_culling():
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF(table=True)
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01,
+                                particles=P, box=box, psf=psf)
+    time_size = 10001
+    kw = dict(total_emission=False, save_pos=True, radial=True)
+    POS, em = S._sim_trajectories(time_size, S.particles.positions,
+                                  rs=np.random.RandomState(_SEED), **kw)
+    R, Z = np.vstack(POS)[:, 0], np.vstack(POS)[:, 1]
+    for engine in ['loop', 'batch', 'fused']:
+        # A support containing the whole PSF table gives the same emission
+        S.culled_samples = 0
+        sim_trajectories = S._get_sim_trajectories(
+            engine, psf_support=(4.5e-6, 6.5e-6))
+        _, em_c = sim_trajectories(time_size, S.particles.positions,
+                                   np.random.RandomState(_SEED), **kw)
+        assert np.allclose(em, em_c, rtol=1e-5, atol=1e-7)
+        # Smaller support: zero emission and culled samples outside
+        S.culled_samples = 0
+        sim_trajectories = S._get_sim_trajectories(
+            engine, psf_support=(1e-6, 2e-6))
+        _, em_c = sim_trajectories(time_size, S.particles.positions,
+                                   np.random.RandomState(_SEED), **kw)
+        outside = (R > 1e-6) | (np.abs(Z) > 2e-6)
+        assert (em_c[outside] == 0).all()
+        assert np.allclose(em[~outside], em_c[~outside], rtol=1e-5, atol=1e-7)
+        assert S.culled_samples == outside.sum()
+
+
+def test_sparse_emission(tmp_path):
+    rs = np.random.RandomState(_SEED)
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box, rs=rs)
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                particles=P, box=box, psf=psf)
+    kw = dict(total_emission=False, chunksize=2**11, psf_support=(2e-6, 3e-6),
+              path=str(tmp_path))
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), **kw)
+    emission = S.emission[:]
+    S.store.close()
+
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                particles=P, box=box, psf=psf)
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                         emission_format='sparse', **kw)
+    assert isinstance(S.emission, pbm.storage.SparseEmissionArray)
+    assert 0 < S.emission.nnz < emission.size
+    assert S.emission.shape == emission.shape
+    assert (S.emission[:] == emission).all()
+    assert (S.emission[:, 150:1234] == emission[:, 150:1234]).all()
+    assert (S.emission[2:5, 100:3000:10] == emission[2:5, 100:3000:10]).all()
+    assert (S.emission[3] == emission[3]).all()
+    S.store.close()
+
+    # Stored emission is read transparently when loading from file
+    S2 = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=tmp_path,
+                                               ignore_timestamps=True)
+    assert isinstance(S2.emission, pbm.storage.SparseEmissionArray)
+    assert (S2.emission[:, 1000:2000] == emission[:, 1000:2000]).all()
+    S2.store.close()
+
+    # Conversion between dense and sparse layouts
+    store = pbm.storage.TrajectoryStore(S.store.filepath, mode='a')
+    assert (store.emission_to_dense()[:] == emission).all()
+    sparse = store.emission_to_sparse(threshold=1e-2, overwrite=True)
+    assert (sparse[:] == np.where(emission > 1e-2, emission, 0)).all()
+    store.close()
+
+
+def test_diffusion_sim_adaptive_engine():
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    psf_support = (2e-6, 3e-6)
+    num_particles = 4000
+    P = pbm.Particles(num_particles=num_particles, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                particles=P, box=box, psf=psf)
+    time_size = 512
+    kw = dict(total_emission=False, psf_support=psf_support)
+    _, em = S._sim_trajectories(time_size, S.particles.positions,
+                                rs=np.random.RandomState(_SEED), **kw)
+    start_pos = S.particles.positions
+    S.culled_samples = 0
+    _, em_a = S._sim_trajectories_adaptive(
+        time_size, start_pos, rs=np.random.RandomState(_SEED + 1),
+        jump_size=256, **kw)
+    # Same emission statistics (mean over particles and time)
+    em_mean, em_a_mean = em.mean(axis=1), em_a.mean(axis=1)
+    err = np.sqrt((em_mean.var() + em_a_mean.var()) / num_particles)
+    assert np.abs(em_mean.mean() - em_a_mean.mean()) <= 4 * err
+    nz, nz_a = (em > 0).mean(axis=1), (em_a > 0).mean(axis=1)
+    err = np.sqrt((nz.var() + nz_a.var()) / num_particles)
+    assert np.abs(nz.mean() - nz_a.mean()) <= 4 * err
+    assert 0 < S.culled_samples < em_a.size
+    # Same distribution of the per-particle emission and photon counts.
+    # Each particle starts from the same position in both engines, so
+    # the per-particle differences of any statistic of the emission are
+    # symmetric around 0. The total variation of the emission depends on
+    # the steps inside the blocks (i.e. on the Brownian bridge).
+    emitting = (em > 0).any(axis=1) | (em_a > 0).any(axis=1)
+    assert emitting.sum() > 300
+    em, em_a = em[emitting], em_a[emitting]
+    stat_funcs = [lambda e: e.sum(axis=1),
+                  lambda e: (e > 0).sum(axis=1),
+                  lambda e: np.abs(np.diff(e, axis=1)).sum(axis=1)]
+    for stat_func in stat_funcs:
+        x, x_a = stat_func(em), stat_func(em_a)
+        assert stats.wilcoxon(x, x_a).pvalue > 1e-3
+        assert stats.ks_2samp(x, x_a).pvalue > 1e-3
+    rs = np.random.RandomState(_SEED)
+    counts = rs.poisson(em.sum(axis=1) * 2)
+    counts_a = rs.poisson(em_a.sum(axis=1) * 2)
+    assert stats.ks_2samp(counts, counts_a).pvalue > 1e-3
+    # End positions have the variance of the Brownian motion
+    sigma2 = 2 * 12e-12 * time_size * S.t_step
+    delta = start_pos - S.particles.positions
+    delta = np.mod(delta + 4e-6, 8e-6) - 4e-6    # undo periodic wrapping
+    assert np.abs(delta[:, :2].var() / sigma2 - 1) < 0.15
+
+    # Particles far from the PSF are skipped (no full-resolution steps)
+    P = pbm.Particles(num_particles=None, D=None, box=box,
+                      particles=[pbm.diffusion.Particle(12e-12, 0, 0, 5.9e-6)
+                                 for _ in range(10)])
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                particles=P, box=box, psf=psf)
+    rs = np.random.RandomState(_SEED)
+    _, em_a = S._sim_trajectories_adaptive(time_size, S.particles.positions,
+                                           rs=rs, jump_size=256, **kw)
+    assert (em_a == 0).all()
+    assert S.culled_samples == em_a.size
+    rs2 = np.random.RandomState(_SEED)
+    rs2.normal(size=3 * (time_size // 256) * 10)
+    assert randomstate_equal(rs, rs2)
+
+
+def test_bridge_hit_prob():
+    half_width, period = 1., 8.
+    rs = np.random.RandomState(_SEED)
+
+    def mc_hit_prob(a, b, var, num_bridges=8000, num_steps=500):
+        steps = rs.normal(scale=np.sqrt(var / num_steps),
+                          size=(num_bridges, num_steps))
+        pos = np.cumsum(steps, axis=1)
+        frac = np.arange(1, num_steps + 1) / num_steps
+        pos -= frac * (pos[:, -1:] - (b - a))
+        pos += a
+        hit = np.mod(pos + half_width, period) <= 2 * half_width
+        p = hit.any(axis=1).mean()
+        return p, np.sqrt(p * (1 - p) / num_bridges)
+
+    # Bridge near a single slab edge: the bound is exp(-3) and the hit
+    # probability of the discrete bridge is only slightly lower
+    bound = pbm.diffusion.bridge_hit_prob(2., 2.5, 1., half_width, period)
+    assert np.allclose(bound, np.exp(-3))
+    p, err = mc_hit_prob(2., 2.5, 1.)
+    assert 0.7 * bound < p <= bound + 4 * err
+    # Bridge in the middle of the gap between two slab images
+    bound = pbm.diffusion.bridge_hit_prob(4., 4., 4., half_width, period)
+    assert np.allclose(bound, 2 * np.exp(-4.5))
+    p, err = mc_hit_prob(4., 4., 4.)
+    assert 0.7 * bound < p <= bound + 4 * err
+    # Periodic images of the end-points give the same bound, end-points
+    # inside a slab give 1 and the bound is broadcasted
+    a = np.array([2., 10., -6., 0.5, 2.])
+    b = np.array([2.5, 10.5, -5.5, 2., 7.5])
+    prob = pbm.diffusion.bridge_hit_prob(a, b, 1., half_width, period)
+    assert np.allclose(prob[:3], np.exp(-3))
+    assert (prob[3:] == 1).all()
+
+
+def test_boundary_conditions():
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    rs = np.random.RandomState(_SEED)
+    pos = rs.uniform(-30e-6, 30e-6, size=(5, 3, 100))
+    lo, hi = box.b[:, :1], box.b[:, 1:]
+
+    pos_p = pos.copy()
+    out = pbm.boundary.periodic(pos_p, box.b)
+    assert out is pos_p
+    assert ((pos_p >= lo) & (pos_p < hi)).all()
+    assert (pos_p == np.mod(pos - lo, hi - lo) + lo).all()
+
+    # Mirror with multiple reflections: reflecting the folded positions
+    # back must give the original positions
+    pos_m = pos.copy()
+    assert pbm.boundary.mirror(pos_m, box.b) is pos_m
+    assert ((pos_m >= lo) & (pos_m <= hi)).all()
+    size = hi - lo
+    u = np.mod(pos - lo, 2 * size)
+    expected = np.where(u > size, 2 * size - u, u) + lo
+    assert np.allclose(pos_m, expected, rtol=0, atol=1e-18)
+    # Positions inside the box are not modified and a single reflection
+    # is computed as in the previous per-coordinate wrap function
+    pos = rs.uniform(-5e-6, 5e-6, size=(5, 3, 100))
+    pos_m = pbm.boundary.mirror(pos.copy(), box.b)
+    inside = (pos >= lo) & (pos <= hi)
+    assert (pos_m[inside] == pos[inside]).all()
+    for coord, (a1, a2) in enumerate(box.b):
+        a = pos[:, coord].copy()
+        a[a > a2] = a2 - (a[a > a2] - a2)
+        a[a < a1] = a1 + (a1 - a[a < a1])
+        assert (pos_m[:, coord] == a).all()
+    a = np.array([-4.5e-6, -1e-6, 4.2e-6])
+    assert np.allclose(pbm.diffusion.wrap_mirror(a.copy(), -4e-6, 4e-6),
+                       [-3.5e-6, -1e-6, 3.8e-6], rtol=0, atol=1e-18)
+
+    # The mask buffer is reused: no full-size temporary arrays when the
+    # positions are inside the box
+    import tracemalloc
+    mirror_bc = pbm.boundary.MirrorBoundary()
+    pos_in = rs.uniform(-3.9e-6, 3.9e-6, size=(20, 3, 10000))
+    mirror_bc(pos_in, box.b)
+    buffer = mirror_bc.buffer
+    tracemalloc.start()
+    mirror_bc(pos_in, box.b)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert mirror_bc.buffer is buffer and peak < pos_in.size // 8
+    pos_m2 = mirror_bc(pos.copy(), box.b)
+    assert (pos_m2 == pos_m).all()
+
+    # Any per-coordinate function can be used as boundary condition
+    func_bc = pbm.boundary.get_boundary(lambda a, a1, a2: np.clip(a, a1, a2))
+    pos_f = func_bc(pos.copy(), box.b)
+    assert (pos_f == np.clip(pos, lo, hi)).all()
+    pos_f = func_bc.apply(pos.copy(), lo, hi)
+    assert (pos_f == np.clip(pos, lo, hi)).all()
+    assert pbm.boundary.get_boundary(pbm.diffusion.wrap_mirror) is \
+        pbm.boundary.mirror
+
+
+def test_diffusion_sim_checkpoint_resume(tmp_path):
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+
+    def new_sim():
+        return pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.002,
+                                       particles=P, box=box, psf=psf)
+
+    kw = dict(total_emission=False, save_pos=True, chunksize=2**11,
+              path=str(tmp_path))
+    S = new_sim()
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), **kw)
+    emission, position = S.emission[:], S.position[:]
+    last_state = S.traj_group._v_attrs['last_random_state']
+    S.store.close()
+
+    class Interrupted(Exception):
+        pass
+
+    # Interrupt the simulation after 5 chunks (last checkpoint at chunk 4)
+    S = new_sim()
+    sim_trajectories = S._sim_trajectories
+    num_calls = [0]
+
+    def sim_trajectories_interrupted(*args, **kwargs):
+        num_calls[0] += 1
+        if num_calls[0] > 5:
+            raise Interrupted
+        return sim_trajectories(*args, **kwargs)
+
+    S._sim_trajectories = sim_trajectories_interrupted
+    with pytest.raises(Interrupted):
+        S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                             checkpoint_every=2, **kw)
+    assert S.traj_group._v_attrs['checkpoint_samples'] == \
+        4 * S.emission.chunkshape[1]
+    assert S.emission.shape[1] == 5 * S.emission.chunkshape[1]
+    S.store.close()
+
+    S = new_sim()
+    S.simulate_diffusion(resume=True, checkpoint_every=2, **kw)
+    assert (S.emission[:] == emission).all()
+    assert (S.position[:] == position).all()
+    assert randomstate_equal(S.traj_group._v_attrs['last_random_state'],
+                             last_state)
+    S.store.close()
+
+
+def test_diffusion_sim_extend(tmp_path):
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+
+    def new_sim(t_max):
+        return pbm.ParticlesSimulation(t_step=0.5e-6, t_max=t_max,
+                                       particles=P, box=box, psf=psf)
+
+    kw = dict(total_emission=False, save_pos=True, chunksize=10000,
+              path=str(tmp_path))
+    S = new_sim(0.02)
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), **kw)
+    emission, position = S.emission[:], S.position[:]
+    last_state = S.traj_group._v_attrs['last_random_state']
+    hash_ = S.hash()[:6]
+    S.store.close()
+    S.store.filepath.unlink()
+
+    S = new_sim(0.01)
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), **kw)
+    assert S.n_samples % S.emission.chunkshape[1] == 0
+    S.extend(0.01)
+    assert S.t_max == 0.02 and S.n_samples == emission.shape[1]
+    assert S.hash()[:6] == hash_
+    S.store.close()
+
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path)
+    assert S.store.numeric_params['t_max'] == 0.02
+    assert S.particles == P
+    assert (S.emission[:] == emission).all()
+    assert (S.position[:] == position).all()
+    assert randomstate_equal(S.traj_group._v_attrs['last_random_state'],
+                             last_state)
+    S.store.close()
+
+
+def test_pipeline(tmp_path):
+    from pybromo import pipeline as pl
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01,
+                                particles=P, box=box, psf=psf)
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                         total_emission=False, save_pos=False,
+                         chunksize=2**14, path=str(tmp_path))
+    kw = dict(max_rates_d=(2e6,), max_rates_a=(1e6,),
+              populations=(slice(0, 20),), bg_rate_d=1e4, bg_rate_a=2e4,
+              t_chunksize=3000)
+    S.simulate_timestamps_mix_da(rs=np.random.RandomState(1), **kw)
+    ts_arrays = [S.ts_group._f_get_child(n) for n in S.timestamp_names]
+
+    # Same timestamps with a pipeline storing the timestamps in memory
+    rs = np.random.RandomState(1)
+    chunks = pl.emission_chunks(S, t_chunksize=3000)
+    chunks = pl.Photons('d', S, kw['max_rates_d'], kw['populations'],
+                        kw['bg_rate_d'], rs)(chunks)
+    chunks = pl.Photons('a', S, kw['max_rates_a'], kw['populations'],
+                        kw['bg_rate_a'], rs)(chunks)
+    sink, = pl.run(chunks, pl.MemorySink(['d', 'a']))
+    for name, ts_array in zip(['a', 'd'], sorted(ts_arrays,
+                                                 key=lambda a: a.name)):
+        ts, par = sink.timestamps[name]
+        assert ts.size > 0
+        assert (ts == ts_array[:]).all()
+        par_array = S.ts_group._f_get_child(ts_array.name + '_par')
+        assert (par == par_array[:]).all()
+
+    # Channel split: all the particle photons in 'd', background in 'a'
+    probs = np.zeros((2, S.num_particles + 1))
+    probs[0, :-1] = 1
+    probs[1, -1] = 1
+    chunks = pl.emission_chunks(S)
+    chunks = pl.Photons('all', S, (1e6,), (slice(0, 20),), 1e4,
+                        np.random.RandomState(2))(chunks)
+    chunks = pl.ChannelSplit('all', ['d', 'a'], probs,
+                             np.random.RandomState(3))(chunks)
+    sink, = pl.run(chunks, pl.MemorySink(['d', 'a']))
+    assert (sink.timestamps['d'][1] < S.num_particles).all()
+    assert (sink.timestamps['a'][1] == S.num_particles).all()
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_background_writer(tmp_path):
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    psf = pbm.NumericPSF()
+    P = pbm.Particles(num_particles=10, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    kw_da = dict(max_rates_d=(2e6,), max_rates_a=(1e6,),
+                 populations=(slice(0, 10),), bg_rate_d=1e4, bg_rate_a=2e4,
+                 t_chunksize=3000, overwrite=True)
+    results = []
+    for writer_queue_size in (0, 2):
+        S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01,
+                                    particles=P, box=box, psf=psf)
+        S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                             total_emission=False, save_pos=True,
+                             chunksize=2**12, checkpoint_every=3,
+                             writer_queue_size=writer_queue_size,
+                             path=str(tmp_path))
+        S.simulate_timestamps_mix_da(rs=np.random.RandomState(1),
+                                     writer_queue_size=writer_queue_size,
+                                     **kw_da)
+        ts = [S.ts_group._f_get_child(name)[:]
+              for name in sorted(S.timestamp_names)]
+        results.append((S.emission[:], S.position[:], ts))
+        S.store.close()
+        S.ts_store.close()
+    (em, pos, ts), (em_w, pos_w, ts_w) = results
+    assert (em == em_w).all() and (pos == pos_w).all()
+    assert all((t == t_w).all() for t, t_w in zip(ts, ts_w))
+
+
+def test_chunk_reader(tmp_path):
+    from pybromo.iter_chunks import ChunkReader, map_chunk, reduce_chunk
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=25, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.02, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                         total_emission=False, save_pos=False,
+                         chunksize=2**14, path=str(tmp_path))
+    emission = S.emission[:]
+    num_samples = emission.shape[1]
+    for queue_depth, max_memory in [(0, None), (1, None), (3, None),
+                                    (3, 1)]:
+        reader = ChunkReader(S.emission, queue_depth, max_memory)
+        chunks = list(reader.iter_chunks(chunksize=7000, start=5,
+                                         stop=num_samples - 3))
+        assert chunks[0][0] == 5 and chunks[-1][1] == num_samples - 3
+        assert (np.hstack([c[2] for c in chunks]) ==
+                emission[:, 5:-3]).all()
+        # Stop iterating before the end
+        for i, (i_start, i_end, data) in enumerate(reader.iter_chunks()):
+            assert (data == emission[:, i_start:i_end]).all()
+            if i == 2:
+                break
+        # Scroll through the array, reading ahead the next window
+        for start in (0, 1000, 2000, 500):
+            data = reader.read(start, start + 1000)
+            assert (data == emission[:, start:start + 1000]).all()
+        reader.close()
+    assert ChunkReader(S.emission, 3, max_memory=1).depth(1000) == 0
+
+    assert reduce_chunk(np.max, S.emission, queue_depth=2) == emission.max()
+    with tables.open_file(str(tmp_path / 'em_max.h5'), mode='w') as h5file:
+        out = h5file.create_earray('/', 'em_max', shape=(0,),
+                                   atom=tables.Float32Atom())
+        map_chunk(lambda x: x.max(0), S.emission, out, queue_depth=2)
+        assert (out[:] == emission.max(0)).all()
+
+    # Timestamps simulated with read-ahead are identical
+    kw = dict(max_rates=(400e3,), populations=(slice(0, 25),), bg_rate=1000,
+              overwrite=True)
+    ts = []
+    for reader_queue_size in (0, 2):
+        S.simulate_timestamps_mix(rs=np.random.RandomState(_SEED),
+                                  reader_queue_size=reader_queue_size, **kw)
+        ts.append(S._timestamps[:])
+    assert ts[0].size > 0 and (ts[0] == ts[1]).all()
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_memory_budget(monkeypatch, tmp_path):
+    from pybromo.iter_chunks import MemoryBudget
+
+    # Fewer particles, longer chunks (powers of 2)
+    kw = dict(sample_bytes=4, block_bytes=44, queue_bytes=4, queue_depth=2,
+              memory_fraction=None)
+    b_small = MemoryBudget(2**32, 10, **kw)
+    b_large = MemoryBudget(2**32, 1000, **kw)
+    assert b_small.t_chunksize == 2**22
+    assert b_large.t_chunksize < b_small.t_chunksize
+    for b in (b_small, b_large):
+        assert b.t_chunksize & (b.t_chunksize - 1) == 0
+        assert b.chunk_bytes(b.t_chunksize) <= 2**32
+        assert b.queue_depth == 2 and b.block_size == b.num_particles
+    # Queue depth, then block size, are reduced for large N
+    b = MemoryBudget(2**24, 1000, min_chunksize=2**12, **kw)
+    assert b.queue_depth == 0 and b.block_size < 1000
+    assert b.t_chunksize >= 2**12 and b.chunk_bytes(b.t_chunksize) <= 2**24
+    with pytest.raises(ValueError):
+        MemoryBudget(2**10, 1000, **kw)
+
+    # The simulation uses the planned chunk size
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    budget = S.memory_budget(2**20, memory_fraction=None)
+    assert budget.t_chunksize == 2**13
+    chunks = pbm.pipeline.diffusion_chunks(S, np.random.RandomState(_SEED),
+                                           t_chunksize=2**13)
+    emission = np.hstack([chunk['emission'] for chunk in chunks])
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), save_pos=False,
+                         total_emission=False, max_memory=2**20,
+                         path=str(tmp_path))
+    assert (S.emission[:] == emission).all()
+    assert S.memory_budget(2**24, 'timestamps', queue_depth=4).queue_depth \
+        == 4
+    S.simulate_timestamps_mix(max_rates=(2e5,), populations=(slice(0, 20),),
+                              bg_rate=1e3, max_memory=2**20,
+                              reader_queue_size=2)
+    assert S._timestamps.shape[0] > 0
+    S.store.close()
+    S.ts_store.close()
+
+    # The chunks are shortened when the memory available drops
+    b = MemoryBudget(2**30, 10, sample_bytes=4, memory_fraction=0.5)
+    monkeypatch.setattr(pbm.iter_chunks, 'available_memory', lambda: 2**20)
+    assert b.shrink(2**22) == 2**13
+    assert MemoryBudget(2**30, 10, sample_bytes=4).t_chunksize == 2**14
+
+
+def test_sim_timestamps_vectorized():
+    def sim_timestamps_loop(counts, i_start, ip_start=0, scale=10):
+        # Reference implementation: loop on the particles and counts
+        ts_range = np.arange(i_start * scale,
+                             (i_start + counts.shape[1]) * scale, scale,
+                             dtype='int64')
+        times, par = [], []
+        for ip, counts_ip in enumerate(counts):
+            t = np.hstack([ts_range[counts_ip >= v]
+                           for v in range(1, counts.max() + 1)])
+            times.append(t)
+            par.append(np.full(t.size, ip + ip_start, dtype='u1'))
+        times, par = np.hstack(times), np.hstack(par)
+        index_sort = times.argsort(kind='mergesort')
+        return times[index_sort], par[index_sort]
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=12, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    rs = np.random.RandomState(_SEED)
+    emission = np.hstack([c['emission'] for c in
+                          pbm.pipeline.diffusion_chunks(S, rs, 2**14)])
+    # High rates to have bins with more than one count
+    for max_rate, bg_rate, i_start, ip_start in [(5e7, 1e6, 0, 0),
+                                                 (2e6, None, 1234, 3),
+                                                 (1e-3, None, 0, 0)]:
+        counts = pbm.diffusion.sim_timetrace_bg(
+            emission.astype('float64'), max_rate, bg_rate, S.t_step,
+            rs=np.random.RandomState(1))
+        ts, par = S._sim_timestamps(max_rate, bg_rate,
+                                    emission.astype('float64'), i_start,
+                                    rs=np.random.RandomState(1),
+                                    ip_start=ip_start)
+        if counts.max() == 0:
+            assert ts.size == 0 and par.size == 0
+            continue
+        ts_ref, par_ref = sim_timestamps_loop(counts, i_start, ip_start)
+        assert counts.max() > 1 or bg_rate is None
+        assert ts.dtype == ts_ref.dtype and par.dtype == par_ref.dtype
+        assert (ts == ts_ref).all() and (par == par_ref).all()
+
+
+def test_sparse_sampler(tmp_path):
+    from pybromo.diffusion import sim_timetrace_bg_sparse
+
+    # Mean and variance of the counts of each bin equal the Poisson rate
+    lam = np.array([[0, 0.5, 0, 1.5, 0.2], [0.1, 0, 0, 0, 3.]])
+    bg = 0.4
+    rs = np.random.RandomState(_SEED)
+    num_iter = 5000
+    counts_sum, counts_sum2 = np.zeros((3, 5)), np.zeros((3, 5))
+    for i in range(num_iter):
+        # Blocks of 3 bins, also splitting the rows
+        i_time, i_row, counts = sim_timetrace_bg_sparse(
+            lam, 2., bg, 0.5, rs, block_size=(3, 2**14)[i % 2])
+        cells = i_time * 3 + i_row
+        assert (np.diff(cells) > 0).all() and (counts > 0).all()
+        counts_sum[i_row, i_time] += counts
+        counts_sum2[i_row, i_time] += counts**2
+    rates = np.vstack([lam, np.full(5, bg * 0.5)])
+    mean = counts_sum / num_iter
+    var = counts_sum2 / num_iter - mean**2
+    assert (mean[rates == 0] == 0).all()
+    tol = 5 * np.sqrt(rates / num_iter)
+    assert (np.abs(mean - rates) <= tol).all()
+    assert (np.abs(var - rates) <= 5 * tol).all()
+
+    # On mostly-zero emission only the blocks with photons are searched:
+    # faster than the dense sampler and no temporary array scales with
+    # the size of the emission
+    import time
+    import tracemalloc
+    em = np.zeros((50, 2**17), dtype='float32')
+    em[7, 1000:1500] = 0.5
+    elapsed = {}
+    for sampler in (pbm.diffusion.sim_counts, sim_timetrace_bg_sparse):
+        elapsed[sampler] = []
+        for _ in range(3):
+            t_start = time.perf_counter()
+            sampler(em, 2e5, 1e3, 0.5e-6, np.random.RandomState(1))
+            elapsed[sampler].append(time.perf_counter() - t_start)
+    assert (min(elapsed[sim_timetrace_bg_sparse]) <
+            min(elapsed[pbm.diffusion.sim_counts]) / 2)
+    tracemalloc.start()
+    i_time, i_row, counts = sim_timetrace_bg_sparse(
+        em, 2e5, 1e3, 0.5e-6, np.random.RandomState(1))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < em.nbytes // 32
+    assert counts[i_row == 7].sum() > 0
+    assert ((i_time[i_row == 7] >= 1000) & (i_time[i_row == 7] < 1500)).all()
+    assert set(i_row) <= {7, 50}
+
+    # Timestamps with the sparse sampler
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.05, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), save_pos=False,
+                         total_emission=False, psf_support=(1e-6, 2e-6),
+                         path=str(tmp_path))
+    kw = dict(max_rates=(2e5, 4e5), populations=(slice(0, 8), slice(8, 20)),
+              bg_rate=2e3, t_chunksize=7000, overwrite=True)
+    num_photons = {}
+    for sampler in ('dense', 'sparse'):
+        S.simulate_timestamps_mix(rs=np.random.RandomState(1),
+                                  sampler=sampler, **kw)
+        ts, par = S._timestamps[:], S._tparticles[:]
+        assert (np.diff(ts) >= 0).all() and (ts % 10 == 0).all()
+        assert par.max() <= 20
+        num_photons[sampler] = ts.size
+    n = num_photons['dense']
+    assert abs(num_photons['sparse'] - n) < 5 * np.sqrt(2 * n)
+    with pytest.raises(ValueError):
+        S.simulate_timestamps_mix(sampler='binomial', **kw)
+    # The sparse sampler requires culled emission
+    assert S.emission_culled
+    S.emission_culled = False
+    with pytest.raises(ValueError):
+        S.simulate_timestamps_mix(rs=np.random.RandomState(1),
+                                  sampler='sparse', **kw)
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_thinning_sampler(tmp_path):
+    from pybromo.diffusion import sim_photons_thinning
+
+    # Photons in each time step have the Poisson rate of the step
+    em = np.array([[0, 0.5, 0, 1., 0.2], [0.1, 0, 0, 0, 0.8]])
+    rs = np.random.RandomState(_SEED)
+    num_iter = 5000
+    counts_sum = np.zeros((3, 5))
+    frac = []
+    for _ in range(num_iter):
+        times, rows = sim_photons_thinning(em, 2., 0.6, 0.5, rs)
+        assert (np.diff(times) >= 0).all()
+        assert (times >= 0).all() and (times < 5).all()
+        np.add.at(counts_sum, (rows, times.astype(int)), 1)
+        frac.append(times % 1)
+    rates = np.vstack([em, np.full(5, 0.6 / 2)])
+    tol = 5 * np.sqrt(rates / num_iter)
+    assert (np.abs(counts_sum / num_iter - rates) <= tol).all()
+    # Times are uniform inside each time step
+    frac = np.hstack(frac)
+    assert abs(frac.mean() - 0.5) < 5 * np.sqrt(1 / 12 / frac.size)
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.05, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED), save_pos=False,
+                         total_emission=False, path=str(tmp_path))
+    kw = dict(max_rates=(2e5, 4e5), populations=(slice(0, 8), slice(8, 20)),
+              bg_rate=2e3, t_chunksize=7000, overwrite=True)
+    num_photons = {}
+    for sampler in ('dense', 'thinning'):
+        S.simulate_timestamps_mix(rs=np.random.RandomState(1),
+                                  sampler=sampler, **kw)
+        ts, par = S._timestamps[:], S._tparticles[:]
+        assert (np.diff(ts) >= 0).all() and par.max() <= 20
+        assert ts.max() < S.n_samples * 10
+        num_photons[sampler] = ts.size
+    # Timestamps with a resolution of t_step / scale
+    assert (ts % 10 != 0).any()
+    n = num_photons['dense']
+    assert abs(num_photons['thinning'] - n) < 5 * np.sqrt(2 * n)
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_sim_counts():
+    from pybromo.diffusion import sim_counts, CountsBuffer
+
+    rs = np.random.RandomState(_SEED)
+    emission = (rs.rand(7, 5000) * 0.2).astype('float32')
+    emission_copy = emission.copy()
+    # Reference: a single Poisson draw on the float64 rates
+    rs_ref = np.random.RandomState(1)
+    lam = emission.astype('float64') * (2e6 * 0.5e-6)
+    counts_ref = np.vstack([rs_ref.poisson(lam=lam),
+                            rs_ref.poisson(lam=3e4 * 0.5e-6, size=5000)])
+
+    buffer = CountsBuffer()
+    for block_size in (2**16, 1000, 333):
+        counts = sim_counts(emission, 2e6, 3e4, 0.5e-6,
+                            rs=np.random.RandomState(1),
+                            out=buffer.get((8, 5000)), block_size=block_size)
+        assert counts.dtype == np.uint8
+        assert np.shares_memory(counts, buffer.buffer)
+        assert (counts == counts_ref).all()
+    assert (emission == emission_copy).all()
+    counts = pbm.diffusion.sim_timetrace_bg(emission, 2e6, 3e4, 0.5e-6,
+                                            rs=np.random.RandomState(1))
+    assert (counts == counts_ref).all()
+    assert (emission == emission_copy).all()
+
+    # Overflow policies
+    emission = np.array([[0, 1, 2, 400]], dtype='float32')
+    kw = dict(max_rate=1., bg_rate=None, t_step=1.)
+    counts = sim_counts(emission, rs=np.random.RandomState(1), **kw)
+    assert counts.dtype == np.uint16 and counts[0, 3] > 255
+    counts_ref = counts.copy()
+    counts = sim_counts(emission, rs=np.random.RandomState(1),
+                        overflow='clip', **kw)
+    assert (counts == np.minimum(counts_ref, 255)).all()
+    counts = sim_counts(emission, rs=np.random.RandomState(1),
+                        overflow='wrap', **kw)
+    assert (counts == counts_ref.astype('uint8')).all()
+    with pytest.raises(OverflowError):
+        sim_counts(emission, rs=np.random.RandomState(1), overflow='raise',
+                   **kw)
+    counts = sim_counts(emission, rs=np.random.RandomState(1),
+                        out=CountsBuffer('uint16').get((1, 4)),
+                        overflow='raise', **kw)
+    assert (counts == counts_ref).all()
+
+
+def test_simulate_timestamps_multi(tmp_path):
+    from pybromo import pipeline as pl
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=15, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                         total_emission=False, save_pos=False,
+                         path=str(tmp_path))
+    populations = (slice(0, 5), slice(5, 15))
+    channels = [dict(max_rates=(2e6, 1e6), bg_rate=1e4),
+                dict(max_rates=(1e6, 2e6), bg_rate=2e4),
+                dict(max_rates=(5e5, 5e5), bg_rate=1e3, name='far_red')]
+    names = S.simulate_timestamps_multi(channels, populations,
+                                        rs=np.random.RandomState(1),
+                                        t_chunksize=3000)
+    assert len(names) == 3 and names[2] == 'far_red'
+
+    # Same timestamps with a pipeline storing the timestamps in memory
+    rs = np.random.RandomState(1)
+    chunks = pl.emission_chunks(S, t_chunksize=3000)
+    for name, ch in zip(names, channels):
+        chunks = pl.Photons(name, S, ch['max_rates'], populations,
+                            ch['bg_rate'], rs)(chunks)
+    sink, = pl.run(chunks, pl.MemorySink(names))
+    for name in names:
+        ts, par = S.get_timestamps_part(name)
+        assert ts.shape[0] > 0
+        assert (ts[:] == sink.timestamps[name][0]).all()
+        assert (par[:] == sink.timestamps[name][1]).all()
+    assert S.timestamps_match_pattern('far_red')
+
+    # Existing and duplicated channels
+    assert S.simulate_timestamps_multi(channels[2:], populations,
+                                       skip_existing=True) is None
+    with pytest.raises(pbm.storage.ExistingArrayError):
+        S.simulate_timestamps_multi(channels[2:], populations)
+    with pytest.raises(ValueError):
+        S.simulate_timestamps_multi(channels[:1] * 2, populations,
+                                    rs=np.random.RandomState(1))
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_timestamps_sweep(tmp_path):
+    from pybromo.timestamps import run_sweep
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=15, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                         total_emission=False, save_pos=False,
+                         path=str(tmp_path))
+    params = dict(em_rates=(4e5, 2e5), num_particles=(5, 10), bg_rate_d=1e4)
+    sims = [pbm.TimestapSimulation(S, E_values=E, bg_rate_a=bg_a, **params)
+            for E, bg_a in [((0.2, 0.8), 1e3), ((0.2, 0.8), 2e3),
+                            ((0.5, 0.8), 1e3)]]
+    names = run_sweep(sims, rs=np.random.RandomState(1), path=str(tmp_path),
+                      t_chunksize=3000)
+    # Each configuration has its own random stream
+    assert len(names) == 6
+    assert sims[0].name_timestamps_d != sims[1].name_timestamps_d
+    for sim in sims:
+        sim.merge_da()
+        assert sim.ts.size == sum(S.get_timestamps_part(name)[0].shape[0]
+                                  for name in (sim.name_timestamps_d,
+                                               sim.name_timestamps_a))
+    ts = {name: S.get_timestamps_part(name)[0][:] for name in names}
+
+    # Same input random state, same timestamps
+    assert run_sweep(sims, rs=np.random.RandomState(1), path=str(tmp_path),
+                     overwrite=False, skip_existing=True) == []
+    # ... for any subset or order of the configurations
+    names2 = run_sweep(sims[:0:-1], rs=np.random.RandomState(1),
+                       path=str(tmp_path), t_chunksize=3000)
+    assert set(names2) == set(names[2:])
+    for name in names:
+        assert (S.get_timestamps_part(name)[0][:] == ts[name]).all()
+    # ... and as a D+A simulation with the stream of the configuration
+    seed = pbm.rng.draw_seed(np.random.RandomState(1))
+    sim = sims[2]
+    S.simulate_timestamps_mix_da(
+        sim.em_rates_d, sim.em_rates_a, sim.populations, sim.bg_rate_d,
+        sim.bg_rate_a, rs=pbm.timestamps.sweep_generator(sim, seed),
+        overwrite=True, t_chunksize=3000)
+    for name in (sim.name_timestamps_d, sim.name_timestamps_a):
+        assert (S.get_timestamps_part(name)[0][:] == ts[name]).all()
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_parallel_timestamps(tmp_path):
+    from pybromo import pipeline as pl
+
+    box = pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+    P = pbm.Particles(num_particles=15, D=12e-12, box=box,
+                      rs=np.random.RandomState(_SEED))
+    S = pbm.ParticlesSimulation(t_step=0.5e-6, t_max=0.01, particles=P,
+                                box=box, psf=pbm.NumericPSF())
+    S.simulate_diffusion(rs=np.random.RandomState(_SEED),
+                         total_emission=False, save_pos=False,
+                         path=str(tmp_path))
+    populations = (slice(0, 5), slice(5, 15))
+    channels = [dict(max_rates=(2e6, 1e6), bg_rate=1e4),
+                dict(max_rates=(1e6, 2e6), bg_rate=2e4)]
+    ts = []
+    for num_processes in (1, 3):
+        names = S.simulate_timestamps_multi(
+            channels, populations, rs=np.random.RandomState(1),
+            t_chunksize=3000, overwrite=True, num_processes=num_processes)
+        ts.append([tuple(a[:] for a in S.get_timestamps_part(name))
+                   for name in names])
+    seed = S.get_timestamps_part(names[0])[0].attrs['chunk_seed']
+    assert seed == pbm.rng.draw_seed(np.random.RandomState(1))
+
+    # Same timestamps with one random stream per chunk
+    sink = pl.MemorySink(names)
+    for i_chunk, chunk in enumerate(pl.emission_chunks(S, 3000)):
+        rs = pbm.rng.chunk_generator(seed, i_chunk)
+        chunks = [chunk]
+        for name, ch in zip(names, channels):
+            chunks = pl.Photons(name, S, ch['max_rates'], populations,
+                                ch['bg_rate'], rs)(chunks)
+        for chunk in chunks:
+            sink.append(chunk)
+    sink.close()
+    for name, (t, p) in zip(names, ts[0]):
+        assert (t == sink.timestamps[name][0]).all()
+        assert (p == sink.timestamps[name][1]).all()
+    for (t1, p1), (t3, p3) in zip(*ts):
+        assert t1.size > 0
+        assert (t1 == t3).all() and (p1 == p3).all()
+
+    S.simulate_timestamps_mix(channels[0]['max_rates'], populations,
+                              channels[0]['bg_rate'],
+                              rs=np.random.RandomState(1), t_chunksize=3000,
+                              overwrite=True, num_processes=2)
+    assert (S._timestamps[:] == ts[0][0][0]).all()
+    S.store.close()
+    S.ts_store.close()
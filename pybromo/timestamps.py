@@ -14,6 +14,7 @@ from pathlib import Path
 import phconvert as phc
 
 from .diffusion import hash_
+from . import rng
 from ._version import get_versions
 __version__ = get_versions()['version']
 
@@ -204,7 +205,7 @@ class TimestapSimulation:
     def _calc_hash_da(self, rs):
         """Compute hash of D and A timestamps for single-step D+A case.
         """
-        self.hash_d = hash_(rs.get_state())[:6]
+        self.hash_d = hash_(rng.get_state(rs))[:6]
         self.hash_a = self.hash_d
 
     def run(self, rs, overwrite=True, skip_existing=False, path=None,
@@ -219,7 +220,7 @@ class TimestapSimulation:
         header = ' - Mixture Simulation:'
 
         # Donor timestamps hash is from the input RandomState
-        self.hash_d = hash_(rs.get_state())[:6]   # needed by merge_da()
+        self.hash_d = hash_(rng.get_state(rs))[:6]   # needed by merge_da()
         print('%s Donor timestamps -    %s' % (header, ctime()), flush=True)
         self.S.simulate_timestamps_mix(
             populations = self.populations,
@@ -231,8 +232,9 @@ class TimestapSimulation:
         # of the donor timestamps. This allows deterministic generation of
         # donor + acceptor timestamps given the input random state.
         ts_d, _ = self.S.get_timestamps_part(self.name_timestamps_d)
-        rs.set_state(ts_d.attrs['last_random_state'])
-        self.hash_a = hash_(rs.get_state())[:6]   # needed by merge_da()
+        last_state = rng.state_from_attr(ts_d.attrs['last_random_state'])
+        rng.set_state(rs, last_state)
+        self.hash_a = hash_(rng.get_state(rs))[:6]   # needed by merge_da()
         print('\n%s Acceptor timestamps - %s' % (header, ctime()), flush=True)
         self.S.simulate_timestamps_mix(
             populations = self.populations,
@@ -289,7 +291,7 @@ class TimestapSimulation:
         ts_a, ts_par_a = self.S.get_timestamps_part(self.name_timestamps_a)
         ts, a_ch, part = merge_da(ts_d, ts_par_d, ts_a, ts_par_a)
         assert a_ch.sum() == ts_a.shape[0]
-        assert (-a_ch).sum() == ts_d.shape[0]
+        assert (~a_ch).sum() == ts_d.shape[0]
         assert a_ch.size == ts_a.shape[0] + ts_d.shape[0]
         self.ts, self.a_ch, self.part = ts, a_ch, part
         self.clk_p = ts_d.attrs['clk_p']
@@ -342,3 +344,97 @@ class TimestapSimulation:
         data = self._make_photon_hdf5(identity=identity)
         phc.hdf5.save_photon_hdf5(data, h5_fname=str(filepath),
                                   overwrite=overwrite)
+
+
+def sweep_generator(sim, seed):
+    """Random number generator of a `TimestapSimulation` in a sweep.
+
+    The stream is derived from `seed` and a hash of the simulation
+    parameters (see :func:`rng.chunk_generator`), so it does not depend on
+    the other simulations in the sweep.
+    """
+    params = ([float(r) for r in sim.em_rates_d],
+              [float(r) for r in sim.em_rates_a],
+              sim.populations, float(sim.bg_rate_d), float(sim.bg_rate_a))
+    key = int(hash_(params)[:8], 16)
+    return rng.chunk_generator(seed, key)
+
+
+def run_sweep(simulations, rs, overwrite=True, skip_existing=False,
+              path=None, chunksize=None, save_photon_hdf5=False,
+              identity=None, **kwargs):
+    """Compute D and A timestamps for a grid of `TimestapSimulation`.
+
+    All the simulations must share the same trajectories and `timeslice`.
+    The emission is read from disk (and decompressed) only once: each
+    chunk is used to simulate the timestamps of all the configurations,
+    which are saved in their own timestamps arrays.
+
+    Each configuration uses its own random stream, derived from a seed
+    drawn from `rs` and from the configuration parameters (see
+    :func:`sweep_generator`). The timestamps of a configuration do not
+    depend on the other configurations in the grid (nor on their order)
+    and are the same computed by `simulate_timestamps_mix_da` with this
+    stream (and the same `t_chunksize`). The arrays names contain the
+    hash of the stream state, as in :meth:`TimestapSimulation.run_da`.
+
+    Arguments:
+        simulations (list): `TimestapSimulation` objects to simulate.
+        rs (RandomState object): random state object used to draw the
+            seed of the sweep.
+        overwrite, skip_existing, path, chunksize: as in
+            :meth:`TimestapSimulation.run_da`. With `skip_existing`, only
+            the missing timestamps arrays are simulated.
+        save_photon_hdf5 (bool): if True, save a Photon-HDF5 file for each
+            simulation (see :meth:`TimestapSimulation.save_photon_hdf5`).
+        identity (dict or None): `identity` of the Photon-HDF5 files.
+        kwargs: other arguments passed to
+            :meth:`ParticlesSimulation.simulate_timestamps_multi`
+            (e.g. `t_chunksize`, `max_memory`, `sampler`).
+
+    Returns:
+        The list of the simulated timestamps array names.
+    """
+    S = simulations[0].S
+    timeslice = simulations[0].timeslice
+    if any(sim.S is not S for sim in simulations):
+        raise ValueError('All the simulations must use the same '
+                         'trajectories.')
+    if any(sim.timeslice != timeslice for sim in simulations):
+        raise ValueError('All the simulations must have the same timeslice.')
+    if path is None:
+        path = str(S.store.filepath.parent)
+    if chunksize is not None:
+        kwargs['chunksize'] = chunksize
+    S.open_store_timestamp(chunksize=kwargs.get('chunksize', 2**16),
+                           path=path)
+
+    seed = rng.draw_seed(rs)
+    channels = {}
+    for sim in simulations:
+        rs_sim = sweep_generator(sim, seed)
+        sim._calc_hash_da(rs_sim)
+        for max_rates, bg_rate in ((sim.em_rates_d, sim.bg_rate_d),
+                                   (sim.em_rates_a, sim.bg_rate_a)):
+            name = S._get_ts_name_mix(max_rates, sim.populations, bg_rate,
+                                      rs_sim)
+            channels[name] = dict(max_rates=max_rates, bg_rate=bg_rate,
+                                  populations=sim.populations, name=name,
+                                  rs=rs_sim)
+    if skip_existing and not overwrite:
+        channels = {name: ch for name, ch in channels.items()
+                    if name not in S.ts_group}
+
+    header = ' - Sweep Simulation:'
+    names = []
+    if channels:
+        print('%s %d configurations, %d timestamps arrays - %s' %
+              (header, len(simulations), len(channels), ctime()), flush=True)
+        names = S.simulate_timestamps_multi(
+            list(channels.values()), None, rs=rs, overwrite=overwrite,
+            path=path, timeslice=timeslice, **kwargs)
+    if save_photon_hdf5:
+        for sim in simulations:
+            sim.save_photon_hdf5(identity=identity, path=path)
+    print('\n%s Completed. %s' % (header, ctime()), flush=True)
+    return names